@@ -1,8 +1,20 @@
 import anthill.common.admin as a
 
+import datetime
+import calendar
 import ujson
 
-from . model.discovery import ServiceNotFound, DiscoveryModel
+from . model.discovery import ServiceNotFound, DiscoveryModel, DiscoveryError
+
+
+def author(controller):
+    """
+    Who is making a change from the admin, as logged into the history.
+    """
+    if controller.token is None:
+        return "admin"
+
+    return "admin:{0}".format(controller.token.name or controller.token.account)
 
 
 class NewServiceController(a.AdminController):
@@ -15,7 +27,7 @@ class NewServiceController(a.AdminController):
         except (KeyError, ValueError):
             raise a.ActionError("Corrupted JSON")
 
-        await services.set_service_networks(service_id, networks)
+        await services.set_service_networks(service_id, networks, author=author(self))
 
         raise a.Redirect(
             "service",
@@ -54,7 +66,7 @@ class CloneServiceController(a.AdminController):
         except (KeyError, ValueError):
             raise a.ActionError("Corrupted JSON")
 
-        await services.set_service_networks(service_id, networks)
+        await services.set_service_networks(service_id, networks, author=author(self))
 
         raise a.Redirect(
             "service",
@@ -102,7 +114,8 @@ class RootAdminController(a.AdminController):
     def render(self, data):
         return [
             a.links("Discovery service", [
-                a.link("services", "Edit services", icon="wrench")
+                a.link("services", "Edit services", icon="wrench"),
+                a.link("history", "Change history", icon="history")
             ])
         ]
 
@@ -116,7 +129,7 @@ class ServiceController(a.AdminController):
         service_id = self.context.get("service_id")
         services = self.application.services
 
-        await services.delete_service(service_id)
+        await services.delete_service(service_id, author=author(self))
 
         raise a.Redirect("services", message="Service has been deleted")
 
@@ -168,7 +181,7 @@ class ServiceController(a.AdminController):
         service_id = self.context.get("service_id")
         services = self.application.services
 
-        await services.set_service_networks(service_id, networks)
+        await services.set_service_networks(service_id, networks, author=author(self))
 
         raise a.Redirect("service",
                          message="Service has been updated",
@@ -201,3 +214,116 @@ class ServicesController(a.AdminController):
 
     def access_scopes(self):
         return ["discovery_admin"]
+
+
+class HistoryController(a.AdminController):
+    """
+    Pages through the change history, newest first, and rolls the registry back to a version.
+    """
+
+    PAGE = 50
+
+    async def get(self, before=None):
+        services = self.application.services
+
+        try:
+            before = int(before) if before else None
+        except ValueError:
+            raise a.ActionError("Bad version")
+
+        changes = await services.get_history(before=before, limit=HistoryController.PAGE)
+
+        return {
+            "changes": changes,
+            "older": changes[-1]["version"] if len(changes) == HistoryController.PAGE else None
+        }
+
+    @staticmethod
+    def __describe__(change):
+        old, new = change["old"], change["new"]
+
+        if not old:
+            return "created: " + ujson.dumps(new, escape_forward_slashes=False)
+
+        if not new:
+            return "deleted"
+
+        return ", ".join(
+            "{0}: {1} -> {2}".format(network, old.get(network, "none"), new.get(network, "none"))
+            for network in sorted(set(old).union(new))
+            if old.get(network) != new.get(network))
+
+    def render(self, data):
+        navigate = [
+            a.link("index", "Go back", icon="chevron-left"),
+            a.link("history", "Newest changes", icon="refresh")
+        ]
+
+        if data["older"] is not None:
+            navigate.append(a.link("history", "Older changes", icon="chevron-right", before=data["older"]))
+
+        return [
+            a.breadcrumbs([], "Change history"),
+            a.content("Changes", [
+                {"id": "version", "title": "Version"},
+                {"id": "time", "title": "Time"},
+                {"id": "author", "title": "Author"},
+                {"id": "service", "title": "Service"},
+                {"id": "change", "title": "Change"}
+            ], [
+                {
+                    "version": change["version"],
+                    "time": datetime.datetime.utcfromtimestamp(change["time"]).strftime("%Y-%m-%d %H:%M:%S"),
+                    "author": change["author"] or "unknown",
+                    "service": [
+                        a.link("service", change["service"], icon="wrench", service_id=change["service"])
+                    ],
+                    "change": HistoryController.__describe__(change)
+                }
+                for change in data["changes"]
+            ], "default"),
+            a.form("Go to time (UTC)", fields={
+                "time": a.field("Time", "date", "primary", "non-empty")
+            }, methods={
+                "go": a.method("Go", "primary")
+            }, data={}),
+            a.form("Roll back", fields={
+                "version": a.field("Bring every service changed after this version back to what it was",
+                                   "text", "danger", "number")
+            }, methods={
+                "rollback": a.method("Roll back", "danger")
+            }, data={}),
+            a.links("Navigate", navigate)
+        ]
+
+    def access_scopes(self):
+        return ["discovery_admin"]
+
+    async def go(self, time):
+        for time_format in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+            try:
+                timestamp = calendar.timegm(datetime.datetime.strptime(time, time_format).utctimetuple())
+            except ValueError:
+                continue
+            break
+        else:
+            raise a.ActionError("Bad time: " + time)
+
+        version = await self.application.services.get_version_at(timestamp)
+
+        raise a.Redirect("history", before=version + 1)
+
+    async def rollback(self, version):
+        try:
+            version = int(version)
+        except ValueError:
+            raise a.ActionError("Bad version")
+
+        try:
+            services = await self.application.services.rollback(version, author=author(self))
+        except DiscoveryError as e:
+            raise a.ActionError(e.message)
+
+        raise a.Redirect(
+            "history",
+            message="Rolled back {0} services to version {1}".format(len(services), version))
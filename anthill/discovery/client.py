@@ -0,0 +1,238 @@
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
+
+from . model.discovery import DiscoveryModel, DiscoveryError, ServiceNotFound
+from . model.endpoints import load_endpoints, closest_endpoints, EndpointsError, RoundRobinStrategy
+from . model.locality import Locality
+
+import asyncio
+import logging
+import os
+import time
+import ujson
+
+
+class DiscoveryClient(object):
+    """
+    Resolves the service locations from a local copy of the whole registry, so the lookups
+    do not reach the discovery service at all.
+
+    The copy is fetched from /@snapshot/<network>, and revalidated with a conditional request
+    (If-None-Match: <registry version>) once it is older than refresh_interval, which costs
+    a 304 Not Modified as long as nothing has changed. Meanwhile, the lookups are served from
+    the copy at hand (stale-while-revalidate). The copy is only waited for if it's older than max_stale.
+
+    Should the discovery service be unreachable, the last good copy is kept in use, however old it is.
+    With snapshot_file, the copy is saved to disk as well, so a process started while the discovery
+    service is down can still resolve its peers.
+
+    With region (and zone), the endpoints in the same zone are preferred, then those in the same region.
+
+        client = DiscoveryClient("http://discovery-internal:9502", snapshot_file="discovery.json")
+        await client.start()
+        location = await client.get_service("login")
+    """
+
+    def __init__(self, location, network=DiscoveryModel.INTERNAL, refresh_interval=5.0, max_stale=60.0,
+                 request_timeout=5.0, snapshot_file=None, region=None, zone=None):
+        self.location = location.rstrip("/")
+        self.network = network
+        self.refresh_interval = refresh_interval
+        self.max_stale = max_stale
+        self.request_timeout = request_timeout
+        self.snapshot_file = snapshot_file
+        self.locality = Locality(region, zone) if (region or zone) else None
+
+        self.version = None
+        self.services = {}
+        self.endpoints = {}
+
+        # when the copy was last confirmed to be up to date, and when that was last attempted
+        self.updated = 0
+        self.attempted = 0
+
+        self.refreshing = None
+        self.strategy = RoundRobinStrategy()
+        self.http_client = AsyncHTTPClient()
+
+    async def start(self):
+        """
+        Loads the saved copy (if any), then fetches the current one. Does not fail if the discovery service
+        is unreachable, the lookups will keep trying to refresh the copy later.
+        """
+        if self.snapshot_file:
+            self.__load_file__()
+
+        try:
+            await self.refresh()
+        except DiscoveryError as e:
+            logging.warning("Failed to fetch the discovery snapshot, using the saved one: {0}".format(e.message))
+
+    def stop(self):
+        if self.refreshing is not None:
+            self.refreshing.cancel()
+            self.refreshing = None
+
+    def __load_file__(self):
+        try:
+            with open(self.snapshot_file, "r") as f:
+                snapshot = ujson.load(f)
+        except (IOError, ValueError):
+            return
+
+        self.__apply__(snapshot)
+
+    def __save_file__(self, body):
+        temp = self.snapshot_file + ".tmp"
+
+        try:
+            with open(temp, "w") as f:
+                f.write(body)
+            os.replace(temp, self.snapshot_file)
+        except IOError as e:
+            logging.warning("Failed to save the discovery snapshot: {0}".format(str(e)))
+
+    def __apply__(self, snapshot):
+        endpoints = {}
+
+        for service_id, service_endpoints in snapshot.get("endpoints", {}).items():
+            try:
+                endpoints[service_id] = load_endpoints(service_endpoints)
+            except EndpointsError:
+                continue
+
+        self.services = {
+            service_id: location
+            for service_id, location in snapshot.get("services", {}).items()
+            if location is not None
+        }
+        self.endpoints = endpoints
+        self.version = snapshot.get("version")
+
+    async def refresh(self):
+        """
+        Revalidates the copy right away. Concurrent calls share the same request.
+        """
+        if self.refreshing is None:
+            self.refreshing = asyncio.ensure_future(self.__refresh__())
+
+        try:
+            await asyncio.shield(self.refreshing)
+        finally:
+            if self.refreshing is not None and self.refreshing.done():
+                self.refreshing = None
+
+    async def __refresh__(self):
+        self.attempted = time.monotonic()
+
+        headers = {}
+
+        if self.version is not None:
+            headers["If-None-Match"] = '"{0}"'.format(self.version)
+
+        request = HTTPRequest(
+            self.location + "/@snapshot/" + self.network,
+            method="GET", headers=headers, request_timeout=self.request_timeout)
+
+        try:
+            response = await self.http_client.fetch(request)
+        except HTTPError as e:
+            if e.code != 304:
+                raise DiscoveryError(e.code if e.code != 599 else 503, "Failed to fetch the snapshot: " + str(e))
+        except (IOError, OSError) as e:
+            raise DiscoveryError(503, "Failed to fetch the snapshot: " + str(e))
+        else:
+            body = response.body.decode("utf-8")
+
+            try:
+                snapshot = ujson.loads(body)
+            except ValueError:
+                raise DiscoveryError(500, "Corrupted snapshot")
+
+            self.__apply__(snapshot)
+
+            if self.snapshot_file:
+                self.__save_file__(body)
+
+        self.updated = time.monotonic()
+
+    async def __revalidate__(self):
+        """
+        Makes sure the copy is fresh enough to be served. A stale copy is served as is while it's refreshed
+        in the background, a copy older than max_stale is only served once refreshed (or failed to).
+        """
+        now = time.monotonic()
+
+        if now - self.updated < self.refresh_interval or now - self.attempted < self.refresh_interval:
+            return
+
+        self.attempted = now
+
+        if self.version is not None and now - self.updated < self.max_stale:
+            asyncio.ensure_future(self.__background_refresh__())
+            return
+
+        await self.__background_refresh__()
+
+    async def __background_refresh__(self):
+        try:
+            await self.refresh()
+        except asyncio.CancelledError:
+            raise
+        except DiscoveryError as e:
+            logging.warning("Failed to refresh the discovery snapshot: {0}".format(e.message))
+
+    def __select__(self, service_id):
+        endpoints = self.endpoints.get(service_id)
+
+        if endpoints:
+            return self.strategy.select(
+                (service_id, self.network), closest_endpoints(endpoints, self.locality)).location
+
+        location = self.services.get(service_id)
+
+        if location is None:
+            raise ServiceNotFound(service_id)
+
+        return location
+
+    async def get_service(self, service_id):
+        """
+        Returns a location of the service (one of its endpoints if there are several).
+        """
+        await self.__revalidate__()
+
+        if self.version is None:
+            raise DiscoveryError(503, "Discovery service is unreachable and no snapshot is available")
+
+        return self.__select__(service_id)
+
+    async def list_services(self, service_ids):
+        """
+        Returns a dict of service_id => location, for each of the services asked.
+        """
+        await self.__revalidate__()
+
+        if self.version is None:
+            raise DiscoveryError(503, "Discovery service is unreachable and no snapshot is available")
+
+        return {
+            service_id: self.__select__(service_id)
+            for service_id in service_ids
+        }
+
+    def get_service_endpoints(self, service_id):
+        """
+        Returns every endpoint of the service, as dicts, from the copy at hand.
+        """
+        endpoints = self.endpoints.get(service_id)
+
+        if endpoints:
+            return [endpoint.dump() for endpoint in endpoints]
+
+        location = self.services.get(service_id)
+
+        if location is None:
+            raise ServiceNotFound(service_id)
+
+        return [{"location": location, "weight": 1}]
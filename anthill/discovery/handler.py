@@ -1,21 +1,119 @@
 
 from anthill.common.access import internal, InternalError
 from anthill.common.handler import JsonHandler
-from . model.discovery import ServiceNotFound, DiscoveryModel
+from anthill.common.options import options
+from . model.discovery import ServiceNotFound, DiscoveryModel, DiscoveryError
+from . model.metrics import metrics, REQUEST_DURATION, REQUESTS, ENCODE_DURATION
+from . model.admission import Overloaded
+from . model.encoding import negotiate
 
 from tornado.web import HTTPError
 
+import asyncio
+import time
+import ujson
 
-class DiscoverServiceHandler(JsonHandler):
+
+class InstrumentedHandler(JsonHandler):
+    """
+    Records the request duration, and the time spent encoding the response, per handler.
+    The time spent in the model and in the storage is recorded separately, so whatever is left
+    (the access check, the request parsing) can be told apart.
+    """
+
+    def dumps(self, data, *args, **kwargs):
+        started = time.perf_counter()
+        super(InstrumentedHandler, self).dumps(data, *args, **kwargs)
+        metrics.observe(ENCODE_DURATION, (("handler", self.__class__.__name__),), time.perf_counter() - started)
+
+    def on_finish(self):
+        name = self.__class__.__name__
+        metrics.observe(REQUEST_DURATION, (("handler", name),), self.request.request_time())
+        metrics.inc(REQUESTS, (("handler", name), ("code", self.get_status())))
+
+        super(InstrumentedHandler, self).on_finish()
+
+    def write_error(self, status_code, **kwargs):
+        """
+        An overloaded backend is reported with 503 and Retry-After, so the callers back off
+        instead of retrying right away.
+        """
+        exc_info = kwargs.get("exc_info")
+
+        if exc_info is not None and isinstance(exc_info[1], Overloaded):
+            self.set_status(503)
+            self.set_header("Retry-After", str(exc_info[1].retry_after))
+            self.finish(str(exc_info[1]))
+            return
+
+        super(InstrumentedHandler, self).write_error(status_code, **kwargs)
+
+    def log_exception(self, typ, value, tb):
+        """
+        Shedding the load is expected under overload, so there's no traceback logged for every request shed:
+        those are counted in the metrics instead.
+        """
+        if isinstance(value, Overloaded):
+            return
+
+        super(InstrumentedHandler, self).log_exception(typ, value, tb)
+
+    def author(self):
+        """
+        Who is making a change, as logged into the history.
+        """
+        return "internal:{0}".format(self.request.remote_ip)
+
+
+class DiscoverServiceHandler(InstrumentedHandler):
     # noinspection PyMethodMayBeStatic
     def wrap(self, service):
         return service
 
+    def all_endpoints(self):
+        """
+        If the "all" argument is set, every endpoint of a service is returned (with weights)
+        instead of a single one picked by the server.
+        """
+        return self.get_argument("all", "false") == "true"
+
+    def locality(self):
+        """
+        Where the caller is, so the endpoints closest to it are preferred: as told by the "region" and "zone"
+        arguments, or else by its address (see --discovery_localities).
+        """
+        return self.application.services.get_locality(
+            region=self.get_argument("region", None),
+            zone=self.get_argument("zone", None),
+            address=self.request.remote_ip)
+
+    def encoding(self):
+        """
+        The encoding of the response, as asked with the Accept (application/msgpack) and
+        Accept-Encoding (gzip, br) headers. JSON otherwise.
+        """
+        return negotiate(self.request.headers.get("Accept"), self.request.headers.get("Accept-Encoding"))
+
+    def write_encoded(self, encoding, response):
+        """
+        Writes a response already encoded, a tuple (body, content encoding).
+        """
+        body, content_encoding = response
+
+        self.set_header("Content-Type", encoding.content_type)
+        self.set_header("Vary", "Accept, Accept-Encoding")
+
+        if content_encoding is not None:
+            self.set_header("Content-Encoding", content_encoding)
+
+        self.write(body)
+
 
 class DiscoverHandler(DiscoverServiceHandler):
     async def get(self, service_name):
         try:
-            service = await self.application.services.get_service(service_name, DiscoveryModel.EXTERNAL)
+            service = await self.application.services.get_service(
+                service_name, DiscoveryModel.EXTERNAL, locality=self.locality())
         except ServiceNotFound:
             raise HTTPError(404, "Service '{0}' was not found".format(service_name))
         self.write(service)
@@ -25,7 +123,7 @@ class DiscoverNetworkHandler(DiscoverServiceHandler):
     @internal
     async def get(self, service_name, network):
         try:
-            service = await self.application.services.get_service(service_name, network)
+            service = await self.application.services.get_service(service_name, network, locality=self.locality())
         except ServiceNotFound:
             raise HTTPError(404, "Service '{0}' was not found".format(service_name))
         self.write(service)
@@ -33,26 +131,31 @@ class DiscoverNetworkHandler(DiscoverServiceHandler):
 
 class MultiDiscoverHandler(DiscoverServiceHandler):
     async def get(self, service_names):
+        encoding = self.encoding()
         try:
-            service_ids = await self.application.services.list_services(
-                service_names.split(","), DiscoveryModel.EXTERNAL)
+            response = await self.application.services.get_services_response(
+                service_names.split(","), DiscoveryModel.EXTERNAL,
+                all_endpoints=self.all_endpoints(), locality=self.locality(), encoding=encoding)
         except ServiceNotFound as e:
             raise HTTPError(404, "Service '{0}' was not found".format(e.service_id))
-        self.dumps(service_ids)
+        self.write_encoded(encoding, response)
 
 
 class MultiDiscoverNetworkHandler(DiscoverServiceHandler):
     @internal
     async def get(self, service_names, network):
         services_ids = list(filter(bool, service_names.split(",")))
+        encoding = self.encoding()
         try:
-            service_ids = await self.application.services.list_services(services_ids, network)
+            response = await self.application.services.get_services_response(
+                services_ids, network, all_endpoints=self.all_endpoints(), locality=self.locality(),
+                encoding=encoding)
         except ServiceNotFound as e:
             raise HTTPError(404, "Service '{0}' was not found".format(e.service_id))
-        self.dumps(service_ids)
+        self.write_encoded(encoding, response)
 
 
-class ServiceInternalHandler(JsonHandler):
+class ServiceInternalHandler(InstrumentedHandler):
     @internal
     async def get(self, service_id, network):
         try:
@@ -60,34 +163,410 @@ class ServiceInternalHandler(JsonHandler):
                 service_id,
                 network)
 
+            # the service could be deleted in between, so it's the same "no such service" then
+            endpoints = await self.application.services.get_service_endpoints(service_id, network)
+
         except ServiceNotFound:
             raise HTTPError(
                 400, "No such service")
 
         self.dumps({
             "id": service_id,
-            "location": service
+            "location": service,
+            "endpoints": endpoints
         })
 
     @internal
     async def post(self, service_id, network):
-        service_location = self.get_argument("location")
+        endpoints = self.get_argument("endpoints", None)
 
-        await self.application.services.set_service(
-            service_id,
-            service_location,
-            network)
+        if endpoints is None:
+            service_location = self.get_argument("location")
+
+            await self.application.services.set_service(
+                service_id,
+                service_location,
+                network,
+                author=self.author())
+        else:
+            try:
+                endpoints = ujson.loads(endpoints)
+            except (KeyError, ValueError):
+                raise HTTPError(400, "Corrupted endpoints JSON")
+
+            try:
+                await self.application.services.set_service_endpoints(
+                    service_id,
+                    network,
+                    endpoints,
+                    author=self.author())
+            except DiscoveryError as e:
+                raise HTTPError(e.code, e.message)
 
         self.dumps({"result": "OK"})
 
 
-class ServiceListInternalHandler(JsonHandler):
+class HeartbeatInternalHandler(InstrumentedHandler):
+    """
+    Registers an endpoint of a service, or keeps it registered. A service is supposed to call this
+    periodically, otherwise the endpoint expires in "ttl" seconds. The endpoint may be tagged
+    with the "region" and "zone" it runs in.
+    """
+
+    @internal
+    async def post(self, service_id, network):
+        location = self.get_argument("location")
+
+        try:
+            weight = int(self.get_argument("weight", 1))
+            ttl = self.get_argument("ttl", None)
+            ttl = int(ttl) if ttl is not None else None
+        except ValueError:
+            raise HTTPError(400, "Bad 'weight' or 'ttl' argument")
+
+        try:
+            await self.application.services.heartbeat(
+                service_id, network, location, weight=weight, ttl=ttl,
+                region=self.get_argument("region", None), zone=self.get_argument("zone", None))
+        except DiscoveryError as e:
+            raise HTTPError(e.code, e.message)
+
+        self.dumps({"result": "OK"})
+
+
+class ServiceFailureInternalHandler(InstrumentedHandler):
+    """
+    Lets a caller report it has failed to reach an endpoint of a service,
+    so the selection strategy can avoid it for a while.
+    """
+
+    @internal
+    async def post(self, service_id, network):
+        location = self.get_argument("location")
+        await self.application.services.report_failure(service_id, network, location)
+        self.dumps({"result": "OK"})
+
+
+class ServiceListInternalHandler(DiscoverServiceHandler):
+    @internal
+    async def get(self, network):
+        encoding = self.encoding()
+
+        response = await self.application.services.get_all_services_response(
+            network, all_endpoints=self.all_endpoints(), locality=self.locality(), encoding=encoding)
+
+        self.write_encoded(encoding, response)
+
+
+class QueryInternalHandler(DiscoverServiceHandler):
+    """
+    Looks the services up in the network, a page at a time. Arguments:
+        prefix=<prefix>   only the services with ids starting with the prefix
+        pattern=<glob>    only the services with ids matching the pattern (*, ? and [...])
+        tag=<a,b>         only the services with all of the tags
+        cursor=<cursor>   the "next" of the previous page, to continue
+        limit=<n>         at most that many services (100 by default)
+        all=true          every endpoint of a service instead of a single one
+    """
+
     @internal
     async def get(self, network):
+        try:
+            limit = min(int(self.get_argument("limit", 100)), 1000)
+        except ValueError:
+            raise HTTPError(400, "Bad 'limit' argument")
+
+        if limit <= 0:
+            raise HTTPError(400, "Bad 'limit' argument")
+
+        tags = self.get_argument("tag", None)
+
+        services, cursor = await self.application.services.query_services(
+            network,
+            prefix=self.get_argument("prefix", ""),
+            pattern=self.get_argument("pattern", None),
+            tags=list(filter(bool, tags.split(","))) if tags else None,
+            cursor=self.get_argument("cursor", None),
+            limit=limit,
+            all_endpoints=self.all_endpoints(),
+            locality=self.locality())
+
+        self.dumps({
+            "services": services,
+            "next": cursor
+        })
+
+
+class TagsInternalHandler(InstrumentedHandler):
+    """
+    The tags of the service, to look it up with (see QueryInternalHandler). POST "tags" as a JSON list
+    to replace them.
+    """
+
+    @internal
+    async def get(self, service_id):
+        tags = await self.application.services.get_service_tags(service_id)
+        self.dumps({"tags": tags})
+
+    @internal
+    async def post(self, service_id):
+        try:
+            tags = ujson.loads(self.get_argument("tags"))
+        except (KeyError, ValueError):
+            raise HTTPError(400, "Corrupted 'tags' argument")
+
+        try:
+            await self.application.services.set_service_tags(service_id, tags)
+        except ServiceNotFound:
+            raise HTTPError(404, "Service '{0}' was not found".format(service_id))
+        except DiscoveryError as e:
+            raise HTTPError(e.code, e.message)
+
+        self.dumps({"tags": tags})
+
+
+class ServicesSnapshotInternalHandler(InstrumentedHandler):
+    """
+    Same as ServiceListInternalHandler, but the listing is pre-serialized once per registry version,
+    and tagged with that version. A client that already has the current version gets 304 Not Modified
+    without the database being touched at all.
+    """
+
+    def compute_etag(self):
+        return None
+
+    def __not_modified__(self, version):
+        self.set_header("Etag", '"{0}"'.format(version))
+
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+
+        return False
+
+    @internal
+    async def get(self, network):
+        services = self.application.services
+
+        version = services.get_known_version()
+
+        if version is not None and self.__not_modified__(version):
+            return
+
+        version, body = await services.get_snapshot(network)
+
+        if self.__not_modified__(version):
+            return
+
+        self.set_header("Content-Type", "application/json")
+        self.write(body)
+
+
+class WatchServicesHandler(InstrumentedHandler):
+    """
+    Long-polls for the location changes: blocks until any of the services requested changes after
+    the registry version passed as the "since" argument, then responds with the changed locations only.
+    """
+
+    def __init__(self, application, request, **kwargs):
+        super(WatchServicesHandler, self).__init__(application, request, **kwargs)
+        self.watch = None
+
+    def on_connection_close(self):
+        if self.watch is not None:
+            self.watch.cancel()
 
-        services_list = await self.application.services.list_all_services(network)
+    async def watch_services(self, service_names, network):
+        service_ids = list(filter(bool, service_names.split(",")))
 
-        self.dumps(services_list)
+        try:
+            since = int(self.get_argument("since", 0))
+            timeout = min(float(self.get_argument("timeout", options.discovery_watch_timeout)),
+                          options.discovery_watch_timeout)
+        except ValueError:
+            raise HTTPError(400, "Bad 'since' or 'timeout' argument")
+
+        self.watch = asyncio.ensure_future(self.application.services.watch_services(
+            service_ids, network, since, timeout))
+
+        try:
+            result = await self.watch
+        except asyncio.CancelledError:
+            return
+        except DiscoveryError as e:
+            raise HTTPError(e.code, e.message)
+        finally:
+            self.watch = None
+
+        self.dumps(result)
+
+
+class WatchHandler(WatchServicesHandler):
+    async def get(self, service_names):
+        await self.watch_services(service_names, DiscoveryModel.EXTERNAL)
+
+
+class WatchNetworkHandler(WatchServicesHandler):
+    @internal
+    async def get(self, service_names, network):
+        await self.watch_services(service_names, network)
+
+
+class ExportInternalHandler(InstrumentedHandler):
+    """
+    Streams the whole registry as JSON, in the same format as the services init file.
+    """
+
+    @internal
+    async def get(self):
+        self.set_header("Content-Type", "application/json")
+        self.write('{"services":{')
+
+        separator = ""
+
+        async for batch in self.application.services.export_services():
+            if not batch:
+                continue
+
+            self.write(separator + ",".join(
+                ujson.dumps(service_id) + ":" + ujson.dumps(networks, escape_forward_slashes=False)
+                for service_id, networks in batch))
+
+            separator = ","
+            await self.flush()
+
+        self.write("}}")
+
+
+class ImportInternalHandler(InstrumentedHandler):
+    """
+    Applies the registry posted (in the same format as the services init file), writing only the services
+    that are new or have changed. Arguments:
+        dry_run=true  only report the difference, write nothing
+        delete=true   also remove the services missing in the registry posted
+    """
+
+    @internal
+    async def post(self):
+        try:
+            data = ujson.loads(self.request.body)
+        except ValueError:
+            raise HTTPError(400, "Corrupted JSON")
+
+        dry_run = self.get_argument("dry_run", "false") == "true"
+        delete = self.get_argument("delete", "false") == "true"
+
+        try:
+            difference = await self.application.services.import_services(
+                data, dry_run=dry_run, delete=delete, author=self.author())
+        except DiscoveryError as e:
+            raise HTTPError(e.code, e.message)
+
+        self.dumps(difference)
+
+
+class ReadyInternalHandler(InstrumentedHandler):
+    """
+    Readiness probe: 200 once the services init file has been reconciled with the registry, 503 till then.
+    The lookups are served either way.
+    """
+
+    @internal
+    async def get(self):
+        ready, state = self.application.services.is_ready()
+
+        if not ready:
+            self.set_status(503)
+
+        state["ready"] = ready
+        self.dumps(state)
+
+
+class HistoryInternalHandler(InstrumentedHandler):
+    """
+    Pages through the change history, newest first. Arguments:
+        before=<version>  only the changes before the version (the version of the last change seen, to page on)
+        after=<version>   only the changes after the version
+        since=<time>      only the changes made since the unix timestamp
+        limit=<n>         at most that many changes (100 by default)
+    """
+
+    @internal
+    async def get(self):
+        try:
+            before = self.get_argument("before", None)
+            before = int(before) if before is not None else None
+            after = int(self.get_argument("after", 0))
+            since = self.get_argument("since", None)
+            since = float(since) if since is not None else None
+            limit = min(int(self.get_argument("limit", 100)), 1000)
+        except ValueError:
+            raise HTTPError(400, "Bad 'before', 'after', 'since' or 'limit' argument")
+
+        if limit <= 0:
+            raise HTTPError(400, "Bad 'limit' argument")
+
+        changes = await self.application.services.get_history(before=before, after=after, limit=limit, since=since)
+
+        self.dumps({
+            "changes": changes,
+            "next": changes[-1]["version"] if len(changes) == limit else None
+        })
+
+
+class HistoryVersionInternalHandler(InstrumentedHandler):
+    """
+    Returns the whole registry as it was at the version, in the same format as the services init file.
+    """
+
+    @internal
+    async def get(self, version):
+        try:
+            services = await self.application.services.get_registry_at(int(version))
+        except DiscoveryError as e:
+            raise HTTPError(e.code, e.message)
+
+        self.dumps({
+            "version": int(version),
+            "services": services
+        })
+
+
+class RollbackInternalHandler(InstrumentedHandler):
+    """
+    Brings the registry back to what it was at the "version" argument.
+    """
+
+    @internal
+    async def post(self):
+        try:
+            version = int(self.get_argument("version"))
+        except ValueError:
+            raise HTTPError(400, "Bad 'version' argument")
+
+        try:
+            services = await self.application.services.rollback(version, author=self.author())
+        except DiscoveryError as e:
+            raise HTTPError(e.code, e.message)
+
+        self.dumps({"services": services})
+
+
+class CacheStatsInternalHandler(InstrumentedHandler):
+    @internal
+    async def get(self):
+        self.dumps(self.application.services.get_cache_stats())
+
+
+class MetricsInternalHandler(InstrumentedHandler):
+    """
+    Exposes the metrics of this process in the Prometheus text format.
+    """
+
+    @internal
+    async def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(self.application.services.get_metrics())
 
 
 class InternalHandler(object):
@@ -111,6 +590,21 @@ class InternalHandler(object):
     async def set_service(self, service_id, network, location):
         services = self.application.services
 
-        await services.set_service(service_id, location, network=network)
+        await services.set_service(service_id, location, network=network, author="internal")
+
+        return "OK"
+
+    async def heartbeat(self, service_id, network, location, weight=1, ttl=None, region=None, zone=None):
+        services = self.application.services
+
+        try:
+            await services.heartbeat(service_id, network, location, weight=weight, ttl=ttl, region=region, zone=zone)
+        except DiscoveryError as e:
+            raise InternalError(e.code, e.message)
+
+        return "OK"
+
+    async def report_failure(self, service_id, network, location):
+        await self.application.services.report_failure(service_id, network, location)
 
         return "OK"
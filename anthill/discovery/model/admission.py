@@ -0,0 +1,94 @@
+
+from collections import deque
+
+import asyncio
+import time
+
+
+class Overloaded(Exception):
+    """
+    Raised when a backend operation could not be started before the queue deadline.
+    """
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return "Service is overloaded, retry in {0} seconds".format(self.retry_after)
+
+
+class AdmissionControl(object):
+    """
+    Limits the number of backend operations in flight. The operations over the limit are queued
+    (first come, first served), and fail with Overloaded if not started within `deadline` seconds,
+    so a burst turns into fast failures rather than a queue growing without limit.
+
+        async with admission:
+            await storage.get_services(...)
+
+    A limit of 0 lets everything in.
+    """
+
+    def __init__(self, limit, deadline, retry_after):
+        self.limit = limit
+        self.deadline = deadline
+        self.retry_after = retry_after
+
+        self.active = 0
+        self.waiters = deque()
+
+        self.admitted = 0
+        self.rejected = 0
+        self.queued_time = 0.0
+
+    async def __aenter__(self):
+        if self.limit <= 0 or (self.active < self.limit and not self.waiters):
+            self.active += 1
+            self.admitted += 1
+            return
+
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+        started = time.monotonic()
+
+        try:
+            await asyncio.wait_for(waiter, self.deadline)
+        except asyncio.TimeoutError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot has been handed over right as the deadline hit, pass it on
+                self.__release__()
+            self.rejected += 1
+            raise Overloaded(self.retry_after)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.__release__()
+            raise
+        finally:
+            self.queued_time += time.monotonic() - started
+
+        self.admitted += 1
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.__release__()
+
+    def __release__(self):
+        """
+        Hands the slot straight over to the next operation in the queue, if any.
+        """
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+        self.active -= 1
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queued": sum(1 for waiter in self.waiters if not waiter.done()),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "queued_time": self.queued_time
+        }
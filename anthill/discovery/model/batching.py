@@ -0,0 +1,91 @@
+
+import asyncio
+import logging
+
+
+class WriteCoalescer(object):
+    """
+    Groups the location updates arriving within `window` seconds (or up to `max_size` services, whichever
+    comes first) into a single commit: every service updated gets a single write, a single registry version
+    and a single notification, however many updates it had in the window, and all of them go in one
+    transaction. A writer is acknowledged (or gets the error) once the batch its update is in has been committed.
+
+    `commit` is an async callable taking a dict of service_id => (dict of network => location, author).
+    The batches are committed one at a time, in order, so a later update of a service never gets overwritten
+    by an earlier one. An update of a service by another author than the one pending starts a new batch,
+    so every author gets their own change in the history.
+    """
+
+    def __init__(self, window, max_size, commit):
+        self.window = window
+        self.max_size = max_size
+        self.commit = commit
+
+        self.pending = {}
+        self.waiters = []
+        self.timer = None
+
+        # the last batch committed (or being committed), the next one waits for it
+        self.last = None
+
+    async def set(self, service_id, network, location, author=None):
+        """
+        Queues the update, returns once it has been committed.
+        """
+        if service_id in self.pending and self.pending[service_id][1] != author:
+            self.__flush__()
+
+        locations = self.pending[service_id][0] if service_id in self.pending else {}
+        locations[network] = location
+        self.pending[service_id] = (locations, author)
+
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+
+        if len(self.pending) >= self.max_size:
+            self.__flush__()
+        elif self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(self.window, self.__flush__)
+
+        await waiter
+
+    def __flush__(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if not self.pending:
+            return
+
+        batch, waiters = self.pending, self.waiters
+        self.pending, self.waiters = {}, []
+
+        self.last = asyncio.ensure_future(self.__commit__(batch, waiters, self.last))
+
+    async def __commit__(self, batch, waiters, previous):
+        if previous is not None:
+            # whatever has happened to it, it's done with
+            await asyncio.wait([previous])
+
+        try:
+            await self.commit(batch)
+        except Exception as e:
+            logging.error("Failed to commit {0} service updates: {1}".format(len(batch), str(e)))
+
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+        else:
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    async def stop(self):
+        """
+        Commits whatever is pending, and waits for it.
+        """
+        self.__flush__()
+
+        if self.last is not None:
+            await asyncio.wait([self.last])
+            self.last = None
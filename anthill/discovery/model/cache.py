@@ -0,0 +1,221 @@
+
+from collections import OrderedDict
+from collections.abc import Mapping
+
+import sys
+import time
+
+
+class ServiceEntry(Mapping):
+    """
+    A compact, read-only network => location map of a cached service. Instead of a dict per service,
+    the locations are kept in a tuple, one column per network: the network names are interned once
+    and shared by every entry (there are only a few of them), so a service costs an object and a tuple.
+    Behaves like a dict otherwise, dict(entry) makes a real one.
+    """
+
+    __slots__ = ("locations",)
+
+    # network name => column, and the other way around; only ever grows, as the networks are few
+    columns = {}
+    names = []
+
+    def __init__(self, locations):
+        self.locations = locations
+
+    @staticmethod
+    def column(network):
+        index = ServiceEntry.columns.get(network)
+
+        if index is None:
+            network = sys.intern(network)
+            index = ServiceEntry.columns[network] = len(ServiceEntry.names)
+            ServiceEntry.names.append(network)
+
+        return index
+
+    @staticmethod
+    def pack(networks):
+        if not networks:
+            return EMPTY
+
+        locations = []
+
+        for network, location in networks.items():
+            index = ServiceEntry.column(network)
+
+            if index >= len(locations):
+                locations.extend([None] * (index + 1 - len(locations)))
+
+            locations[index] = location
+
+        return ServiceEntry(tuple(locations))
+
+    def get(self, network, default=None):
+        index = ServiceEntry.columns.get(network)
+
+        if index is None or index >= len(self.locations):
+            return default
+
+        location = self.locations[index]
+        return default if location is None else location
+
+    def __getitem__(self, network):
+        location = self.get(network)
+
+        if location is None:
+            raise KeyError(network)
+
+        return location
+
+    def __iter__(self):
+        names = ServiceEntry.names
+        return (names[index] for index, location in enumerate(self.locations) if location is not None)
+
+    def __len__(self):
+        return sum(1 for location in self.locations if location is not None)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+EMPTY = ServiceEntry(())
+
+
+class ServicesCache(object):
+    """
+    In-process read-through cache of service locations: service_id => ServiceEntry.
+
+    Entries are only served while the cache is enabled, that is, while the invalidation channel
+    is subscribed. Otherwise other replicas could change a location without us knowing.
+
+    A service that does not exist is remembered as well, so repeated lookups of a missing service do not
+    reach the database either. Anyone can look up any id though, so those are kept apart: at most
+    `missing_size` of them (the least recently looked up go first), each for `missing_ttl` seconds.
+    """
+
+    MISSING_SIZE = 1024
+    MISSING_TTL = 10
+
+    def __init__(self, store=True, missing_size=MISSING_SIZE, missing_ttl=MISSING_TTL):
+        self.services = {}
+        # service_id => when it's to be forgotten, in the order of the last lookup
+        self.missing = OrderedDict()
+        self.missing_size = missing_size
+        self.missing_ttl = missing_ttl
+        # with store off, nothing is actually kept, but the changes are still tracked
+        self.store = store
+        self.enabled = False
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, service_id):
+        if not self.enabled or not self.store:
+            return None
+
+        networks = self.services.get(service_id)
+
+        if networks is None:
+            expires = self.missing.get(service_id)
+
+            if expires is not None:
+                if expires > time.monotonic():
+                    self.missing.move_to_end(service_id)
+                    self.hits += 1
+                    return EMPTY
+
+                del self.missing[service_id]
+
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return networks
+
+    def put(self, service_id, networks, generation):
+        """
+        Stores the networks fetched from the database, returns what is stored (or the networks as they are,
+        if nothing is). The generation should be obtained before the fetch: if an invalidation arrived
+        in the meantime, the (possibly stale) result is dropped.
+        """
+        if not self.store:
+            return networks
+
+        entry = ServiceEntry.pack(networks)
+
+        if not self.enabled or generation != self.generation:
+            return entry
+
+        if entry is EMPTY:
+            self.missing[service_id] = time.monotonic() + self.missing_ttl
+            self.missing.move_to_end(service_id)
+
+            while len(self.missing) > self.missing_size:
+                self.missing.popitem(last=False)
+        else:
+            self.services[service_id] = entry
+            self.missing.pop(service_id, None)
+
+        return entry
+
+    def invalidate(self, service_id):
+        self.generation += 1
+        self.services.pop(service_id, None)
+        self.missing.pop(service_id, None)
+
+    def clear(self):
+        self.generation += 1
+        self.services.clear()
+        self.missing.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.services),
+            "missing": len(self.missing),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": (float(self.hits) / total) if total else 0.0
+        }
+
+
+class ResponsesCache(object):
+    """
+    Fully encoded responses, each tagged with the registry version it was built at.
+    A response is only served at the same version; every registry change makes all of them outdated,
+    which is why they are simply dropped (see clear) as soon as the version moves on, or a change older
+    than the version arrives late.
+    The least recently built responses are evicted once there are more than `size` of them.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.responses = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        response = self.responses.get(key)
+
+        if response is not None and response[0] == version:
+            self.hits += 1
+            return response[1]
+
+        self.misses += 1
+        return None
+
+    def put(self, key, version, body):
+        if self.size <= 0:
+            return
+
+        self.responses[key] = (version, body)
+        self.responses.move_to_end(key)
+
+        while len(self.responses) > self.size:
+            self.responses.popitem(last=False)
+
+    def clear(self):
+        self.responses.clear()
@@ -1,12 +1,27 @@
 
-from anthill.common import keyvalue
-
 from anthill.common.options import options
 from anthill.common.model import Model
-from anthill.common.validate import validate, validate_value, ValidationError
+from anthill.common.validate import validate_value, ValidationError
+
+from . cache import ServicesCache, ResponsesCache
+from . watch import ChangesLog
+from . endpoints import parse_endpoints, dump_endpoints, load_endpoints, closest_endpoints, Endpoint, EndpointsError
+from . endpoints import STRATEGIES
+from . locality import Locality, LocalityMap, LocalityError
+from . storage import create_storage, StorageListener, StorageError
+from . metrics import metrics, measured, COALESCED_LOOKUPS
+from . admission import AdmissionControl, Overloaded
+from . snapshot import SnapshotPublisher
+from . history import ChangeHistory, HistoryError
+from . encoding import JSON
+from . batching import WriteCoalescer
 
+from fnmatch import fnmatchcase
+
+import asyncio
 import ujson
 import logging
+import time
 
 
 class DiscoveryError(Exception):
@@ -18,7 +33,7 @@ class DiscoveryError(Exception):
         return str(self.code) + ": " + str(self.message)
 
 
-class DiscoveryModel(Model):
+class DiscoveryModel(Model, StorageListener):
 
     INTERNAL = "internal"
     EXTERNAL = "external"
@@ -26,129 +41,1003 @@ class DiscoveryModel(Model):
 
     NETWORKS = [INTERNAL, EXTERNAL, BROKER]
 
+    # states of the init file reconciliation
+    RECONCILE_PENDING = "pending"
+    RECONCILE_DONE = "done"
+    RECONCILE_FAILED = "failed"
+
+    # how long to wait (in seconds) before the reconciliation is retried after the storage has failed
+    RECONCILE_RETRY_DELAY = 5
+
+    # how many pages of the index a single query may scan (when the pattern or the tags filter most of it out)
+    # before it returns what it has got, with a cursor to continue
+    QUERY_MAX_SCANS = 10
+
+    TAGS_MAX = 32
+    TAG_MAX_LENGTH = 64
+
     def __init__(self, application):
         self.application = application
 
-        self.kv = keyvalue.KeyValueStorage(
-            host=options.discover_services_host,
-            port=options.discover_services_port,
-            db=options.discover_services_db)
+        try:
+            self.storage = create_storage(options.discover_services_storage, self)
+        except StorageError as e:
+            raise DiscoveryError(500, e.message)
+
+        self.cache = ServicesCache(store=self.storage.cacheable)
+
+        self.admission = AdmissionControl(
+            options.discovery_max_backend_operations,
+            options.discovery_backend_queue_timeout,
+            options.discovery_overload_retry_after)
+
+        # service_id => the fetch in progress, shared by every concurrent lookup of that service
+        self.fetches = {}
+
+        # the most recent registry version known to this replica, and the listings serialized at it
+        self.version = 0
+        self.snapshots = {}
+        self.responses = ResponsesCache(options.discovery_responses_cache_size)
+
+        self.changes = ChangesLog(options.discovery_watch_history)
+
+        strategy = STRATEGIES.get(options.discovery_endpoint_strategy)
+
+        if strategy is None:
+            raise DiscoveryError(500, "Unknown endpoint selection strategy: {0}".format(
+                options.discovery_endpoint_strategy))
+
+        self.strategy = strategy()
+
+        try:
+            self.localities = LocalityMap(options.discovery_localities)
+        except LocalityError as e:
+            raise DiscoveryError(500, e.message)
+
+        # the process that reads the registry from the storage itself shares it with the other
+        # worker processes (if any) through a snapshot file, see SnapshotServicesStorage
+        if options.discovery_snapshot_file and self.storage.cacheable:
+            self.publisher = SnapshotPublisher(
+                options.discovery_snapshot_file, options.discovery_snapshot_interval,
+                options.discovery_watch_history, self.changes, self.__all_networks__)
+        else:
+            self.publisher = None
+
+        self.history = ChangeHistory(
+            self.storage, options.discovery_history_snapshot_every, options.discovery_history_snapshots)
+
+        # the location updates close in time are committed together, see set_service
+        if options.discovery_write_batch_window > 0:
+            self.writes = WriteCoalescer(
+                options.discovery_write_batch_window, options.discovery_write_batch_size, self.__set_locations__)
+        else:
+            self.writes = None
+
+        # the init file is reconciled with the registry in the background, see started
+        self.reconciliation = DiscoveryModel.RECONCILE_DONE
+        self.reconciliation_result = None
+        self.reconciliation_task = None
+
+        metrics.add_collector(self.__collect_metrics__)
 
     async def started(self, application):
+        """
+        The lookups are served out of the registry at hand right away, the services of the init file
+        missing in the registry are added in the background (see is_ready).
+        """
+        await self.storage.start()
+
         services_init_file = options.services_init_file
 
         if services_init_file:
-            is_empty = await self.is_empty()
+            self.reconciliation = DiscoveryModel.RECONCILE_PENDING
+            self.reconciliation_task = asyncio.ensure_future(self.__reconcile__(services_init_file))
 
-            if is_empty:
-                logging.info("Discovery records database is empty, initializing from {0}".format(services_init_file))
+    async def stopped(self):
+        if self.reconciliation_task is not None:
+            self.reconciliation_task.cancel()
+            self.reconciliation_task = None
 
-            try:
-                with open(services_init_file, "r") as f:
-                    data = ujson.load(f)
-            except IOError as e:
-                raise DiscoveryError(500, "Failed to load services init file: " + str(e))
-            else:
-                if not is_empty:
-                    data = await self.get_unloaded_data(data)
-                await self.setup_services(data)
-
-    @validate(data="json_dict")
-    async def get_unloaded_data(self, data):
-        async with self.kv.acquire() as db:
-            _data = {"services": {}}
-            db_keys = await db.keys("*")
-            try:
-                data_keys = list(data["services"].keys())
-            except KeyError:
-                raise DiscoveryError(400, "Init file has no 'services' section defined.")
+        if self.writes is not None:
+            await self.writes.stop()
+
+        if self.publisher is not None:
+            self.publisher.stop()
+
+        self.history.stop()
+
+        await self.storage.stop()
+        await super(DiscoveryModel, self).stopped()
+
+    def storage_connected(self, version):
+        """
+        The cache is only enabled while the storage can tell about every change, including the changes
+        made by the other replicas.
+        """
+        self.cache.clear()
+        self.fetches.clear()
+        self.snapshots.clear()
+        self.responses.clear()
+        self.version = version
+        self.changes.reset(version)
+        self.cache.enabled = True
+
+        if self.publisher is not None:
+            self.publisher.storage_connected(version)
+
+    def storage_changed(self, service_id, version):
+        if service_id is not None:
+            self.cache.invalidate(service_id)
+            self.strategy.changed(service_id)
+            # a lookup coming after the change should not join a fetch that might have started before it
+            self.fetches.pop(service_id, None)
+
+        self.changes.add(version, service_id)
+
+        if self.publisher is not None and service_id is not None:
+            self.publisher.storage_changed(service_id, version)
+
+        # the snapshots are kept, those are only served at their version, or while overloaded
+        if version > self.version:
+            self.version = version
+            self.responses.clear()
+        elif service_id is not None:
+            # a change from another replica that has come late: a snapshot or a response built
+            # at a later version could have the service as it was before it
+            self.snapshots.clear()
+            self.responses.clear()
+
+    def storage_disconnected(self):
+        self.cache.enabled = False
+        self.cache.clear()
+        self.fetches.clear()
+        self.responses.clear()
+        self.changes.reset(0)
+
+        if self.publisher is not None:
+            self.publisher.storage_disconnected()
+
+    async def __backend__(self, operation, *args):
+        """
+        Calls the storage operation once admitted, see AdmissionControl. Raises Overloaded
+        if the operation could not be started in time.
+        """
+        async with self.admission:
+            return await operation(*args)
+
+    async def __get_networks__(self, service_id):
+        networks = await self.__get_networks_many__([service_id])
+        return networks[service_id]
+
+    async def __get_networks_many__(self, service_ids):
+        """
+        Same as __get_networks__, but for a number of services at once: whatever is missing in the
+        cache is fetched from the storage in a single batch, regardless of how many services are asked.
+
+        Concurrent lookups of the same service share a single fetch: a service already being fetched
+        for another lookup is waited for rather than fetched again, so only the distinct services
+        reach the storage.
+        """
+        result = {}
+        missing = []
+        pending = {}
+
+        for service_id in service_ids:
+            networks = self.cache.get(service_id)
+            if networks is not None:
+                result[service_id] = networks
+                continue
+
+            fetch = self.fetches.get(service_id)
+            if fetch is not None:
+                pending[service_id] = fetch
+            elif service_id not in result:
+                result[service_id] = None
+                missing.append(service_id)
+
+        if missing:
+            fetch = asyncio.ensure_future(self.__fetch__(missing))
+            fetch.add_done_callback(lambda f: self.__fetched__(missing, f))
+
+            for service_id in missing:
+                self.fetches[service_id] = fetch
+                pending[service_id] = fetch
+
+        if not pending:
+            return result
+
+        if len(pending) > len(missing):
+            metrics.inc(COALESCED_LOOKUPS, (), len(pending) - len(missing))
+
+        # shielded, so a cancelled lookup does not cancel the fetch the other lookups are waiting for
+        for service_id, fetch in pending.items():
+            networks = await asyncio.shield(fetch)
+            result[service_id] = networks[service_id]
+
+        return result
+
+    async def __fetch__(self, service_ids):
+        generation = self.cache.generation
+        fetched = await self.__backend__(self.storage.get_services, service_ids)
+
+        return {
+            service_id: self.cache.put(service_id, networks, generation)
+            for service_id, networks in zip(service_ids, fetched)
+        }
+
+    def __fetched__(self, service_ids, fetch):
+        for service_id in service_ids:
+            if self.fetches.get(service_id) is fetch:
+                del self.fetches[service_id]
+
+    async def __all_networks__(self):
+        service_ids = await self.__backend__(self.storage.list_service_ids)
+        return await self.__get_networks_many__(service_ids)
+
+    def __select__(self, service_id, network, value, locality=None):
+        """
+        Picks one endpoint location out of the stored value, according to the selection strategy.
+        The endpoints closest to the locality of the caller (if known) are preferred.
+        """
+        if not value.startswith("["):
+            return value
+
+        try:
+            endpoints = parse_endpoints(value)
+        except EndpointsError as e:
+            raise DiscoveryError(500, "Service '{0}' has bad endpoints: {1}".format(service_id, e.message))
+
+        return self.strategy.select((service_id, network), closest_endpoints(endpoints, locality)).location
+
+    # noinspection PyMethodMayBeStatic
+    def __describe__(self, service_id, value):
+        """
+        Returns all endpoints of the stored value, as dicts.
+        """
+        try:
+            endpoints = parse_endpoints(value)
+        except EndpointsError as e:
+            raise DiscoveryError(500, "Service '{0}' has bad endpoints: {1}".format(service_id, e.message))
+
+        return [endpoint.dump() for endpoint in endpoints]
+
+    def __locations__(self, networks, network):
+        """
+        Splits the services networks into a dict of primary (first) locations in the network given,
+        and a dict of all endpoints for the services that have more than one.
+        """
+        locations = {}
+        endpoints = {}
+
+        for service_id, service_networks in networks.items():
+            value = service_networks.get(network)
+
+            if value is None:
+                locations[service_id] = None
+                continue
+
+            service_endpoints = self.__describe__(service_id, value)
+            locations[service_id] = service_endpoints[0]["location"]
+
+            if len(service_endpoints) > 1:
+                endpoints[service_id] = service_endpoints
+
+        return locations, endpoints
+
+    def get_locality(self, region=None, zone=None, address=None):
+        """
+        Returns the locality of a caller: as given explicitly, or else as told by its address
+        (see --discovery_localities). None if unknown.
+        """
+        if region or zone:
+            return Locality(region or None, zone or None)
+
+        return self.localities.resolve(address)
+
+    def get_cache_stats(self):
+        return self.cache.stats()
+
+    def __collect_metrics__(self):
+        stats = self.cache.stats()
+        admission = self.admission.stats()
+
+        return [
+            ("discovery_cache_hits_total", "counter", "Service lookups served from the cache.",
+             [((), stats["hits"])]),
+            ("discovery_cache_misses_total", "counter", "Service lookups that had to reach the storage.",
+             [((), stats["misses"])]),
+            ("discovery_cache_hit_ratio", "gauge", "Share of the service lookups served from the cache.",
+             [((), stats["hit_ratio"])]),
+            ("discovery_cache_entries", "gauge", "Services currently cached.",
+             [((), stats["entries"])]),
+            ("discovery_cache_missing_entries", "gauge", "Missing services currently remembered as such.",
+             [((), stats["missing"])]),
+            ("discovery_responses_cache_hits_total", "counter", "Multi lookups served with a pre-encoded response.",
+             [((), self.responses.hits)]),
+            ("discovery_responses_cache_misses_total", "counter", "Multi lookups that had to be encoded.",
+             [((), self.responses.misses)]),
+            ("discovery_backend_operations_active", "gauge", "Backend operations in flight.",
+             [((), admission["active"])]),
+            ("discovery_backend_operations_queued", "gauge", "Backend operations waiting to be admitted.",
+             [((), admission["queued"])]),
+            ("discovery_backend_operations_rejected_total", "counter",
+             "Backend operations rejected, not admitted within the queue deadline.",
+             [((), admission["rejected"])]),
+            ("discovery_backend_queue_seconds_total", "counter", "Time backend operations spent in the queue.",
+             [((), admission["queued_time"])]),
+            ("discovery_registry_version", "gauge", "Most recent registry version known to this process.",
+             [((), self.version)])
+        ]
+
+    def get_metrics(self):
+        """
+        Returns the metrics of this process in the Prometheus text format.
+        """
+        return metrics.render()
+
+    def get_known_version(self):
+        """
+        Returns the registry version without touching the database, or None if this replica
+        cannot be sure it is up to date (the invalidation channel is not subscribed).
+        """
+        if self.cache.enabled:
+            return self.version
+        return None
+
+    @measured
+    async def get_snapshot(self, network):
+        """
+        Returns a tuple (version, body) where body is the pre-serialized JSON of all services
+        locations for the network. The body is built once per registry version.
+        If the backend is overloaded, the last snapshot built is returned, however old it is.
+        """
+        version = self.get_known_version()
+
+        if version is not None:
+            snapshot = self.snapshots.get(network)
+            if snapshot is not None and snapshot[0] == version:
+                return snapshot
+
+        try:
+            # the version is read before the data, so the snapshot can only be newer than its version says
+            version = await self.__backend__(self.storage.get_version)
+            # every change up to that is known (and has invalidated the cache) by then
+            complete = self.changes.version
+            service_ids = await self.__backend__(self.storage.list_service_ids)
+            networks = await self.__get_networks_many__(service_ids)
+        except Overloaded:
+            snapshot = self.snapshots.get(network)
+            if snapshot is None:
+                raise
+            return snapshot
+
+        services, endpoints = self.__locations__(networks, network)
+
+        body = ujson.dumps({
+            "version": version,
+            "services": services,
+            "endpoints": endpoints
+        }, escape_forward_slashes=False)
+
+        snapshot = (version, body)
+
+        # otherwise, the cache could have some services from before the version, so it's not kept
+        if version == self.get_known_version() and complete >= version:
+            self.snapshots[network] = snapshot
+
+        return snapshot
+
+    async def watch_services(self, service_ids, network, since, timeout):
+        """
+        Waits until any of the services (all services if the list is empty) changes after the registry
+        version `since`, or the timeout expires. Returns the new version along with the current locations
+        (in the network given) of the changed services only, None for a location that is gone, and all
+        endpoints of the changed services that have more than one.
+        If the changes log does not go back to `since`, every service requested is returned
+        and the result is marked as "reset".
+        """
+
+        if not self.cache.enabled:
+            raise DiscoveryError(503, "Watching is not available at the moment")
+
+        changed = self.changes.changed_since(since, service_ids)
+
+        if changed is not None and not changed:
+            await self.changes.wait(service_ids, timeout)
+
+            if not self.cache.enabled:
+                raise DiscoveryError(503, "Watching is not available at the moment")
+
+            changed = self.changes.changed_since(since, service_ids)
+
+        result = {
+            "version": self.changes.version
+        }
+
+        if changed is None:
+            result["reset"] = True
+
+            if service_ids:
+                changed = service_ids
             else:
-                if len(data_keys) > len(db_keys):
-                    for key in data_keys:
-                        if key not in db_keys:
-                            _data["services"][key] = data["services"][key]
-            return _data
-
-    @validate(data="json_dict")
-    async def setup_services(self, data):
+                changed = await self.__backend__(self.storage.list_service_ids)
+
+        networks = await self.__get_networks_many__(list(changed))
+        result["services"], result["endpoints"] = self.__locations__(networks, network)
+
+        return result
+
+    async def __reconcile__(self, services_init_file):
+        """
+        Adds the services of the init file missing in the registry, in batches. The services already
+        in the registry are left as they are, even if the init file says otherwise.
+        """
+        try:
+            data = await asyncio.get_event_loop().run_in_executor(None, load_init_file, services_init_file)
+
+            while True:
+                try:
+                    result = await self.import_services(
+                        data, overwrite=False, batch_size=options.discovery_init_batch_size, author="init_file")
+                except (DiscoveryError, asyncio.CancelledError):
+                    raise
+                except Exception as e:
+                    # the storage is unavailable or overloaded, it's not the init file to blame
+                    logging.warning("Failed to reconcile the services init file, retrying: {0}".format(str(e)))
+                    await asyncio.sleep(DiscoveryModel.RECONCILE_RETRY_DELAY)
+                else:
+                    break
+        except DiscoveryError as e:
+            logging.error("Failed to reconcile the services init file: {0}".format(e.message))
+            self.reconciliation = DiscoveryModel.RECONCILE_FAILED
+            self.reconciliation_result = {"error": e.message}
+        else:
+            if result["added"]:
+                logging.info("Added {0} services from {1}".format(len(result["added"]), services_init_file))
+
+            self.reconciliation = DiscoveryModel.RECONCILE_DONE
+            self.reconciliation_result = result
+        finally:
+            self.reconciliation_task = None
+
+    def is_ready(self):
+        """
+        Returns a tuple (ready, state): a replica is ready once the init file has been reconciled.
+        """
+        state = {
+            "reconciliation": self.reconciliation
+        }
+
+        if self.reconciliation_result is not None:
+            state["result"] = self.reconciliation_result
+
+        return self.reconciliation == DiscoveryModel.RECONCILE_DONE, state
+
+    async def export_services(self, batch_size=1000):
+        """
+        Yields the whole registry as lists of (service_id, networks) tuples, batch_size services each,
+        in the order of service ids. Only the static locations are exported.
+        """
+        service_ids = sorted(await self.__backend__(self.storage.list_service_ids))
+
+        for offset in range(0, len(service_ids), batch_size):
+            batch = service_ids[offset:offset + batch_size]
+            networks = await self.__backend__(self.storage.get_static_services, batch)
+
+            yield [
+                (service_id, service_networks)
+                for service_id, service_networks in zip(batch, networks)
+                if service_networks
+            ]
+
+    @measured
+    async def import_services(self, data, dry_run=False, delete=False, overwrite=True, batch_size=1000,
+                              author=None):
+        """
+        Compares the services in the data (same format as the init file) with the registry,
+        and writes only the services that are new or have changed, batch_size services at a time.
+        With delete, the services missing in the data are removed from the registry. Without overwrite,
+        the services changed are only reported. With dry_run, nothing is written at all.
+        Returns the difference found.
+        """
         try:
             services = validate_value(data["services"], "json_dict")
-        except (KeyError, ValueError):
-            raise DiscoveryError(400, "Init file has no 'services' section defined.")
+        except (KeyError, ValueError, ValidationError):
+            raise DiscoveryError(400, "Data has no 'services' section defined.")
+
+        imported = {}
 
         for service_id, info in services.items():
             try:
-                networks = validate_value(info, "json_dict_of_strings")
+                imported[service_id] = validate_value(info, "json_dict_of_strings")
             except ValidationError as e:
-                raise DiscoveryError(400, e.message)
-
-            await self.set_service_networks(service_id, networks)
-
-    async def is_empty(self):
-        async with self.kv.acquire() as db:
-            keys = await db.keys("*")
-            return len(keys) == 0
-
-    async def delete_service(self, service_id):
-        async with self.kv.acquire() as db:
-            await db.delete(service_id)
-
-    async def delete_service_network(self, service_id, network):
-        async with self.kv.acquire() as db:
-            await db.hdel(service_id, network)
-
-    async def list_all_services(self, network):
-        async with self.kv.acquire() as db:
-            keys = await db.keys("*")
-            services = {}
-            for key in keys:
-                location = await db.hget(key, network)
-                services[key] = location
+                raise DiscoveryError(400, "Service '{0}': {1}".format(service_id, e.message))
+
+        added = []
+        changed = []
+        unchanged = 0
+
+        existing_ids = set(await self.__backend__(self.storage.list_service_ids))
+        service_ids = list(imported.keys())
+
+        for offset in range(0, len(service_ids), batch_size):
+            batch = service_ids[offset:offset + batch_size]
+            existing = await self.__backend__(self.storage.get_static_services, batch)
+
+            updates = {}
+
+            for service_id, networks in zip(batch, existing):
+                if not networks:
+                    added.append(service_id)
+                    updates[service_id] = imported[service_id]
+                elif networks != imported[service_id]:
+                    changed.append(service_id)
+                    if overwrite:
+                        updates[service_id] = imported[service_id]
+                else:
+                    unchanged += 1
+
+            if updates and not dry_run:
+                # the networks just compared are what gets replaced, so there's no need to read them again
+                await self.set_services_networks(updates, author=author, old={
+                    service_id: networks
+                    for service_id, networks in zip(batch, existing)
+                    if service_id in updates
+                })
+
+        removed = sorted(existing_ids.difference(imported)) if delete else []
+
+        if not dry_run:
+            for offset in range(0, len(removed), batch_size):
+                await self.set_services_networks({
+                    service_id: {}
+                    for service_id in removed[offset:offset + batch_size]
+                }, author=author)
+
+        return {
+            "added": added,
+            "changed": changed,
+            "removed": removed,
+            "unchanged": unchanged,
+            "dry_run": dry_run
+        }
+
+    @measured
+    async def delete_service(self, service_id, author=None):
+        old, = await self.__backend__(self.storage.get_static_services, [service_id])
+        version = await self.__backend__(self.storage.delete_service, service_id)
+        await self.__record__(author, [(service_id, old, {}, version)])
+
+    @measured
+    async def delete_service_network(self, service_id, network, author=None):
+        old, = await self.__backend__(self.storage.get_static_services, [service_id])
+        version = await self.__backend__(self.storage.delete_network, service_id, network)
+
+        new = dict(old)
+        new.pop(network, None)
+        await self.__record__(author, [(service_id, old, new, version)])
+
+    @measured
+    async def list_all_services(self, network, all_endpoints=False, locality=None):
+        services, selected = await self.__list_all_services__(network, all_endpoints, locality)
         return services
 
+    async def __list_all_services__(self, network, all_endpoints, locality=None):
+        keys = await self.__backend__(self.storage.list_service_ids)
+        networks = await self.__get_networks_many__(keys)
+
+        services = {}
+        selected = False
+
+        for service_id, service_networks in networks.items():
+            value = service_networks.get(network)
+
+            if value is None:
+                services[service_id] = None
+            elif all_endpoints:
+                services[service_id] = self.__describe__(service_id, value)
+            else:
+                selected = selected or value.startswith("[")
+                services[service_id] = self.__select__(service_id, network, value, locality)
+
+        return services, selected
+
+    @measured
+    async def get_all_services_response(self, network, all_endpoints=False, locality=None, encoding=JSON):
+        """
+        Same as list_all_services, but returns the result encoded, see get_services_response.
+        """
+        return await self.__response__(
+            (None, network, all_endpoints), encoding,
+            lambda: self.__list_all_services__(network, all_endpoints, locality))
+
     # noinspection PyUnusedLocal
-    async def get_service(self, service_id, network, **ignored):
-        async with self.kv.acquire() as db:
-            service = await db.hget(service_id, network)
-            if not service:
-                raise ServiceNotFound(service_id)
-        return service.decode("utf-8")
+    @measured
+    async def get_service(self, service_id, network, locality=None, **ignored):
+        networks = await self.__get_networks__(service_id)
+        service = networks.get(network)
+        if not service:
+            raise ServiceNotFound(service_id)
+        return self.__select__(service_id, network, service, locality)
+
+    @measured
+    async def get_service_endpoints(self, service_id, network):
+        networks = await self.__get_networks__(service_id)
+        service = networks.get(network)
+        if not service:
+            raise ServiceNotFound(service_id)
+        return self.__describe__(service_id, service)
+
+    async def report_failure(self, service_id, network, location):
+        """
+        Lets the selection strategy know a caller has failed to reach the location.
+        A location the service does not have in the network is ignored.
+        """
+        networks = await self.__get_networks__(service_id)
+        value = networks.get(network)
+
+        if not value:
+            return
 
+        try:
+            endpoints = parse_endpoints(value)
+        except EndpointsError:
+            return
+
+        if any(endpoint.location == location for endpoint in endpoints):
+            self.strategy.failed((service_id, network), location)
+
+    @measured
     async def list_service_networks(self, service_id):
-        async with self.kv.acquire() as db:
-            services = await db.hgetall(service_id)
-            if not services:
+        """
+        Returns the static networks of the service only (as they are edited in the admin tool),
+        without the endpoints registered with heartbeats, so it is not served from the cache.
+        """
+        services, = await self.__backend__(self.storage.get_static_services, [service_id])
+        if not services:
+            raise ServiceNotFound(service_id)
+        return services
+
+    @measured
+    async def list_services(self, service_ids, network, all_endpoints=False, locality=None):
+        service_locations, selected = await self.__list_services__(service_ids, network, all_endpoints, locality)
+        return service_locations
+
+    async def __list_services__(self, service_ids, network, all_endpoints, locality=None):
+        """
+        Returns a tuple of (service_id => location, and whether any of the locations
+        has been picked out of several endpoints).
+        """
+        service_locations = {}
+        selected = False
+        networks = await self.__get_networks_many__(service_ids)
+
+        for service_id in service_ids:
+            service = networks[service_id].get(network)
+
+            if not service:
                 raise ServiceNotFound(service_id)
-            return services or {}
+            elif all_endpoints:
+                service_locations[service_id] = self.__describe__(service_id, service)
+            else:
+                selected = selected or service.startswith("[")
+                service_locations[service_id] = self.__select__(service_id, network, service, locality)
+
+        return service_locations, selected
+
+    @measured
+    async def query_services(self, network, prefix="", pattern=None, tags=None, cursor=None, limit=100,
+                             all_endpoints=False, locality=None):
+        """
+        Looks the services up by a prefix of their ids, a glob pattern (fnmatch style, case sensitive)
+        and/or tags (all of them), walking the sorted index of service ids from the cursor on, so the cost
+        depends on the services walked, not on the size of the registry. The services that do not have
+        the network are skipped.
 
-    async def list_services(self, service_ids, network):
-        async with self.kv.acquire() as db:
-            service_locations = {}
+        Returns a tuple (service_id => location, or all endpoints, and the cursor to pass to get
+        the next page, None once there is nothing more).
+        """
+        if pattern:
+            # the literal part of the pattern narrows the index walked down
+            literal = pattern
 
-            for service_id in service_ids:
-                service = await db.hget(service_id, network)
+            for index, char in enumerate(pattern):
+                if char in "*?[":
+                    literal = pattern[:index]
+                    break
 
-                if service is None or len(service) == 0:
-                    raise ServiceNotFound(service_id)
+            if not literal.startswith(prefix) and not prefix.startswith(literal):
+                return {}, None
+
+            prefix = max(prefix, literal, key=len)
+
+        tags = list(tags or [])
+        tag = tags.pop(0) if tags else None
+
+        services = {}
+        scans = 0
+
+        while len(services) < limit and scans < DiscoveryModel.QUERY_MAX_SCANS:
+            scans += 1
+            count = limit - len(services)
+
+            service_ids = await self.__backend__(self.storage.scan_service_ids, prefix, cursor, count, tag)
+
+            if service_ids:
+                cursor = service_ids[-1]
+
+            matching = service_ids
+
+            if pattern:
+                matching = [service_id for service_id in matching if fnmatchcase(service_id, pattern)]
+
+            if tags and matching:
+                service_tags = await self.__backend__(self.storage.get_tags, matching)
+                matching = [
+                    service_id for service_id, has in zip(matching, service_tags)
+                    if all(t in has for t in tags)
+                ]
+
+            networks = await self.__get_networks_many__(matching)
+
+            for service_id in matching:
+                value = networks[service_id].get(network)
+
+                if value is None:
+                    continue
+                elif all_endpoints:
+                    services[service_id] = self.__describe__(service_id, value)
                 else:
-                    service_locations[service_id] = service
+                    services[service_id] = self.__select__(service_id, network, value, locality)
 
-        return service_locations
+            if len(service_ids) < count:
+                return services, None
+
+        return services, cursor
+
+    @staticmethod
+    def __validate_tags__(tags):
+        if not isinstance(tags, list) or len(tags) > DiscoveryModel.TAGS_MAX:
+            raise DiscoveryError(400, "Tags should be a list of at most {0} strings".format(DiscoveryModel.TAGS_MAX))
+
+        for tag in tags:
+            if not isinstance(tag, str) or not tag or len(tag) > DiscoveryModel.TAG_MAX_LENGTH or "," in tag:
+                raise DiscoveryError(400, "Bad tag: {0}".format(tag))
+
+        return sorted(set(tags))
+
+    @measured
+    async def set_service_tags(self, service_id, tags):
+        tags = DiscoveryModel.__validate_tags__(tags)
+
+        networks, = await self.__backend__(self.storage.get_services, [service_id])
+        if not networks and tags:
+            raise ServiceNotFound(service_id)
+
+        await self.__backend__(self.storage.set_tags, service_id, tags)
+
+    @measured
+    async def get_service_tags(self, service_id):
+        tags, = await self.__backend__(self.storage.get_tags, [service_id])
+        return tags
+
+    @measured
+    async def get_services_response(self, service_ids, network, all_endpoints=False, locality=None, encoding=JSON):
+        """
+        Same as list_services, but returns the result encoded (see Encoding), as a tuple
+        (body, content encoding). The encoded result is cached by the set of services asked (regardless
+        of the order, or duplicates), the network and the encoding, until the registry version changes,
+        so each encoding (and compression) is only paid for once per change. A result with an endpoint
+        picked out of several is not cached, so the selection strategy still applies to every call.
+        """
+        service_ids = frozenset(service_ids)
+
+        return await self.__response__(
+            (service_ids, network, all_endpoints), encoding,
+            lambda: self.__list_services__(list(service_ids), network, all_endpoints, locality))
+
+    async def __response__(self, key, encoding, build):
+        """
+        Returns the cached response, or builds one: build is a coroutine function returning
+        a tuple (result, whether an endpoint has been picked out of several).
+        """
+        key = key + (encoding.name,)
+        version = self.get_known_version()
+        # every change up to that is known (and has invalidated the cache) before the build, see get_snapshot
+        complete = self.changes.version
+
+        if version is not None:
+            response = self.responses.get(key, version)
+            if response is not None:
+                return response
+
+        result, selected = await build()
+        response = encoding.encode(result)
+
+        if not selected and version is not None and version == self.get_known_version() and complete >= version:
+            self.responses.put(key, version, response)
+
+        return response
+
+    @measured
+    async def set_service(self, service_id, service_location, network, author=None):
+        """
+        Returns once the location has been written. The updates arriving at about the same time
+        are written together (see WriteCoalescer), unless --discovery_write_batch_window is 0.
+        """
+        if self.writes is not None:
+            await self.writes.set(service_id, network, service_location, author)
+            return
+
+        old, = await self.__backend__(self.storage.get_static_services, [service_id])
+        version = await self.__backend__(self.storage.set_location, service_id, network, service_location)
+
+        new = dict(old)
+        new[network] = service_location
+        await self.__record__(author, [(service_id, old, new, version)])
+
+        logging.info("Updated service '{0}' location to {1}/{2}".format(
+            service_id, network, str(service_location)))
+
+    @measured
+    async def heartbeat(self, service_id, network, location, weight=1, ttl=None, region=None, zone=None):
+        """
+        Registers the location as an endpoint of the service, or keeps it registered, for the next ttl seconds.
+        The replicas are only notified when a new endpoint shows up.
+        """
+        if weight <= 0:
+            raise DiscoveryError(400, "Endpoint weight should be positive")
+
+        # an endpoint registered already expired would only make every replica refresh twice for nothing
+        if ttl is not None and ttl <= 0:
+            raise DiscoveryError(400, "Endpoint ttl should be positive")
+
+        ttl = min(ttl or options.discovery_heartbeat_ttl, options.discovery_heartbeat_max_ttl)
+        endpoint = Endpoint(location, weight, region or None, zone or None)
+
+        version = await self.__backend__(
+            self.storage.heartbeat, service_id, network, endpoint, time.time() + ttl)
+
+        if version:
+            logging.info("Service '{0}' registered endpoint {1}/{2}".format(service_id, network, location))
+
+    @measured
+    async def set_service_endpoints(self, service_id, network, endpoints, author=None):
+        try:
+            endpoints = load_endpoints(endpoints)
+        except EndpointsError as e:
+            raise DiscoveryError(400, e.message)
+
+        await self.set_service(service_id, dump_endpoints(endpoints), network, author=author)
+
+    @measured
+    async def set_service_networks(self, service_id, networks, author=None):
+        await self.__set_networks__({service_id: networks}, author)
+        logging.info("Updated service '{0}' location to {1}".format(service_id, str(networks)))
+
+    @measured
+    async def set_services_networks(self, services, author=None, old=None):
+        """
+        Same as set_service_networks, for a dict of service_id => networks. Every service is still
+        swapped atomically, and gets its own registry version.
+        The static networks being replaced (for the history) can be passed as old, if already known.
+        """
+        await self.__set_networks__(services, author, old)
+
+        if services:
+            logging.info("Updated locations of {0} services".format(len(services)))
+
+    async def __set_networks__(self, services, author, old=None):
+        old = dict(old or {})
+        unknown = [service_id for service_id in services if service_id not in old]
+
+        if unknown:
+            old.update(zip(unknown, await self.__backend__(self.storage.get_static_services, unknown)))
+
+        versions = await self.__backend__(self.storage.set_networks, services)
+
+        await self.__record__(author, [
+            (service_id, old[service_id], networks, versions.get(service_id))
+            for service_id, networks in services.items()
+        ])
+
+    async def __set_locations__(self, batch):
+        """
+        Commits a batch of the WriteCoalescer: service_id => (network => location, author).
+        """
+        service_ids = list(batch.keys())
+
+        old = await self.__backend__(self.storage.get_static_services, service_ids)
+        versions = await self.__backend__(self.storage.set_locations, {
+            service_id: locations
+            for service_id, (locations, author) in batch.items()
+        })
+
+        changes = {}
+
+        for service_id, old_networks in zip(service_ids, old):
+            locations, author = batch[service_id]
+            new = dict(old_networks)
+            new.update(locations)
+            changes.setdefault(author, []).append((service_id, old_networks, new, versions.get(service_id)))
+
+        for author, author_changes in changes.items():
+            await self.__record__(author, author_changes)
+
+        if len(service_ids) == 1 and len(batch[service_ids[0]][0]) == 1:
+            network, location = next(iter(batch[service_ids[0]][0].items()))
+            logging.info("Updated service '{0}' location to {1}/{2}".format(service_ids[0], network, str(location)))
+        else:
+            logging.info("Updated locations of {0} services".format(len(service_ids)))
+
+    async def __record__(self, author, changes):
+        """
+        Logs the changes made into the history. The change itself is done by then,
+        so a failure to log it is not the caller's problem.
+        """
+        try:
+            await self.history.record(author, changes)
+        except Exception as e:
+            logging.error("Failed to log {0} changes into the history: {1}".format(len(changes), str(e)))
+
+    async def get_history(self, before=None, after=0, limit=100, since=None):
+        """
+        Returns up to `limit` changes, newest first, with versions between after and before. With since
+        (a timestamp), the changes made before it are left out.
+        """
+        if since is not None:
+            after = max(after, await self.history.version_at(since))
+
+        entries = await self.history.list(before=before, after=after, limit=limit)
+        return [entry.describe() for entry in entries]
+
+    async def get_version_at(self, timestamp):
+        return await self.history.version_at(timestamp)
+
+    async def get_registry_at(self, version):
+        """
+        Returns the whole registry (service_id => networks) as it was at the version.
+        """
+        try:
+            return await self.history.state_at(version)
+        except HistoryError as e:
+            raise DiscoveryError(400, e.message)
+
+    @measured
+    async def rollback(self, version, author=None):
+        """
+        Brings every service changed after the version back to what it was at the version,
+        returns the list of those services. The rollback is logged as a change like any other.
+        """
+        try:
+            changed = await self.history.changes_since(version)
+        except HistoryError as e:
+            raise DiscoveryError(400, e.message)
+
+        if not changed:
+            return []
+
+        current = await self.__backend__(self.storage.get_static_services, list(changed.keys()))
+
+        # the services changed back and forth since are not touched
+        services = {
+            service_id: networks
+            for (service_id, networks), existing in zip(changed.items(), current)
+            if networks != existing
+        }
 
-    async def set_service(self, service_id, service_location, network):
-        async with self.kv.acquire() as db:
-            await db.hset(service_id, network, service_location)
-            logging.info("Updated service '{0}' location to {1}/{2}".format(
-                service_id, network, str(service_location)))
+        await self.set_services_networks(services, author=author)
+        logging.info("Rolled back {0} services to version {1}".format(len(services), version))
 
-    async def set_service_networks(self, service_id, networks):
-        async with self.kv.acquire() as db:
-            await db.delete(service_id)
+        return sorted(services.keys())
 
-            for network, service_location in networks.items():
-                await db.hset(service_id, network, service_location)
 
-            logging.info("Updated service '{0}' location to {1}".format(service_id, str(networks)))
+def load_init_file(path):
+    try:
+        with open(path, "r") as f:
+            return ujson.load(f)
+    except (IOError, ValueError) as e:
+        raise DiscoveryError(500, "Failed to load services init file: " + str(e))
 
 
 class ServiceNotFound(Exception):
@@ -0,0 +1,128 @@
+
+import gzip
+import ujson
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class Encoding(object):
+    """
+    A way a response can be encoded: a format (JSON, or msgpack if installed), optionally compressed
+    (gzip, or brotli if installed). Negotiated with the Accept and Accept-Encoding headers, see negotiate.
+    """
+
+    JSON = "json"
+    MSGPACK = "msgpack"
+
+    GZIP = "gzip"
+    BROTLI = "br"
+
+    CONTENT_TYPES = {
+        JSON: "application/json",
+        MSGPACK: "application/msgpack"
+    }
+
+    # responses smaller than that are not worth compressing
+    COMPRESS_MIN_LENGTH = 1024
+
+    __slots__ = ("format", "compression", "name")
+
+    def __init__(self, format, compression=None):
+        self.format = format
+        self.compression = compression
+        self.name = format + ("+" + compression if compression else "")
+
+    @property
+    def content_type(self):
+        return Encoding.CONTENT_TYPES[self.format]
+
+    def encode(self, data):
+        """
+        Returns a tuple (body, content encoding), the latter is None if the body has not been compressed.
+        """
+        if self.format == Encoding.MSGPACK:
+            body = msgpack.packb(data, use_bin_type=True)
+        else:
+            body = ujson.dumps(data, escape_forward_slashes=False).encode("utf-8")
+
+        if self.compression is None or len(body) < Encoding.COMPRESS_MIN_LENGTH:
+            return body, None
+
+        if self.compression == Encoding.BROTLI:
+            return brotli.compress(body, quality=5), self.compression
+
+        return gzip.compress(body, compresslevel=6), self.compression
+
+
+JSON = Encoding(Encoding.JSON)
+
+ENCODINGS = {
+    (encoding.format, encoding.compression): encoding
+    for encoding in (
+        Encoding(format, compression)
+        for format in (Encoding.JSON, Encoding.MSGPACK)
+        for compression in (None, Encoding.GZIP, Encoding.BROTLI)
+    )
+}
+
+
+def accepted(header):
+    """
+    Returns the values of an Accept-like header as a dict of value => quality (1 unless given with q=).
+    The ones with q=0 are kept, as they explicitly refuse the value.
+    """
+    result = {}
+
+    for value in (header or "").split(","):
+        value, *params = [part.strip() for part in value.split(";")]
+        quality = 1.0
+
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+
+        if value:
+            result[value.lower()] = quality
+
+    return result
+
+
+def negotiate(accept, accept_encoding):
+    """
+    Picks the encoding of a response out of the Accept and Accept-Encoding headers of the request,
+    the one of the highest quality among the ones available (msgpack and brotli on a tie).
+    JSON, uncompressed, unless asked otherwise.
+    """
+    types = accepted(accept)
+    encodings = accepted(accept_encoding)
+
+    # msgpack is only picked when asked by name, a wildcard means JSON is just as good
+    msgpack_quality = max(types.get("application/msgpack", 0), types.get("application/x-msgpack", 0))
+    json_quality = types.get("application/json", types.get("application/*", types.get("*/*", 0)))
+
+    if msgpack is not None and msgpack_quality > 0 and msgpack_quality >= json_quality:
+        format = Encoding.MSGPACK
+    else:
+        format = Encoding.JSON
+
+    compression = None
+    best = 0
+
+    for candidate, available in ((Encoding.BROTLI, brotli is not None), (Encoding.GZIP, True)):
+        quality = encodings.get(candidate, encodings.get("*", 0))
+
+        if available and quality > best:
+            compression, best = candidate, quality
+
+    return ENCODINGS[(format, compression)]
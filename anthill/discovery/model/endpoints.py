@@ -0,0 +1,319 @@
+
+from functools import lru_cache
+from bisect import bisect_right
+
+import ujson
+import random
+import time
+
+
+class Endpoint(object):
+    """
+    A single location of a service in some network, along with its weight relative to
+    the other endpoints of the same service, and optionally the region and the zone it is located in.
+    """
+
+    __slots__ = ("location", "weight", "region", "zone")
+
+    def __init__(self, location, weight=1, region=None, zone=None):
+        self.location = location
+        self.weight = weight
+        self.region = region
+        self.zone = zone
+
+    def dump(self):
+        result = {
+            "location": self.location,
+            "weight": self.weight
+        }
+
+        if self.region is not None:
+            result["region"] = self.region
+        if self.zone is not None:
+            result["zone"] = self.zone
+
+        return result
+
+    def tagged(self):
+        return self.region is not None or self.zone is not None
+
+
+class EndpointsError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+@lru_cache(maxsize=4096)
+def parse_endpoints(value):
+    """
+    A service location is stored either as a plain location string (a single endpoint),
+    or as a JSON list of endpoints: [{"location": "http://...", "weight": 2, "region": "eu", "zone": "eu-1a"}, ...],
+    the weight, the region and the zone being optional.
+    Returns a tuple of Endpoint objects. The parsing is done once per distinct value.
+
+    A plain location may start with "[" too (a bare IPv6 address, like "[::1]:9500"), so a value
+    that is not JSON is a plain location.
+    """
+    if not value.startswith("["):
+        return (Endpoint(value),)
+
+    try:
+        endpoints = ujson.loads(value)
+    except ValueError:
+        return (Endpoint(value),)
+
+    return tuple(load_endpoints(endpoints))
+
+
+def load_endpoints(endpoints):
+    if not isinstance(endpoints, list) or not endpoints:
+        raise EndpointsError("Endpoints should be a non-empty list")
+
+    result = []
+
+    for endpoint in endpoints:
+        try:
+            location = str(endpoint["location"])
+            weight = int(endpoint.get("weight", 1))
+            region = endpoint.get("region")
+            zone = endpoint.get("zone")
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise EndpointsError("Each endpoint should have a location and an integer weight")
+
+        if weight <= 0:
+            raise EndpointsError("Endpoint weight should be positive")
+
+        if not isinstance(region, (str, type(None))) or not isinstance(zone, (str, type(None))):
+            raise EndpointsError("Endpoint region and zone should be strings")
+
+        result.append(Endpoint(location, weight, region or None, zone or None))
+
+    return result
+
+
+def dump_endpoints(endpoints):
+    """
+    The opposite of parse_endpoints. A single endpoint of weight 1 with no region or zone is stored
+    as a plain location, so the records stay readable by the older versions of the service
+    (unless the location itself starts with "[", so it's never mistaken for a list).
+    """
+    if len(endpoints) == 1 and endpoints[0].weight == 1 and not endpoints[0].tagged() and \
+            not endpoints[0].location.startswith("["):
+        return endpoints[0].location
+
+    return ujson.dumps([endpoint.dump() for endpoint in endpoints], escape_forward_slashes=False)
+
+
+def merge_endpoints(value, registered):
+    """
+    Adds the endpoints registered with heartbeats to the stored value (which may be None),
+    returns a new value. Endpoints already in the stored value are not duplicated.
+    """
+    if value is None:
+        endpoints = []
+    else:
+        try:
+            endpoints = list(parse_endpoints(value))
+        except EndpointsError:
+            endpoints = []
+
+    locations = set(endpoint.location for endpoint in endpoints)
+
+    for endpoint in sorted(registered, key=lambda e: e.location):
+        if endpoint.location not in locations:
+            endpoints.append(endpoint)
+
+    if not endpoints:
+        return value
+
+    return dump_endpoints(endpoints)
+
+
+def merge_registered(networks, registered):
+    """
+    Merges the endpoints registered with heartbeats (a dict of network => list of Endpoint objects)
+    into the networks of a service, returns new networks.
+    """
+    if not registered:
+        return networks
+
+    merged = dict(networks)
+
+    for network, endpoints in registered.items():
+        merged[network] = merge_endpoints(merged.get(network), endpoints)
+
+    return merged
+
+
+def dump_registered(endpoint):
+    """
+    Encodes an endpoint registered with a heartbeat (the location is stored apart): just the weight,
+    or a JSON list of [weight, region, zone] if the endpoint has either.
+    """
+    if not endpoint.tagged():
+        return str(endpoint.weight)
+
+    return ujson.dumps([endpoint.weight, endpoint.region, endpoint.zone])
+
+
+def load_registered(location, value):
+    """
+    The opposite of dump_registered, raises ValueError if the value is corrupted.
+    """
+    if isinstance(value, str) and value.startswith("["):
+        weight, region, zone = ujson.loads(value)
+        return Endpoint(location, int(weight), region, zone)
+
+    return Endpoint(location, int(value))
+
+
+def closest_endpoints(endpoints, locality):
+    """
+    Narrows the endpoints down to those in the same zone as the locality given, or, if none,
+    to those in the same region, or leaves them all.
+    """
+    if locality is None:
+        return endpoints
+
+    if locality.zone is not None:
+        same_zone = [endpoint for endpoint in endpoints if endpoint.zone == locality.zone]
+        if same_zone:
+            return same_zone
+
+    if locality.region is not None:
+        same_region = [endpoint for endpoint in endpoints if endpoint.region == locality.region]
+        if same_region:
+            return same_region
+
+    return endpoints
+
+
+class SelectionStrategy(object):
+    """
+    Picks one endpoint out of several endpoints of a service. The key is a (service_id, network) tuple.
+    """
+
+    def select(self, key, endpoints):
+        raise NotImplementedError()
+
+    def failed(self, key, location):
+        pass
+
+    def changed(self, service_id):
+        """
+        Called once the service has changed (or is gone), whatever is kept about it could be dropped.
+        """
+        pass
+
+
+def cumulative_weights(endpoints):
+    weights = []
+    total = 0
+
+    for endpoint in endpoints:
+        total += endpoint.weight
+        weights.append(total)
+
+    return weights
+
+
+class RoundRobinStrategy(SelectionStrategy):
+    def __init__(self):
+        # service_id => {network: counter}
+        self.counters = {}
+
+    def select(self, key, endpoints):
+        if len(endpoints) == 1:
+            return endpoints[0]
+
+        service_id, network = key
+        counters = self.counters.setdefault(service_id, {})
+        counter = counters.get(network, 0)
+        counters[network] = counter + 1
+
+        weights = cumulative_weights(endpoints)
+        return endpoints[bisect_right(weights, counter % weights[-1])]
+
+    def changed(self, service_id):
+        # the endpoints may be different now anyway, so it's fine to start over
+        self.counters.pop(service_id, None)
+
+
+class WeightedRandomStrategy(SelectionStrategy):
+    def select(self, key, endpoints):
+        if len(endpoints) == 1:
+            return endpoints[0]
+
+        weights = cumulative_weights(endpoints)
+        return endpoints[bisect_right(weights, random.random() * weights[-1])]
+
+
+class LeastRecentlyFailedStrategy(WeightedRandomStrategy):
+    """
+    Prefers the endpoints that have not failed recently (weighted random among them), otherwise picks
+    the one that failed the longest time ago. Failures are reported by the callers, see failed().
+    """
+
+    # an endpoint that failed that long ago (in seconds) is considered healthy again
+    FAILURE_TIMEOUT = 30
+
+    def __init__(self):
+        self.failures = {}
+        # the failures that are too old to matter are dropped once in FAILURE_TIMEOUT
+        self.next_prune = 0
+
+    def select(self, key, endpoints):
+        if len(endpoints) == 1:
+            return endpoints[0]
+
+        failures = self.failures.get(key)
+
+        if not failures:
+            return super(LeastRecentlyFailedStrategy, self).select(key, endpoints)
+
+        recently = time.time() - LeastRecentlyFailedStrategy.FAILURE_TIMEOUT
+
+        healthy = [
+            endpoint for endpoint in endpoints
+            if failures.get(endpoint.location, 0) < recently
+        ]
+
+        if healthy:
+            return super(LeastRecentlyFailedStrategy, self).select(key, healthy)
+
+        return min(endpoints, key=lambda endpoint: failures.get(endpoint.location, 0))
+
+    def failed(self, key, location):
+        now = time.time()
+
+        if now >= self.next_prune:
+            self.__prune__(now)
+
+        self.failures.setdefault(key, {})[location] = now
+
+    def __prune__(self, now):
+        recently = now - LeastRecentlyFailedStrategy.FAILURE_TIMEOUT
+
+        for key in list(self.failures.keys()):
+            failures = {
+                location: failed
+                for location, failed in self.failures[key].items()
+                if failed >= recently
+            }
+
+            if failures:
+                self.failures[key] = failures
+            else:
+                del self.failures[key]
+
+        self.next_prune = now + LeastRecentlyFailedStrategy.FAILURE_TIMEOUT
+
+
+STRATEGIES = {
+    "round_robin": RoundRobinStrategy,
+    "weighted_random": WeightedRandomStrategy,
+    "least_recently_failed": LeastRecentlyFailedStrategy
+}
@@ -0,0 +1,207 @@
+
+import asyncio
+import logging
+import time
+
+
+class HistoryError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class HistoryEntry(object):
+    """
+    A single change of a service: the whole static network maps before and after it
+    (an empty dict for a service that did not exist, or has been deleted), along with who made it and when.
+    """
+
+    __slots__ = ("version", "time", "author", "service_id", "old", "new")
+
+    def __init__(self, version, time, author, service_id, old, new):
+        self.version = version
+        self.time = time
+        self.author = author
+        self.service_id = service_id
+        self.old = old
+        self.new = new
+
+    def dump(self):
+        return [self.version, self.time, self.author, self.service_id, self.old, self.new]
+
+    @staticmethod
+    def load(data):
+        version, time, author, service_id, old, new = data
+        return HistoryEntry(version, time, author, service_id, old, new)
+
+    def describe(self):
+        return {
+            "version": self.version,
+            "time": self.time,
+            "author": self.author,
+            "service": self.service_id,
+            "old": self.old,
+            "new": self.new
+        }
+
+
+class ChangeHistory(object):
+    """
+    An append-only log of the changes made to the static locations of the services (the endpoints
+    registered with heartbeats come and go on their own, and are not logged), keyed by the registry version.
+
+    Once this replica has logged `snapshot_every` changes, the whole registry is saved as a snapshot
+    at its current version. The registry is not read at once, so a snapshot may also have some of the changes
+    made while it was read: it is only used for the versions after those, and the changes logged after
+    its version are replayed on top of it. Only the last `keep_snapshots` snapshots are kept, along with the changes
+    after the oldest of those, so the log does not grow forever: any version from the oldest snapshot on
+    can be looked at, or rolled back to.
+    """
+
+    # how many entries are read at a time while walking the log
+    PAGE = 1000
+
+    def __init__(self, storage, snapshot_every, keep_snapshots):
+        self.storage = storage
+        self.snapshot_every = snapshot_every
+        self.keep_snapshots = keep_snapshots
+
+        self.logged = 0
+        self.compaction = None
+
+    def stop(self):
+        if self.compaction is not None:
+            self.compaction.cancel()
+            self.compaction = None
+
+    async def record(self, author, changes):
+        """
+        Logs a list of (service_id, old networks, new networks, version) changes.
+        """
+        now = time.time()
+
+        entries = [
+            HistoryEntry(version, now, author, service_id, old, new)
+            for service_id, old, new, version in changes
+            if version and old != new
+        ]
+
+        if not entries:
+            return
+
+        await self.storage.append_history(entries)
+
+        self.logged += len(entries)
+
+        if self.snapshot_every > 0 and self.logged >= self.snapshot_every and self.compaction is None:
+            self.logged = 0
+            self.compaction = asyncio.ensure_future(self.__compact__())
+
+    async def __compact__(self):
+        try:
+            version, services = await self.storage.get_registry()
+            complete = await self.storage.get_version()
+            await self.storage.put_history_snapshot(version, services, complete)
+
+            snapshots = await self.storage.list_history_snapshots()
+
+            if len(snapshots) > self.keep_snapshots:
+                await self.storage.trim_history(snapshots[-self.keep_snapshots])
+
+            logging.info("Saved registry snapshot of {0} services at version {1}".format(len(services), version))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error("Failed to save registry snapshot: {0}".format(str(e)))
+        finally:
+            self.compaction = None
+
+    async def list(self, before=None, after=0, limit=100):
+        """
+        Returns up to `limit` entries with versions between after and before (exclusive), newest first.
+        To page through, pass the version of the last entry returned as `before`.
+        """
+        return await self.storage.get_history(before=before, after=after, limit=limit)
+
+    async def version_at(self, timestamp):
+        """
+        Returns the registry version as of the timestamp, that is, the version of the last change logged
+        at or before it.
+        """
+        return await self.storage.find_history_version(timestamp)
+
+    async def __check__(self, version):
+        start = await self.storage.get_history_start()
+
+        if version < start:
+            raise HistoryError("Version {0} is too old, the history starts at version {1}".format(version, start))
+
+    async def changes_since(self, version):
+        """
+        Returns a dict of service_id => networks as of the version, for every service changed after it.
+        """
+        await self.__check__(version)
+
+        changed = {}
+        before = None
+
+        while True:
+            entries = await self.storage.get_history(before=before, after=version, limit=ChangeHistory.PAGE)
+
+            # walking backwards, so the oldest change after the version is the last one to set the service
+            for entry in entries:
+                changed[entry.service_id] = entry.old
+
+            if len(entries) < ChangeHistory.PAGE:
+                return changed
+
+            before = entries[-1].version
+
+    async def state_at(self, version):
+        """
+        Returns the whole registry (service_id => networks) as of the version: the closest snapshot complete
+        at or before it with the later changes replayed, or else the current registry with the changes
+        made after the version reverted.
+        """
+        await self.__check__(version)
+
+        if version > await self.storage.get_version():
+            raise HistoryError("Version {0} is not there yet".format(version))
+
+        snapshot = None
+
+        for snapshot_version in reversed(await self.storage.list_history_snapshots()):
+            if snapshot_version > version:
+                continue
+
+            loaded = await self.storage.get_history_snapshot(snapshot_version)
+
+            if loaded is not None and loaded[1] <= version:
+                snapshot = snapshot_version, loaded[0]
+                break
+
+        if snapshot is None:
+            services = (await self.storage.get_registry())[1]
+            services.update(await self.changes_since(version))
+        else:
+            after, services = snapshot
+
+            while True:
+                entries = await self.storage.get_history(
+                    before=version + 1, after=after, limit=ChangeHistory.PAGE, oldest_first=True)
+
+                for entry in entries:
+                    services[entry.service_id] = entry.new
+
+                if len(entries) < ChangeHistory.PAGE:
+                    break
+
+                after = entries[-1].version
+
+        return {
+            service_id: networks
+            for service_id, networks in services.items()
+            if networks
+        }
@@ -0,0 +1,69 @@
+
+import ipaddress
+
+
+class Locality(object):
+    """
+    Where a caller is located: a region, and a zone within that region (either may be unknown).
+    """
+
+    __slots__ = ("region", "zone")
+
+    def __init__(self, region=None, zone=None):
+        self.region = region
+        self.zone = zone
+
+    def __repr__(self):
+        return "{0}/{1}".format(self.region, self.zone)
+
+
+class LocalityError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class LocalityMap(object):
+    """
+    Tells the locality of a caller by its address. Described as a comma-separated list of
+    <subnet>=<region>:<zone>, for example:
+
+        10.0.1.0/24=eu-west:eu-west-1a,10.0.2.0/24=eu-west:eu-west-1b,10.1.0.0/16=us-east:
+
+    The most specific subnet an address belongs to wins.
+    """
+
+    def __init__(self, description):
+        self.subnets = []
+
+        for entry in filter(bool, (entry.strip() for entry in description.split(","))):
+            try:
+                subnet, locality = entry.split("=", 1)
+                region, zone = (locality.split(":", 1) + [""])[:2]
+                subnet = ipaddress.ip_network(subnet.strip(), strict=False)
+            except ValueError:
+                raise LocalityError("Bad locality entry: '{0}'".format(entry))
+
+            self.subnets.append((subnet, Locality(region.strip() or None, zone.strip() or None)))
+
+        self.subnets.sort(key=lambda item: item[0].prefixlen, reverse=True)
+
+    def resolve(self, address):
+        """
+        Returns the locality of the address, or None if it's not in any of the subnets.
+        """
+        if not self.subnets or not address:
+            return None
+
+        try:
+            address = ipaddress.ip_address(address)
+        except ValueError:
+            return None
+
+        for subnet, locality in self.subnets:
+            if address.version == subnet.version and address in subnet:
+                return locality
+
+        return None
@@ -0,0 +1,171 @@
+
+from bisect import bisect_left
+from functools import wraps
+
+import time
+
+
+# latency buckets in seconds, from 50 microseconds to 5 seconds
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram(object):
+    """
+    A fixed-bucket histogram. Observing a value costs a single bisect; the counts are only
+    made cumulative (as Prometheus expects them) when rendered.
+    """
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # the last one is for the values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def format_labels(labels, extra=None):
+    if extra is not None:
+        labels = labels + (extra,)
+
+    if not labels:
+        return ""
+
+    return "{" + ",".join(
+        '{0}="{1}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels) + "}"
+
+
+class Metrics(object):
+    """
+    In-process metrics, rendered in the Prometheus text format. The labels are passed as a tuple
+    of (name, value) pairs, so the callers on the hot paths can build them once and reuse.
+
+    Apart from the histograms and the counters recorded as things happen, collectors can be added:
+    callables invoked upon rendering only, returning a list of (name, type, help, [(labels, value)]).
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.help = {}
+        self.collectors = []
+
+    def describe(self, name, help):
+        self.help[name] = help
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+
+        histogram.observe(value)
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def __header__(self, lines, name, kind, help=None):
+        help = help or self.help.get(name)
+        if help:
+            lines.append("# HELP {0} {1}".format(name, help))
+        lines.append("# TYPE {0} {1}".format(name, kind))
+
+    def render(self):
+        lines = []
+
+        for name, entries in group(self.counters.items()):
+            self.__header__(lines, name, "counter")
+
+            for labels, value in entries:
+                lines.append("{0}{1} {2}".format(name, format_labels(labels), value))
+
+        for name, entries in group(self.histograms.items()):
+            self.__header__(lines, name, "histogram")
+
+            for labels, histogram in entries:
+                cumulative = 0
+
+                for bucket, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append("{0}_bucket{1} {2}".format(
+                        name, format_labels(labels, ("le", bucket)), cumulative))
+
+                lines.append("{0}_bucket{1} {2}".format(
+                    name, format_labels(labels, ("le", "+Inf")), histogram.count))
+                lines.append("{0}_sum{1} {2}".format(name, format_labels(labels), histogram.sum))
+                lines.append("{0}_count{1} {2}".format(name, format_labels(labels), histogram.count))
+
+        for collector in self.collectors:
+            for name, kind, help, samples in collector():
+                self.__header__(lines, name, kind, help)
+
+                for labels, value in samples:
+                    lines.append("{0}{1} {2}".format(name, format_labels(labels), value))
+
+        lines.append("")
+        return "\n".join(lines)
+
+
+def group(items):
+    """
+    Groups ((name, labels), value) items by name, sorted, so each metric gets a single header.
+    """
+    groups = {}
+
+    for (name, labels), value in items:
+        groups.setdefault(name, []).append((labels, value))
+
+    return sorted((name, sorted(entries, key=lambda entry: entry[0])) for name, entries in groups.items())
+
+
+# the metrics of this process
+metrics = Metrics()
+
+MODEL_DURATION = "discovery_model_duration_seconds"
+REQUEST_DURATION = "discovery_request_duration_seconds"
+REQUESTS = "discovery_requests_total"
+ENCODE_DURATION = "discovery_json_encode_duration_seconds"
+REDIS_DURATION = "discovery_redis_duration_seconds"
+REDIS_COMMANDS = "discovery_redis_commands_total"
+POOL_WAIT = "discovery_redis_pool_wait_seconds"
+COALESCED_LOOKUPS = "discovery_coalesced_lookups_total"
+
+metrics.describe(MODEL_DURATION, "Time spent in the DiscoveryModel operations.")
+metrics.describe(REQUEST_DURATION, "Time spent serving the requests, by handler.")
+metrics.describe(REQUESTS, "Requests served, by handler and status code.")
+metrics.describe(ENCODE_DURATION, "Time spent encoding the JSON responses, by handler.")
+metrics.describe(REDIS_DURATION, "Time spent talking to Redis (connection acquired), by storage operation.")
+metrics.describe(REDIS_COMMANDS, "Redis commands sent, by storage operation.")
+metrics.describe(POOL_WAIT, "Time spent waiting for a Redis connection from the pool.")
+metrics.describe(COALESCED_LOOKUPS, "Service lookups served by a fetch already in progress for another lookup.")
+
+
+def measured(method):
+    """
+    Records the duration of an async model method into the MODEL_DURATION histogram.
+    """
+    labels = (("operation", method.__name__),)
+
+    @wraps(method)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            metrics.observe(MODEL_DURATION, labels, time.perf_counter() - started)
+
+    return wrapper
@@ -0,0 +1,296 @@
+
+from bisect import bisect_left, bisect_right
+
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import time
+import ujson
+
+
+class SnapshotError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class SnapshotFile(object):
+    """
+    A read-only, memory-mapped copy of the whole registry, shared by the worker processes.
+
+    Layout (little endian):
+
+        header   magic "ADSN", format, flags, epoch, registry version, number of entries
+        index    one entry per service, sorted by service id:
+                 id offset, id length, value offset, value length, version of the last change
+        data     the service ids, and the values: networks JSON (endpoints registered with heartbeats
+                 merged in), empty for a service deleted recently (so the readers learn about the deletion)
+
+    The file is never modified in place: a new one is written aside and renamed over, so a reader
+    keeps its mapping of the old file intact until it maps the new one. The epoch changes whenever
+    the writer starts over, meaning the versions of the services cannot be compared with the previous file.
+    """
+
+    MAGIC = b"ADSN"
+    FORMAT = 1
+
+    # the writer could track the changes when the snapshot was written, so it's up to date
+    FLAG_CONNECTED = 1
+
+    HEADER = struct.Struct("<4sHHQQI")
+    ENTRY = struct.Struct("<IIIIQ")
+
+    def __init__(self, f):
+        self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, fmt, flags, self.epoch, self.version, self.count = SnapshotFile.HEADER.unpack_from(self.map, 0)
+        except struct.error:
+            self.map.close()
+            raise SnapshotError("Snapshot is truncated")
+
+        if magic != SnapshotFile.MAGIC or fmt != SnapshotFile.FORMAT:
+            self.map.close()
+            raise SnapshotError("Not a snapshot, or an unsupported format")
+
+        self.connected = bool(flags & SnapshotFile.FLAG_CONNECTED)
+        self.keys = SnapshotKeys(self)
+
+    @staticmethod
+    def open(path):
+        with open(path, "rb") as f:
+            return SnapshotFile(f)
+
+    def close(self):
+        self.map.close()
+
+    def entry(self, index):
+        return SnapshotFile.ENTRY.unpack_from(self.map, SnapshotFile.HEADER.size + index * SnapshotFile.ENTRY.size)
+
+    def key(self, index):
+        key_offset, key_length, value_offset, value_length, version = self.entry(index)
+        return self.map[key_offset:key_offset + key_length]
+
+    def find(self, service_id):
+        """
+        Returns a tuple (value, version) of the service, value is None if there's no such service.
+        """
+        key = service_id.encode("utf-8")
+        index = bisect_left(self.keys, key)
+
+        if index >= self.count:
+            return None, 0
+
+        key_offset, key_length, value_offset, value_length, version = self.entry(index)
+
+        if self.map[key_offset:key_offset + key_length] != key or not value_length:
+            return None, 0
+
+        return self.map[value_offset:value_offset + value_length], version
+
+    def items(self):
+        """
+        Yields (service_id, value, version) for each entry, in the order of service ids.
+        The value is None for a deleted service.
+        """
+        m = self.map
+
+        for index in range(0, self.count):
+            key_offset, key_length, value_offset, value_length, version = self.entry(index)
+
+            yield (m[key_offset:key_offset + key_length].decode("utf-8"),
+                   m[value_offset:value_offset + value_length] if value_length else None,
+                   version)
+
+    def service_ids(self):
+        return [service_id for service_id, value, version in self.items() if value is not None]
+
+    def scan(self, prefix="", after=None, limit=100):
+        """
+        Returns up to `limit` ids of the services (deleted ones skipped) starting with the prefix,
+        in order, after the `after` one, if given. Only the entries returned are read.
+        """
+        prefix = prefix.encode("utf-8")
+
+        if after is not None and after.encode("utf-8") >= prefix:
+            index = bisect_right(self.keys, after.encode("utf-8"))
+        else:
+            index = bisect_left(self.keys, prefix)
+
+        result = []
+
+        while index < self.count and len(result) < limit:
+            key_offset, key_length, value_offset, value_length, version = self.entry(index)
+            key = self.map[key_offset:key_offset + key_length]
+
+            if not key.startswith(prefix):
+                break
+
+            if value_length:
+                result.append(key.decode("utf-8"))
+
+            index += 1
+
+        return result
+
+
+class SnapshotKeys(object):
+    """
+    A sequence view of the service ids of the snapshot, so it can be bisected without reading it all.
+    """
+
+    __slots__ = ("snapshot",)
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return self.snapshot.count
+
+    def __getitem__(self, index):
+        return self.snapshot.key(index)
+
+
+def write_snapshot(path, epoch, version, connected, entries):
+    """
+    Writes a snapshot file out of (service_id, value, version) entries, value is a string of
+    the networks JSON, or None for a deleted service. Replaces the file atomically.
+    """
+    entries = sorted(
+        ((service_id.encode("utf-8"), value.encode("utf-8") if value is not None else b"", service_version)
+         for service_id, value, service_version in entries),
+        key=lambda entry: entry[0])
+
+    index_size = SnapshotFile.HEADER.size + len(entries) * SnapshotFile.ENTRY.size
+
+    data = []
+    offset = index_size
+
+    index = bytearray(index_size)
+
+    SnapshotFile.HEADER.pack_into(
+        index, 0, SnapshotFile.MAGIC, SnapshotFile.FORMAT,
+        SnapshotFile.FLAG_CONNECTED if connected else 0, epoch, version, len(entries))
+
+    for i, (key, value, service_version) in enumerate(entries):
+        SnapshotFile.ENTRY.pack_into(
+            index, SnapshotFile.HEADER.size + i * SnapshotFile.ENTRY.size,
+            offset, len(key), offset + len(key), len(value), service_version)
+
+        data.append(key)
+        data.append(value)
+        offset += len(key) + len(value)
+
+    temp = "{0}.{1}.tmp".format(path, os.getpid())
+
+    try:
+        with open(temp, "wb") as f:
+            f.write(index)
+            f.write(b"".join(data))
+
+        os.replace(temp, path)
+    except IOError as e:
+        raise SnapshotError("Failed to write snapshot: {0}".format(str(e)))
+
+
+class SnapshotPublisher(object):
+    """
+    Keeps the snapshot file up to date on the leader process: the registry is written out as soon as
+    it changes, but no more often than once per `interval`.
+
+    `fetch` is an async callable returning a dict of service_id => networks of every service.
+    The publisher tracks the version of the last change of each service, and keeps the services deleted
+    within the last `history` versions as empty entries, so the readers can tell what has changed.
+
+    The snapshot is given the version of the changes log: every change up to it is known, so the readers
+    can take the versions not mentioned in the snapshot as superseded. The services may have changed
+    with later versions already.
+    """
+
+    def __init__(self, path, interval, history, changes, fetch):
+        self.path = path
+        self.interval = interval
+        self.history = history
+        self.changes = changes
+        self.fetch = fetch
+
+        self.epoch = 0
+        self.connected = False
+        # service_id => version of its last change
+        self.versions = {}
+
+        self.dirty = False
+        self.task = None
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def storage_connected(self, version):
+        # the changes missed could be anything, so the readers have to start over
+        self.epoch = int(time.time() * 1000000)
+        self.versions.clear()
+        self.connected = True
+        self.__schedule__()
+
+    def storage_changed(self, service_id, version):
+        self.versions[service_id] = version
+        self.__schedule__()
+
+    def storage_disconnected(self):
+        self.connected = False
+        self.__schedule__()
+
+    def __schedule__(self):
+        self.dirty = True
+
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.__run__())
+
+    async def __run__(self):
+        try:
+            while self.dirty:
+                self.dirty = False
+
+                try:
+                    await self.__publish__()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logging.error("Failed to publish the services snapshot: {0}".format(str(e)))
+                    self.dirty = True
+
+                await asyncio.sleep(self.interval)
+        finally:
+            self.task = None
+
+    async def __publish__(self):
+        # taken before the services are fetched, so the services can only be newer than their versions say
+        epoch, version, connected = self.epoch, self.changes.version, self.connected
+        versions = dict(self.versions)
+
+        services = await self.fetch() if connected else {}
+
+        entries = [
+            (service_id, ujson.dumps(dict(networks), escape_forward_slashes=False), versions.get(service_id, 0))
+            for service_id, networks in services.items()
+            if networks
+        ]
+
+        oldest = version - self.history
+
+        for service_id, service_version in versions.items():
+            if services.get(service_id):
+                continue
+
+            if service_version > oldest:
+                entries.append((service_id, None, service_version))
+            elif self.versions.get(service_id) == service_version:
+                del self.versions[service_id]
+
+        write_snapshot(self.path, epoch, version, connected, entries)
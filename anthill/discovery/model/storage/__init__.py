@@ -0,0 +1,211 @@
+
+class StorageError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class StorageListener(object):
+    """
+    Gets notified about the changes of the storage, including the changes made by the other replicas.
+    """
+
+    def storage_connected(self, version):
+        """
+        Called once the changes can be tracked, with the current registry version.
+        """
+        raise NotImplementedError()
+
+    def storage_changed(self, service_id, version):
+        """
+        Called after the service has been changed, and the registry got the new version.
+        The service_id is None if whatever the version has changed is reported with a later version.
+        """
+        raise NotImplementedError()
+
+    def storage_disconnected(self):
+        """
+        Called when the changes cannot be tracked anymore, so nothing known about the registry can be trusted.
+        """
+        raise NotImplementedError()
+
+
+class ServicesStorage(object):
+    """
+    Where the service locations are actually stored. Each service is a dict of network => location.
+    Apart from those (static) locations, a service may have endpoints registered with heartbeats,
+    which expire unless refreshed in time.
+
+    Every mutation increments the registry version, and has to be reported to the listener
+    with the new version, on this replica and on every other replica sharing the storage.
+    """
+
+    # whether the services fetched may be kept in the memory of the process
+    cacheable = True
+
+    def __init__(self, listener):
+        self.listener = listener
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def get_version(self):
+        raise NotImplementedError()
+
+    async def list_service_ids(self):
+        raise NotImplementedError()
+
+    async def count_services(self):
+        raise NotImplementedError()
+
+    async def get_services(self, service_ids):
+        """
+        Returns a list of dicts (network => location) for the services, in the same order,
+        with the endpoints registered with heartbeats merged in. A missing service is an empty dict.
+        """
+        raise NotImplementedError()
+
+    async def get_static_services(self, service_ids):
+        """
+        Same as get_services, but without the endpoints registered with heartbeats.
+        """
+        raise NotImplementedError()
+
+    async def set_location(self, service_id, network, location):
+        """
+        The mutations return the new registry version.
+        """
+        raise NotImplementedError()
+
+    async def set_networks(self, services):
+        """
+        Replaces the whole network maps of the services (a dict of service_id => networks, an empty
+        networks dict removes the service). Each service is swapped atomically.
+        Returns a dict of service_id => the registry version it has got.
+        """
+        raise NotImplementedError()
+
+    async def set_locations(self, services):
+        """
+        Sets some of the networks of the services (a dict of service_id => dict of network => location),
+        leaving the other networks as they are, all at once. Each service gets a single registry version
+        (and a single notification), whatever number of networks it has had set.
+        Returns a dict of service_id => the registry version it has got.
+        """
+        raise NotImplementedError()
+
+    async def delete_service(self, service_id):
+        raise NotImplementedError()
+
+    async def delete_network(self, service_id, network):
+        raise NotImplementedError()
+
+    async def heartbeat(self, service_id, network, endpoint, expires):
+        """
+        Registers an endpoint of the service (or keeps it registered) until the expires timestamp.
+        The endpoint is an Endpoint, along with its weight and locality.
+        """
+        raise NotImplementedError()
+
+    async def scan_service_ids(self, prefix="", after=None, limit=100, tag=None):
+        """
+        Returns up to `limit` ids of the services starting with the prefix, in the order of their UTF-8 bytes,
+        beginning right after the `after` one (if given), so the last one returned continues the scan.
+        With a tag, only the services tagged with it are scanned.
+        """
+        raise NotImplementedError()
+
+    async def set_tags(self, service_id, tags):
+        """
+        Replaces the tags of the service (a list of strings, empty removes them). Tags are not a part
+        of the registry, so neither the version changes nor the history is logged.
+        A service that is gone (with no networks nor endpoints left, however it's happened) loses its tags.
+        """
+        raise NotImplementedError()
+
+    async def get_tags(self, service_ids):
+        """
+        Returns a list of the lists of tags of the services, in the same order.
+        """
+        raise NotImplementedError()
+
+    async def get_registry(self):
+        """
+        Returns a tuple (version, dict of service_id => static networks) of the whole registry.
+        The registry is not necessarily read at once: every change up to the version is in it,
+        but some of the later ones (up to get_version called after it) may be as well.
+        """
+        raise NotImplementedError()
+
+    # the change history (see ChangeHistory), shared by every replica as well
+
+    async def append_history(self, entries):
+        """
+        Appends a list of HistoryEntry to the history.
+        """
+        raise NotImplementedError()
+
+    async def get_history(self, before=None, after=0, limit=100, oldest_first=False):
+        """
+        Returns up to `limit` entries with versions between after and before (exclusive, None means no limit),
+        newest first unless oldest_first.
+        """
+        raise NotImplementedError()
+
+    async def find_history_version(self, timestamp):
+        """
+        Returns the version of the last entry made at or before the timestamp, 0 if none.
+        """
+        raise NotImplementedError()
+
+    async def get_history_start(self):
+        """
+        Returns the version the history has been trimmed to, 0 if never.
+        """
+        raise NotImplementedError()
+
+    async def put_history_snapshot(self, version, services, complete):
+        """
+        Saves the registry read by get_registry at the version. The later changes it may have are
+        all at or before `complete`.
+        """
+        raise NotImplementedError()
+
+    async def get_history_snapshot(self, version):
+        """
+        Returns a tuple (dict of service_id => networks, complete) saved at the version, or None.
+        """
+        raise NotImplementedError()
+
+    async def list_history_snapshots(self):
+        """
+        Returns the sorted list of the versions the snapshots have been saved at.
+        """
+        raise NotImplementedError()
+
+    async def trim_history(self, version):
+        """
+        Removes the entries and the snapshots older than the version.
+        """
+        raise NotImplementedError()
+
+
+def create_storage(kind, listener):
+    if kind == "redis":
+        from . redis import RedisServicesStorage
+        return RedisServicesStorage(listener)
+
+    if kind == "memory":
+        from . memory import MemoryServicesStorage
+        return MemoryServicesStorage(listener)
+
+    if kind == "snapshot":
+        from . snapshot import SnapshotServicesStorage
+        return SnapshotServicesStorage(listener)
+
+    raise StorageError("Unknown storage: {0}".format(kind))
@@ -0,0 +1,390 @@
+
+from anthill.common.options import options
+
+from . import ServicesStorage, StorageError
+from .. endpoints import merge_registered, dump_registered
+
+from bisect import bisect_left, bisect_right
+
+import asyncio
+import heapq
+import ujson
+import logging
+import time
+import os
+
+
+class MemoryServicesStorage(ServicesStorage):
+    """
+    Keeps the registry in the memory of this very process, so it needs no Redis at all.
+    Meant for small deployments (a single replica) and tests.
+
+    Every mutation is appended to a local file (if configured) as a JSON line, the file is replayed
+    and compacted on start. The endpoints registered with heartbeats are not persisted, as they would
+    have expired by the time the process is up again anyway. Neither is the change history.
+    """
+
+    def __init__(self, listener):
+        super(MemoryServicesStorage, self).__init__(listener)
+
+        self.services = {}
+        # service_id => {(network, location): Endpoint}
+        self.registered = {}
+        # (service_id, network, location) => expiration time, plus a heap of the same to expire them in order
+        self.expirations = {}
+        self.expiration_queue = []
+        self.version = 0
+
+        # every service id (static or registered) in order, for the scans
+        self.sorted_ids = []
+        # service_id => list of its tags, and tag => sorted list of the service ids tagged with it
+        self.tags = {}
+        self.tagged = {}
+
+        # the change history in the order of versions, along with the versions and times of the entries
+        # for the lookups, and the snapshots as version => services
+        self.history = []
+        self.history_versions = []
+        self.history_times = []
+        self.history_snapshots = {}
+        self.history_start = 0
+
+        self.path = options.discover_services_file
+        self.log = None
+        self.expiration = None
+
+    async def start(self):
+        if self.path:
+            self.__load__()
+
+            # the services only registered with heartbeats are gone by now, so are their tags
+            for service_id in [service_id for service_id in self.tags if service_id not in self.services]:
+                self.__tag__(service_id, [])
+
+            self.__compact__()
+            self.log = open(self.path, "a")
+
+        self.expiration = asyncio.ensure_future(self.__expire_endpoints__())
+        self.listener.storage_connected(self.version)
+
+    async def stop(self):
+        if self.expiration is not None:
+            self.expiration.cancel()
+            self.expiration = None
+
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def __load__(self):
+        try:
+            f = open(self.path, "r")
+        except FileNotFoundError:
+            return
+        except IOError as e:
+            raise StorageError("Failed to open services file: {0}".format(str(e)))
+
+        with f:
+            for line in f:
+                try:
+                    record = ujson.loads(line)
+                except ValueError:
+                    # the process must have died while writing it
+                    logging.warning("Services file '{0}' has a corrupted record, skipping the rest".format(
+                        self.path))
+                    break
+
+                self.__apply__(record)
+
+        logging.info("Loaded {0} services from '{1}'".format(len(self.services), self.path))
+
+    def __compact__(self):
+        """
+        Rewrites the file with a single record per service, so it does not grow forever.
+        """
+        compacted = self.path + ".tmp"
+
+        with open(compacted, "w") as f:
+            for service_id, networks in self.services.items():
+                f.write(ujson.dumps(["networks", service_id, networks]) + "\n")
+            for service_id, tags in self.tags.items():
+                f.write(ujson.dumps(["tags", service_id, tags]) + "\n")
+            f.write(ujson.dumps(["version", self.version]) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(compacted, self.path)
+
+    def __apply__(self, record):
+        kind = record[0]
+
+        if kind == "version":
+            self.version = record[1]
+            return
+
+        service_id = record[1]
+
+        if kind == "tags":
+            # tags are not a part of the registry, so the version stays
+            self.__tag__(service_id, record[2])
+            return
+
+        if kind == "networks":
+            if record[2]:
+                self.services[service_id] = dict(record[2])
+            else:
+                self.services.pop(service_id, None)
+        elif kind == "location":
+            self.services.setdefault(service_id, {})[record[2]] = record[3]
+        elif kind == "locations":
+            self.services.setdefault(service_id, {}).update(record[2])
+        elif kind == "delete":
+            self.services.pop(service_id, None)
+            self.registered.pop(service_id, None)
+        elif kind == "delete_network":
+            networks = self.services.get(service_id)
+            if networks is not None:
+                networks.pop(record[2], None)
+                if not networks:
+                    self.services.pop(service_id)
+        else:
+            raise StorageError("Unknown record: {0}".format(kind))
+
+        self.__reindex__(service_id)
+        self.version += 1
+
+    @staticmethod
+    def __insert__(ids, service_id):
+        index = bisect_left(ids, service_id)
+        if index == len(ids) or ids[index] != service_id:
+            ids.insert(index, service_id)
+
+    @staticmethod
+    def __remove__(ids, service_id):
+        index = bisect_left(ids, service_id)
+        if index < len(ids) and ids[index] == service_id:
+            del ids[index]
+
+    def __reindex__(self, service_id):
+        """
+        Keeps the sorted ids in line with whether the service exists after a change.
+        A service that is gone loses its tags too.
+        """
+        if service_id in self.services or service_id in self.registered:
+            MemoryServicesStorage.__insert__(self.sorted_ids, service_id)
+            return
+
+        MemoryServicesStorage.__remove__(self.sorted_ids, service_id)
+
+        if service_id in self.tags:
+            self.__tag__(service_id, [])
+            self.__append__(["tags", service_id, []])
+
+    def __tag__(self, service_id, tags):
+        for tag in self.tags.pop(service_id, []):
+            ids = self.tagged.get(tag)
+            MemoryServicesStorage.__remove__(ids, service_id)
+            if not ids:
+                del self.tagged[tag]
+
+        if tags:
+            self.tags[service_id] = list(tags)
+
+            for tag in tags:
+                MemoryServicesStorage.__insert__(self.tagged.setdefault(tag, []), service_id)
+
+    def __append__(self, record):
+        if self.log is not None:
+            self.log.write(ujson.dumps(record) + "\n")
+            self.log.flush()
+
+    def __mutate__(self, record):
+        self.__apply__(record)
+        self.__append__(record)
+        self.listener.storage_changed(record[1], self.version)
+        return self.version
+
+    def __bump__(self, service_id):
+        """
+        Bumps the version for a change that is not persisted, only the version itself is, so it never goes back.
+        """
+        self.version += 1
+        self.__append__(["version", self.version])
+        self.listener.storage_changed(service_id, self.version)
+        return self.version
+
+    async def __expire_endpoints__(self):
+        while True:
+            await asyncio.sleep(options.discovery_heartbeat_expire_interval)
+            self.__expire__(time.time())
+
+    def __expire__(self, now):
+        queue = self.expiration_queue
+
+        while queue and queue[0][0] <= now:
+            expires, service_id, network, location = heapq.heappop(queue)
+            key = (service_id, network, location)
+
+            # the endpoint could have been refreshed after this entry has been queued
+            if self.expirations.get(key) != expires:
+                continue
+
+            del self.expirations[key]
+
+            endpoints = self.registered.get(service_id)
+            if endpoints is None or endpoints.pop((network, location), None) is None:
+                continue
+
+            if not endpoints:
+                del self.registered[service_id]
+                self.__reindex__(service_id)
+
+            self.__bump__(service_id)
+            logging.info("Service '{0}' has an endpoint expired".format(service_id))
+
+    async def get_version(self):
+        return self.version
+
+    def __service_ids__(self):
+        return set(self.services.keys()).union(self.registered.keys())
+
+    async def list_service_ids(self):
+        return list(self.__service_ids__())
+
+    async def count_services(self):
+        return len(self.__service_ids__())
+
+    def __get_service__(self, service_id):
+        networks = dict(self.services.get(service_id, {}))
+        endpoints = self.registered.get(service_id)
+
+        if not endpoints:
+            return networks
+
+        registered = {}
+
+        for (network, location), endpoint in endpoints.items():
+            registered.setdefault(network, []).append(endpoint)
+
+        return merge_registered(networks, registered)
+
+    async def get_services(self, service_ids):
+        return [self.__get_service__(service_id) for service_id in service_ids]
+
+    async def get_static_services(self, service_ids):
+        return [dict(self.services.get(service_id, {})) for service_id in service_ids]
+
+    async def set_location(self, service_id, network, location):
+        return self.__mutate__(["location", service_id, network, location])
+
+    async def set_networks(self, services):
+        return {
+            service_id: self.__mutate__(["networks", service_id, networks])
+            for service_id, networks in services.items()
+        }
+
+    async def set_locations(self, services):
+        return {
+            service_id: self.__mutate__(["locations", service_id, locations])
+            for service_id, locations in services.items()
+        }
+
+    async def delete_service(self, service_id):
+        return self.__mutate__(["delete", service_id])
+
+    async def delete_network(self, service_id, network):
+        return self.__mutate__(["delete_network", service_id, network])
+
+    async def heartbeat(self, service_id, network, endpoint, expires):
+        location = endpoint.location
+        key = (service_id, network, location)
+
+        self.expirations[key] = expires
+        heapq.heappush(self.expiration_queue, (expires, service_id, network, location))
+
+        endpoints = self.registered.setdefault(service_id, {})
+        old = endpoints.get((network, location))
+        endpoints[(network, location)] = endpoint
+        self.__reindex__(service_id)
+
+        if old is not None and dump_registered(old) == dump_registered(endpoint):
+            return 0
+
+        return self.__bump__(service_id)
+
+    async def scan_service_ids(self, prefix="", after=None, limit=100, tag=None):
+        ids = self.tagged.get(tag, []) if tag is not None else self.sorted_ids
+
+        if after is not None and after >= prefix:
+            start = bisect_right(ids, after)
+        else:
+            start = bisect_left(ids, prefix)
+
+        result = []
+
+        for service_id in ids[start:start + limit]:
+            if not service_id.startswith(prefix):
+                break
+            result.append(service_id)
+
+        return result
+
+    async def set_tags(self, service_id, tags):
+        record = ["tags", service_id, list(tags)]
+        self.__apply__(record)
+        self.__append__(record)
+
+    async def get_tags(self, service_ids):
+        return [list(self.tags.get(service_id, [])) for service_id in service_ids]
+
+    async def get_registry(self):
+        return self.version, {service_id: dict(networks) for service_id, networks in self.services.items()}
+
+    async def append_history(self, entries):
+        for entry in sorted(entries, key=lambda e: e.version):
+            self.history.append(entry)
+            self.history_versions.append(entry.version)
+            self.history_times.append(entry.time)
+
+    async def get_history(self, before=None, after=0, limit=100, oldest_first=False):
+        start = bisect_right(self.history_versions, after)
+        end = bisect_left(self.history_versions, before) if before is not None else len(self.history)
+
+        if oldest_first:
+            return self.history[start:min(end, start + limit)]
+
+        return self.history[max(start, end - limit):end][::-1]
+
+    async def find_history_version(self, timestamp):
+        index = bisect_right(self.history_times, timestamp)
+        return self.history_versions[index - 1] if index else 0
+
+    async def get_history_start(self):
+        return self.history_start
+
+    async def put_history_snapshot(self, version, services, complete):
+        self.history_snapshots[version] = (services, complete)
+
+    async def get_history_snapshot(self, version):
+        snapshot = self.history_snapshots.get(version)
+
+        if snapshot is None:
+            return None
+
+        services, complete = snapshot
+        return {service_id: dict(networks) for service_id, networks in services.items()}, complete
+
+    async def list_history_snapshots(self):
+        return sorted(self.history_snapshots.keys())
+
+    async def trim_history(self, version):
+        index = bisect_left(self.history_versions, version)
+
+        del self.history[:index]
+        del self.history_versions[:index]
+        del self.history_times[:index]
+
+        for snapshot in [snapshot for snapshot in self.history_snapshots if snapshot < version]:
+            del self.history_snapshots[snapshot]
+
+        self.history_start = max(self.history_start, version)
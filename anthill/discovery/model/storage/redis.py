@@ -0,0 +1,731 @@
+
+from anthill.common import keyvalue
+from anthill.common.options import options
+
+from . import ServicesStorage
+from .. endpoints import merge_registered, dump_registered, load_registered
+from .. metrics import metrics, REDIS_DURATION, REDIS_COMMANDS, POOL_WAIT
+from .. history import HistoryEntry
+
+from aioredis import Redis, ReplyError
+
+import asyncio
+import hashlib
+import ujson
+import logging
+import time
+import zlib
+
+
+class InstrumentedConnection(object):
+    """
+    Wraps kv.acquire(), recording the time spent waiting for a connection from the pool,
+    the time the connection is held, and the number of commands sent over it.
+    """
+
+    __slots__ = ("acquire", "labels", "commands", "acquired")
+
+    def __init__(self, acquire, operation, commands):
+        self.acquire = acquire
+        self.labels = (("operation", operation),)
+        self.commands = commands
+        self.acquired = 0
+
+    async def __aenter__(self):
+        started = time.perf_counter()
+        db = await self.acquire.__aenter__()
+        self.acquired = time.perf_counter()
+        metrics.observe(POOL_WAIT, (), self.acquired - started)
+        return db
+
+    async def __aexit__(self, exc_type, exc, tb):
+        metrics.observe(REDIS_DURATION, self.labels, time.perf_counter() - self.acquired)
+        metrics.inc(REDIS_COMMANDS, self.labels, self.commands)
+        return await self.acquire.__aexit__(exc_type, exc, tb)
+
+
+class RedisServicesStorage(ServicesStorage):
+    """
+    Keeps each service as a hash of network => location, and tells the other replicas about
+    the changes over a pub/sub channel.
+    """
+
+    # a set of all service ids, maintained along with every write, so the database is never scanned
+    SERVICES_INDEX = "__services__"
+
+    # the same service ids in a sorted set (all scored 0), so they can be walked in order, or by prefix
+    SORTED_INDEX = "__services_sorted__"
+
+    # service_id => JSON list of its tags, and a sorted set of service ids (as the one above) per tag
+    TAGS = "__tags__"
+    TAG_PREFIX = "__tag__:"
+
+    # registry version, incremented along with every mutation
+    VERSION_KEY = "__version__"
+
+    # endpoints registered with heartbeats are kept apart from the static ones, in a hash per service:
+    #   __live__:<service_id> => {["<network>", "<location>"]: <weight> or [<weight>, "<region>", "<zone>"]}
+    # the expiration time of each is tracked in a sorted set of ["<service_id>", "<field>"] members
+    LIVE_PREFIX = "__live__:"
+    LIVE_EXPIRATION = "__live_expiration__"
+
+    # a Lua function the scripts below share: drops the tags of a service that is gone, see TAGS_SCRIPT
+    UNTAG_FUNCTION = """
+        local function untag(tags, prefix, service_id)
+            local old = redis.call('HGET', tags, service_id)
+            if old then
+                for _, tag in ipairs(cjson.decode(old)) do
+                    redis.call('ZREM', prefix .. tag, service_id)
+                end
+                redis.call('HDEL', tags, service_id)
+            end
+        end
+    """
+
+    # removes a network from the service, and the service from the index (along with its tags) if no networks left
+    DELETE_NETWORK_SCRIPT = UNTAG_FUNCTION + """
+        redis.call('HDEL', KEYS[1], ARGV[1])
+        if redis.call('EXISTS', KEYS[1]) == 0 and redis.call('EXISTS', KEYS[4]) == 0 then
+            redis.call('SREM', KEYS[2], KEYS[1])
+            redis.call('ZREM', KEYS[5], KEYS[1])
+            untag(KEYS[6], ARGV[2], KEYS[1])
+        end
+        return redis.call('INCR', KEYS[3])
+    """
+
+    # removes the service from the indexes (along with its tags), unless it still has any networks
+    # or endpoints registered
+    UNINDEX_SCRIPT = UNTAG_FUNCTION + """
+        if redis.call('EXISTS', KEYS[1]) == 0 and redis.call('EXISTS', KEYS[2]) == 0 then
+            redis.call('SREM', KEYS[3], KEYS[1])
+            redis.call('ZREM', KEYS[4], KEYS[1])
+            untag(KEYS[5], ARGV[1], KEYS[1])
+        end
+        return 0
+    """
+
+    # drops the tags of a service deleted
+    UNTAG_SCRIPT = UNTAG_FUNCTION + """
+        untag(KEYS[1], ARGV[1], ARGV[2])
+        return 0
+    """
+
+    # registers (or refreshes) an endpoint, the registry version is only bumped if something has changed
+    HEARTBEAT_SCRIPT = """
+        local old = redis.call('HGET', KEYS[1], ARGV[1])
+        redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+        redis.call('ZADD', KEYS[2], ARGV[3], ARGV[4])
+        if old == ARGV[2] then
+            return 0
+        end
+        redis.call('SADD', KEYS[3], ARGV[5])
+        redis.call('ZADD', KEYS[5], 0, ARGV[5])
+        return redis.call('INCR', KEYS[4])
+    """
+
+    # removes the expired endpoints, returns a flat list of changed services along with their versions
+    EXPIRE_SCRIPT = UNTAG_FUNCTION + """
+        local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+        local result = {}
+        for _, member in ipairs(expired) do
+            redis.call('ZREM', KEYS[1], member)
+            local entry = cjson.decode(member)
+            local service_id = entry[1]
+            local live = ARGV[2] .. service_id
+            if redis.call('HDEL', live, entry[2]) == 1 then
+                if redis.call('EXISTS', live) == 0 and redis.call('EXISTS', service_id) == 0 then
+                    redis.call('SREM', KEYS[2], service_id)
+                    redis.call('ZREM', KEYS[4], service_id)
+                    untag(KEYS[5], ARGV[4], service_id)
+                end
+                table.insert(result, service_id)
+                table.insert(result, redis.call('INCR', KEYS[3]))
+            end
+        end
+        return result
+    """
+
+    EXPIRE_BATCH = 1000
+
+    # replaces the tags of a service (ARGV[1]), ARGV[2] is the prefix of the tag sets, the rest are the tags
+    TAGS_SCRIPT = """
+        local old = redis.call('HGET', KEYS[1], ARGV[1])
+        if old then
+            for _, tag in ipairs(cjson.decode(old)) do
+                redis.call('ZREM', ARGV[2] .. tag, ARGV[1])
+            end
+        end
+        if #ARGV > 2 then
+            local tags = {}
+            for i = 3, #ARGV do
+                redis.call('ZADD', ARGV[2] .. ARGV[i], 0, ARGV[1])
+                table.insert(tags, ARGV[i])
+            end
+            redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(tags))
+        else
+            redis.call('HDEL', KEYS[1], ARGV[1])
+        end
+    """
+
+    # how many services are read in a single round trip when the whole registry is read
+    READ_BATCH = 500
+
+    # the change history: a sorted set of JSON entries scored by version, another one of the versions
+    # scored by the time of the change, and the snapshots (zlib-compressed JSON) indexed in a sorted set as well
+    HISTORY = "__history__"
+    HISTORY_TIMES = "__history_times__"
+    HISTORY_START = "__history_start__"
+    HISTORY_SNAPSHOTS = "__history_snapshots__"
+    HISTORY_SNAPSHOT_PREFIX = "__history_snapshot__:"
+
+    PUBLISH_LABELS = (("operation", "publish"),)
+
+    # how many services are written in a single transaction on bulk writes
+    WRITE_BATCH = 500
+
+    def __init__(self, listener):
+        super(RedisServicesStorage, self).__init__(listener)
+
+        self.kv = keyvalue.KeyValueStorage(
+            host=options.discover_services_host,
+            port=options.discover_services_port,
+            db=options.discover_services_db,
+            max_connections=options.discover_services_max_connections)
+
+        self.invalidations = None
+        self.expiration = None
+
+        metrics.add_collector(self.__collect_metrics__)
+
+    async def start(self):
+        self.invalidations = asyncio.ensure_future(self.__listen_invalidations__())
+        self.expiration = asyncio.ensure_future(self.__expire_endpoints__())
+
+        await self.__build_index__()
+
+    async def stop(self):
+        if self.invalidations is not None:
+            self.invalidations.cancel()
+            self.invalidations = None
+
+        if self.expiration is not None:
+            self.expiration.cancel()
+            self.expiration = None
+
+    def __acquire__(self, operation, commands=1):
+        return InstrumentedConnection(self.kv.acquire(), operation, commands)
+
+    def __collect_metrics__(self):
+        pool = self.kv.connection_pool
+
+        return [
+            ("discovery_redis_pool_size", "gauge", "Redis connections open.",
+             [((), pool.size)]),
+            ("discovery_redis_pool_free", "gauge", "Redis connections open and not in use.",
+             [((), pool.freesize)]),
+            ("discovery_redis_pool_in_use", "gauge", "Redis connections currently acquired.",
+             [((), pool.size - pool.freesize)]),
+            ("discovery_redis_pool_max_size", "gauge", "Maximum number of Redis connections.",
+             [((), pool.maxsize)])
+        ]
+
+    async def __listen_invalidations__(self):
+        """
+        Every mutation publishes the service id along with the new registry version on the invalidation
+        channel. The listener is only told the storage is connected while the channel is subscribed.
+        """
+        redis = Redis(self.kv.connection_pool)
+
+        while True:
+            try:
+                channel, = await redis.subscribe(options.discover_services_channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error("Failed to subscribe for service invalidations: {0}".format(str(e)))
+                await asyncio.sleep(1)
+                continue
+
+            try:
+                self.listener.storage_connected(await self.get_version())
+
+                while await channel.wait_message():
+                    message = await channel.get_json()
+                    if message is not None:
+                        self.listener.storage_changed(message["service"], message["version"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error("Service invalidations listener failed: {0}".format(str(e)))
+            finally:
+                self.listener.storage_disconnected()
+
+            logging.warning("Service invalidations channel has been closed, resubscribing")
+            await asyncio.sleep(1)
+
+    async def __expire_endpoints__(self):
+        """
+        Removes the endpoints that have not sent a heartbeat in time. Every replica does that,
+        but the removal itself is atomic, so each expired endpoint is only announced once.
+        """
+        while True:
+            await asyncio.sleep(options.discovery_heartbeat_expire_interval)
+
+            try:
+                async with self.__acquire__("expire") as db:
+                    expired = await self.__script__(
+                        db, RedisServicesStorage.EXPIRE_SCRIPT,
+                        keys=[RedisServicesStorage.LIVE_EXPIRATION, RedisServicesStorage.SERVICES_INDEX,
+                              RedisServicesStorage.VERSION_KEY, RedisServicesStorage.SORTED_INDEX,
+                              RedisServicesStorage.TAGS],
+                        args=[time.time(), RedisServicesStorage.LIVE_PREFIX, RedisServicesStorage.EXPIRE_BATCH,
+                              RedisServicesStorage.TAG_PREFIX])
+
+                    for service_id, version in zip(expired[0::2], expired[1::2]):
+                        service_id = service_id.decode("utf-8")
+                        await self.__invalidate__(db, service_id, version)
+                        logging.info("Service '{0}' has an endpoint expired".format(service_id))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error("Failed to expire service endpoints: {0}".format(str(e)))
+
+    # noinspection PyMethodMayBeStatic
+    async def __script__(self, db, script, keys, args):
+        """
+        Runs a Lua script by its digest, the script is only sent over if Redis does not know it yet.
+        """
+        digest = hashlib.sha1(script.encode("utf-8")).hexdigest()
+
+        try:
+            return await db.evalsha(digest, keys=keys, args=args)
+        except ReplyError as e:
+            if not str(e).startswith("NOSCRIPT"):
+                raise
+
+        return await db.eval(script, keys=keys, args=args)
+
+    async def __build_index__(self):
+        """
+        One-shot migration for the databases created before the services index was introduced.
+        Uses SCAN rather than KEYS so the (possibly shared) Redis is not blocked meanwhile.
+        """
+        async with self.__acquire__("build_index") as db:
+            if await db.exists(RedisServicesStorage.SERVICES_INDEX):
+                service_ids = None
+            else:
+                service_ids = []
+
+                async for key in db.iscan(count=1000):
+                    if await db.type(key) == b"hash" and not key.startswith(b"__"):
+                        service_ids.append(key)
+
+                if service_ids:
+                    await db.sadd(RedisServicesStorage.SERVICES_INDEX, *service_ids)
+                    logging.info("Built services index of {0} services".format(len(service_ids)))
+
+            # the sorted index has come later than the plain one
+            if await db.exists(RedisServicesStorage.SORTED_INDEX):
+                return
+
+            if service_ids is None:
+                service_ids = await db.smembers(RedisServicesStorage.SERVICES_INDEX)
+
+            for offset in range(0, len(service_ids), RedisServicesStorage.WRITE_BATCH):
+                batch = service_ids[offset:offset + RedisServicesStorage.WRITE_BATCH]
+                await db.zadd(RedisServicesStorage.SORTED_INDEX, *[
+                    value for service_id in batch for value in (0, service_id)
+                ])
+
+        if service_ids:
+            logging.info("Built sorted services index of {0} services".format(len(service_ids)))
+
+    async def __invalidate__(self, db, service_id, version):
+        self.listener.storage_changed(service_id, version)
+        metrics.inc(REDIS_COMMANDS, RedisServicesStorage.PUBLISH_LABELS)
+
+        await db.publish_json(options.discover_services_channel, {
+            "service": service_id,
+            "version": version
+        })
+
+    async def __commit__(self, db, tr, service_id):
+        """
+        Executes the mutation transaction along with the registry version bump,
+        then notifies every replica about the change.
+        """
+        version = tr.incr(RedisServicesStorage.VERSION_KEY)
+        await tr.execute()
+
+        version = await version
+        await self.__invalidate__(db, service_id, version)
+        return version
+
+    async def get_version(self):
+        async with self.__acquire__("get_version") as db:
+            return int(await db.get(RedisServicesStorage.VERSION_KEY) or 0)
+
+    async def list_service_ids(self):
+        async with self.__acquire__("list_service_ids") as db:
+            return await db.smembers(RedisServicesStorage.SERVICES_INDEX, encoding="utf-8")
+
+    async def count_services(self):
+        async with self.__acquire__("count_services") as db:
+            return await db.scard(RedisServicesStorage.SERVICES_INDEX)
+
+    async def get_services(self, service_ids):
+        """
+        Fetches the static networks of the services along with the endpoints registered with heartbeats,
+        in a single pipelined round trip, regardless of how many services are asked.
+        """
+        async with self.__acquire__("get_services", len(service_ids) * 2) as db:
+            pipe = db.pipeline()
+
+            for service_id in service_ids:
+                pipe.hgetall(service_id, encoding="utf-8")
+                pipe.hgetall(RedisServicesStorage.LIVE_PREFIX + service_id, encoding="utf-8")
+
+            results = await pipe.execute()
+
+        return [
+            self.__merge_live__(networks, live)
+            for networks, live in zip(results[0::2], results[1::2])
+        ]
+
+    # noinspection PyMethodMayBeStatic
+    def __merge_live__(self, networks, live):
+        if not live:
+            return networks
+
+        registered = {}
+
+        for field, value in live.items():
+            try:
+                network, location = ujson.loads(field)
+                endpoint = load_registered(location, value)
+            except (ValueError, TypeError):
+                continue
+
+            registered.setdefault(network, []).append(endpoint)
+
+        return merge_registered(networks, registered)
+
+    async def get_static_services(self, service_ids):
+        async with self.__acquire__("get_static_services", len(service_ids)) as db:
+            pipe = db.pipeline()
+
+            for service_id in service_ids:
+                pipe.hgetall(service_id, encoding="utf-8")
+
+            return await pipe.execute()
+
+    async def set_location(self, service_id, network, location):
+        async with self.__acquire__("set_location", 5) as db:
+            tr = db.multi_exec()
+            tr.hset(service_id, network, location)
+            tr.sadd(RedisServicesStorage.SERVICES_INDEX, service_id)
+            tr.zadd(RedisServicesStorage.SORTED_INDEX, 0, service_id)
+
+            return await self.__commit__(db, tr, service_id)
+
+    # noinspection PyMethodMayBeStatic
+    def __write_networks__(self, tr, service_id, networks):
+        """
+        Queues a swap of the whole network map of the service into the transaction.
+        The readers see either the old map or the new one, never a missing or a half-written service.
+        Returns a future of the new registry version.
+        """
+        tr.delete(service_id)
+
+        if networks:
+            tr.hmset_dict(service_id, networks)
+            tr.sadd(RedisServicesStorage.SERVICES_INDEX, service_id)
+            tr.zadd(RedisServicesStorage.SORTED_INDEX, 0, service_id)
+        else:
+            # the script is sent as is, as a missing one can't be told apart inside of the transaction
+            tr.eval(RedisServicesStorage.UNINDEX_SCRIPT, keys=[
+                service_id,
+                RedisServicesStorage.LIVE_PREFIX + service_id,
+                RedisServicesStorage.SERVICES_INDEX,
+                RedisServicesStorage.SORTED_INDEX,
+                RedisServicesStorage.TAGS
+            ], args=[RedisServicesStorage.TAG_PREFIX])
+
+        return tr.incr(RedisServicesStorage.VERSION_KEY)
+
+    async def set_networks(self, services):
+        """
+        Written in transactions of WRITE_BATCH services each. Every service is still swapped atomically,
+        and gets its own registry version.
+        """
+        service_ids = list(services.keys())
+        result = {}
+
+        async with self.__acquire__("set_networks", len(service_ids) * 3 + 2) as db:
+            for offset in range(0, len(service_ids), RedisServicesStorage.WRITE_BATCH):
+                batch = service_ids[offset:offset + RedisServicesStorage.WRITE_BATCH]
+
+                tr = db.multi_exec()
+                versions = [
+                    self.__write_networks__(tr, service_id, services[service_id])
+                    for service_id in batch
+                ]
+                await tr.execute()
+
+                for service_id, version in zip(batch, versions):
+                    result[service_id] = version.result()
+
+                # the notifications are pipelined rather than sent one by one
+                await asyncio.gather(*[
+                    self.__invalidate__(db, service_id, result[service_id])
+                    for service_id in batch
+                ])
+
+        return result
+
+    async def set_locations(self, services):
+        """
+        A single transaction (and a single round trip) however many services there are,
+        with the notifications pipelined after it.
+        """
+        service_ids = list(services.keys())
+
+        async with self.__acquire__("set_locations", len(service_ids) * 5 + 2) as db:
+            tr = db.multi_exec()
+            versions = []
+
+            for service_id in service_ids:
+                tr.hmset_dict(service_id, services[service_id])
+                tr.sadd(RedisServicesStorage.SERVICES_INDEX, service_id)
+                tr.zadd(RedisServicesStorage.SORTED_INDEX, 0, service_id)
+                versions.append(tr.incr(RedisServicesStorage.VERSION_KEY))
+
+            await tr.execute()
+
+            result = {
+                service_id: version.result()
+                for service_id, version in zip(service_ids, versions)
+            }
+
+            await asyncio.gather(*[
+                self.__invalidate__(db, service_id, version)
+                for service_id, version in result.items()
+            ])
+
+        return result
+
+    async def delete_service(self, service_id):
+        async with self.__acquire__("delete_service", 5) as db:
+            tr = db.multi_exec()
+            tr.delete(service_id, RedisServicesStorage.LIVE_PREFIX + service_id)
+            tr.srem(RedisServicesStorage.SERVICES_INDEX, service_id)
+            tr.zrem(RedisServicesStorage.SORTED_INDEX, service_id)
+            tr.eval(RedisServicesStorage.UNTAG_SCRIPT, keys=[RedisServicesStorage.TAGS],
+                    args=[RedisServicesStorage.TAG_PREFIX, service_id])
+
+            return await self.__commit__(db, tr, service_id)
+
+    async def delete_network(self, service_id, network):
+        async with self.__acquire__("delete_network") as db:
+            version = await self.__script__(
+                db, RedisServicesStorage.DELETE_NETWORK_SCRIPT,
+                keys=[service_id, RedisServicesStorage.SERVICES_INDEX, RedisServicesStorage.VERSION_KEY,
+                      RedisServicesStorage.LIVE_PREFIX + service_id, RedisServicesStorage.SORTED_INDEX,
+                      RedisServicesStorage.TAGS],
+                args=[network, RedisServicesStorage.TAG_PREFIX])
+
+            await self.__invalidate__(db, service_id, version)
+            return version
+
+    async def heartbeat(self, service_id, network, endpoint, expires):
+        """
+        Costs a single round trip, and the replicas are only notified when a new endpoint shows up.
+        """
+        field = ujson.dumps([network, endpoint.location])
+        member = ujson.dumps([service_id, field])
+
+        async with self.__acquire__("heartbeat") as db:
+            version = await self.__script__(
+                db, RedisServicesStorage.HEARTBEAT_SCRIPT,
+                keys=[RedisServicesStorage.LIVE_PREFIX + service_id, RedisServicesStorage.LIVE_EXPIRATION,
+                      RedisServicesStorage.SERVICES_INDEX, RedisServicesStorage.VERSION_KEY,
+                      RedisServicesStorage.SORTED_INDEX],
+                args=[field, dump_registered(endpoint), expires, member, service_id])
+
+            if version:
+                await self.__invalidate__(db, service_id, version)
+
+            return version
+
+    async def scan_service_ids(self, prefix="", after=None, limit=100, tag=None):
+        """
+        A single ZRANGEBYLEX over the sorted index (or the set of the tag), so it costs as much as
+        the ids returned, not the whole registry.
+        """
+        key = RedisServicesStorage.TAG_PREFIX + tag if tag is not None else RedisServicesStorage.SORTED_INDEX
+        prefix = prefix.encode("utf-8")
+
+        # the bounds are built here rather than by zrangebylex, which takes a bare "-" or "+" as the open ends,
+        # so a service id of exactly that would end up unbounded
+        if after is not None and after.encode("utf-8") >= prefix:
+            start = b"(" + after.encode("utf-8")
+        elif prefix:
+            start = b"[" + prefix
+        else:
+            start = b"-"
+
+        # no UTF-8 string contains 0xFF, so every id starting with the prefix is below that
+        end = b"(" + prefix + b"\xff" if prefix else b"+"
+
+        async with self.__acquire__("scan_service_ids") as db:
+            return await db.execute(b"ZRANGEBYLEX", key, start, end, b"LIMIT", 0, limit, encoding="utf-8")
+
+    async def set_tags(self, service_id, tags):
+        async with self.__acquire__("set_tags") as db:
+            await self.__script__(
+                db, RedisServicesStorage.TAGS_SCRIPT,
+                keys=[RedisServicesStorage.TAGS],
+                args=[service_id, RedisServicesStorage.TAG_PREFIX] + list(tags))
+
+    async def get_tags(self, service_ids):
+        if not service_ids:
+            return []
+
+        async with self.__acquire__("get_tags") as db:
+            tags = await db.hmget(RedisServicesStorage.TAGS, *service_ids, encoding="utf-8")
+
+        return [ujson.loads(service_tags) if service_tags else [] for service_tags in tags]
+
+    async def get_registry(self):
+        """
+        The index is walked with SSCAN, and the services are read in pipelined batches of READ_BATCH,
+        so Redis is never blocked for long, however large the registry. The version is read first,
+        so the services can only be newer than it.
+        """
+        services = {}
+
+        async with self.__acquire__("get_registry") as db:
+            version = int(await db.get(RedisServicesStorage.VERSION_KEY) or 0)
+            batch = []
+
+            service_ids = db.isscan(RedisServicesStorage.SERVICES_INDEX, count=RedisServicesStorage.READ_BATCH)
+
+            async for service_id in service_ids:
+                batch.append(service_id.decode("utf-8"))
+
+                if len(batch) >= RedisServicesStorage.READ_BATCH:
+                    await self.__read_registry__(db, batch, services)
+                    batch = []
+
+            if batch:
+                await self.__read_registry__(db, batch, services)
+
+        return version, services
+
+    # noinspection PyMethodMayBeStatic
+    async def __read_registry__(self, db, service_ids, services):
+        pipe = db.pipeline()
+
+        for service_id in service_ids:
+            pipe.hgetall(service_id, encoding="utf-8")
+
+        for service_id, networks in zip(service_ids, await pipe.execute()):
+            if networks:
+                services[service_id] = networks
+
+    async def append_history(self, entries):
+        history = []
+        times = []
+
+        for entry in entries:
+            history.extend((entry.version, ujson.dumps(entry.dump(), escape_forward_slashes=False)))
+            times.extend((entry.time, entry.version))
+
+        async with self.__acquire__("append_history", 2) as db:
+            pipe = db.pipeline()
+            pipe.zadd(RedisServicesStorage.HISTORY, *history)
+            pipe.zadd(RedisServicesStorage.HISTORY_TIMES, *times)
+            await pipe.execute()
+
+    async def get_history(self, before=None, after=0, limit=100, oldest_first=False):
+        before = before if before is not None else float("inf")
+
+        async with self.__acquire__("get_history") as db:
+            if oldest_first:
+                entries = await db.zrangebyscore(
+                    RedisServicesStorage.HISTORY, after, before, offset=0, count=limit,
+                    exclude=db.ZSET_EXCLUDE_BOTH, encoding="utf-8")
+            else:
+                entries = await db.zrevrangebyscore(
+                    RedisServicesStorage.HISTORY, before, after, offset=0, count=limit,
+                    exclude=db.ZSET_EXCLUDE_BOTH, encoding="utf-8")
+
+        return [HistoryEntry.load(ujson.loads(entry)) for entry in entries]
+
+    async def find_history_version(self, timestamp):
+        async with self.__acquire__("find_history_version") as db:
+            versions = await db.zrevrangebyscore(
+                RedisServicesStorage.HISTORY_TIMES, timestamp, float("-inf"), offset=0, count=1)
+
+        return int(versions[0]) if versions else 0
+
+    async def get_history_start(self):
+        async with self.__acquire__("get_history_start") as db:
+            return int(await db.get(RedisServicesStorage.HISTORY_START) or 0)
+
+    async def put_history_snapshot(self, version, services, complete):
+        data = zlib.compress(ujson.dumps([complete, services], escape_forward_slashes=False).encode("utf-8"))
+
+        async with self.__acquire__("put_history_snapshot", 2) as db:
+            tr = db.multi_exec()
+            tr.set(RedisServicesStorage.HISTORY_SNAPSHOT_PREFIX + str(version), data)
+            tr.zadd(RedisServicesStorage.HISTORY_SNAPSHOTS, version, version)
+            await tr.execute()
+
+    async def get_history_snapshot(self, version):
+        async with self.__acquire__("get_history_snapshot") as db:
+            data = await db.get(RedisServicesStorage.HISTORY_SNAPSHOT_PREFIX + str(version))
+
+        if data is None:
+            return None
+
+        data = ujson.loads(zlib.decompress(data).decode("utf-8"))
+
+        # the snapshots saved before the registry was read in batches were read at once
+        if isinstance(data, dict):
+            return data, version
+
+        complete, services = data
+        return services, complete
+
+    async def list_history_snapshots(self):
+        async with self.__acquire__("list_history_snapshots") as db:
+            versions = await db.zrange(RedisServicesStorage.HISTORY_SNAPSHOTS)
+
+        return [int(version) for version in versions]
+
+    async def trim_history(self, version):
+        async with self.__acquire__("trim_history", 7) as db:
+            snapshots = await db.zrangebyscore(
+                RedisServicesStorage.HISTORY_SNAPSHOTS, float("-inf"), version, exclude=db.ZSET_EXCLUDE_MAX)
+
+            # the times index is trimmed up to the time of the oldest entry kept
+            kept = await db.zrangebyscore(
+                RedisServicesStorage.HISTORY, version, float("inf"), offset=0, count=1, encoding="utf-8")
+            kept_time = HistoryEntry.load(ujson.loads(kept[0])).time if kept else float("inf")
+
+            tr = db.multi_exec()
+            tr.zremrangebyscore(RedisServicesStorage.HISTORY, float("-inf"), version, exclude=db.ZSET_EXCLUDE_MAX)
+            tr.zremrangebyscore(
+                RedisServicesStorage.HISTORY_TIMES, float("-inf"), kept_time, exclude=db.ZSET_EXCLUDE_MAX)
+            tr.zremrangebyscore(
+                RedisServicesStorage.HISTORY_SNAPSHOTS, float("-inf"), version, exclude=db.ZSET_EXCLUDE_MAX)
+            tr.set(RedisServicesStorage.HISTORY_START, version)
+
+            if snapshots:
+                tr.delete(*[
+                    RedisServicesStorage.HISTORY_SNAPSHOT_PREFIX + snapshot.decode("utf-8")
+                    for snapshot in snapshots
+                ])
+
+            await tr.execute()
@@ -0,0 +1,272 @@
+
+from anthill.common.options import options
+
+from . import ServicesStorage, StorageListener
+from . redis import RedisServicesStorage
+from .. snapshot import SnapshotFile, SnapshotError
+
+import asyncio
+import logging
+import ujson
+import os
+
+
+class SnapshotServicesStorage(ServicesStorage, StorageListener):
+    """
+    Used by the worker processes other than the leader: the registry is read out of the memory-mapped
+    snapshot file the leader keeps up to date, so neither Redis is queried nor the services are copied
+    into the memory of every worker. The changes are learned by comparing each new snapshot with
+    the previous one.
+
+    The writes (and the reads, while there is no up-to-date snapshot) go to Redis directly, so
+    a change made by a worker is only seen by it once the leader has published it.
+    """
+
+    cacheable = False
+
+    def __init__(self, listener):
+        super(SnapshotServicesStorage, self).__init__(listener)
+
+        # the changes made through it are not listened to, those come with the snapshots
+        self.redis = RedisServicesStorage(self)
+
+        self.path = options.discovery_snapshot_file
+        self.snapshot = None
+        self.stat = None
+        self.poll = None
+
+    async def start(self):
+        self.__reload__()
+        self.poll = asyncio.ensure_future(self.__poll__())
+
+    async def stop(self):
+        if self.poll is not None:
+            self.poll.cancel()
+            self.poll = None
+
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+
+    def storage_connected(self, version):
+        pass
+
+    def storage_changed(self, service_id, version):
+        pass
+
+    def storage_disconnected(self):
+        pass
+
+    async def __poll__(self):
+        while True:
+            await asyncio.sleep(options.discovery_snapshot_interval)
+
+            try:
+                self.__reload__()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error("Failed to reload the services snapshot: {0}".format(str(e)))
+
+    def __reload__(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+
+        # a new snapshot is always a new file, so it gets a new inode
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+        if key == self.stat:
+            return
+
+        try:
+            snapshot = SnapshotFile.open(self.path)
+        except (IOError, SnapshotError) as e:
+            logging.warning("Failed to open the services snapshot: {0}".format(str(e)))
+            return
+
+        self.stat = key
+        previous, self.snapshot = self.snapshot, snapshot
+
+        self.__notify__(previous, snapshot)
+
+        if previous is not None:
+            previous.close()
+
+    def __notify__(self, previous, current):
+        listener = self.listener
+
+        if not current.connected:
+            if previous is not None and previous.connected:
+                listener.storage_disconnected()
+            return
+
+        if previous is None or not previous.connected or previous.epoch != current.epoch:
+            listener.storage_connected(current.version)
+            return
+
+        if current.version < previous.version:
+            return
+
+        changes = SnapshotServicesStorage.__diff__(previous, current)
+
+        if changes is None:
+            listener.storage_connected(current.version)
+            return
+
+        for version, service_id in sorted(changes.items()):
+            listener.storage_changed(service_id, version)
+
+        # every change up to the snapshot version is in the snapshot, so the versions not mentioned
+        # have been superseded by later changes of the same services, and only fill the gaps
+        for version in range(previous.version + 1, current.version + 1):
+            if version not in changes:
+                listener.storage_changed(None, version)
+
+    @staticmethod
+    def __diff__(previous, current):
+        """
+        Walks both snapshots in the order of service ids, returns a dict of version => service_id
+        of the services changed (the version of the last change of a service is compared, not the value),
+        or None if the changes cannot be told for sure.
+        """
+        changes = {}
+
+        old = previous.items()
+        new = current.items()
+
+        old_entry = next(old, None)
+        new_entry = next(new, None)
+
+        while old_entry is not None or new_entry is not None:
+            if new_entry is None or (old_entry is not None and old_entry[0] < new_entry[0]):
+                # a service that has gone without a trace, its deletion is too old to be reported
+                if old_entry[1] is not None:
+                    return None
+                old_entry = next(old, None)
+                continue
+
+            service_id, value, version = new_entry
+
+            if old_entry is None or old_entry[0] > service_id:
+                changed = True
+            else:
+                changed = old_entry[2] != version
+                old_entry = next(old, None)
+
+            if changed and version > previous.version:
+                changes[version] = service_id
+
+            new_entry = next(new, None)
+
+        return changes
+
+    def __current__(self):
+        snapshot = self.snapshot
+
+        if snapshot is not None and snapshot.connected:
+            return snapshot
+
+        return None
+
+    async def get_version(self):
+        snapshot = self.__current__()
+
+        if snapshot is None:
+            return await self.redis.get_version()
+
+        return snapshot.version
+
+    async def list_service_ids(self):
+        snapshot = self.__current__()
+
+        if snapshot is None:
+            return await self.redis.list_service_ids()
+
+        return snapshot.service_ids()
+
+    async def count_services(self):
+        snapshot = self.__current__()
+
+        if snapshot is None:
+            return await self.redis.count_services()
+
+        return len(snapshot.service_ids())
+
+    async def get_services(self, service_ids):
+        snapshot = self.__current__()
+
+        if snapshot is None:
+            return await self.redis.get_services(service_ids)
+
+        result = []
+
+        for service_id in service_ids:
+            value, version = snapshot.find(service_id)
+            result.append(ujson.loads(value) if value is not None else {})
+
+        return result
+
+    async def get_static_services(self, service_ids):
+        return await self.redis.get_static_services(service_ids)
+
+    async def set_location(self, service_id, network, location):
+        return await self.redis.set_location(service_id, network, location)
+
+    async def set_networks(self, services):
+        return await self.redis.set_networks(services)
+
+    async def set_locations(self, services):
+        return await self.redis.set_locations(services)
+
+    async def delete_service(self, service_id):
+        return await self.redis.delete_service(service_id)
+
+    async def delete_network(self, service_id, network):
+        return await self.redis.delete_network(service_id, network)
+
+    async def heartbeat(self, service_id, network, endpoint, expires):
+        return await self.redis.heartbeat(service_id, network, endpoint, expires)
+
+    async def scan_service_ids(self, prefix="", after=None, limit=100, tag=None):
+        snapshot = self.__current__()
+
+        # the tags are not in the snapshot
+        if snapshot is None or tag is not None:
+            return await self.redis.scan_service_ids(prefix=prefix, after=after, limit=limit, tag=tag)
+
+        return snapshot.scan(prefix=prefix, after=after, limit=limit)
+
+    async def set_tags(self, service_id, tags):
+        return await self.redis.set_tags(service_id, tags)
+
+    async def get_tags(self, service_ids):
+        return await self.redis.get_tags(service_ids)
+
+    async def get_registry(self):
+        return await self.redis.get_registry()
+
+    async def append_history(self, entries):
+        return await self.redis.append_history(entries)
+
+    async def get_history(self, before=None, after=0, limit=100, oldest_first=False):
+        return await self.redis.get_history(before=before, after=after, limit=limit, oldest_first=oldest_first)
+
+    async def find_history_version(self, timestamp):
+        return await self.redis.find_history_version(timestamp)
+
+    async def get_history_start(self):
+        return await self.redis.get_history_start()
+
+    async def put_history_snapshot(self, version, services, complete):
+        return await self.redis.put_history_snapshot(version, services, complete)
+
+    async def get_history_snapshot(self, version):
+        return await self.redis.get_history_snapshot(version)
+
+    async def list_history_snapshots(self):
+        return await self.redis.list_history_snapshots()
+
+    async def trim_history(self, version):
+        return await self.redis.trim_history(version)
@@ -0,0 +1,144 @@
+
+from collections import OrderedDict
+
+import asyncio
+import logging
+
+
+class ChangesLog(object):
+    """
+    A bounded log of recent registry changes (version => service_id), fed by the invalidation channel.
+    Lets the watchers learn what has changed since a version they know, and wait for the next change
+    of the services they are interested in without polling the database.
+
+    Notifications from different replicas may arrive out of order, so the log only advances its version
+    once every version before it is known. A version that never arrives (its writer died before
+    publishing) is skipped after GAP_TIMEOUT, and the log is considered incomplete up to it.
+
+    A version may come with no service (None), if whatever it changed is known to be covered
+    by a later version: it only fills the gap.
+    """
+
+    GAP_TIMEOUT = 1.0
+
+    def __init__(self, size):
+        self.size = size
+        self.changes = OrderedDict()
+        self.pending = {}
+        self.version = 0
+        # changes are only known for versions newer than this one
+        self.oldest = 0
+        # service_id (None for the watchers of all services) => a set of futures
+        self.waiters = {}
+        self.gap_timer = None
+
+    def reset(self, version):
+        self.changes.clear()
+        self.pending.clear()
+        self.version = version
+        self.oldest = version
+        self.__wake_all__()
+
+    def add(self, version, service_id):
+        if version <= self.version or version in self.pending:
+            return
+
+        self.pending[version] = service_id
+        self.__advance__()
+
+        if self.pending and self.gap_timer is None:
+            self.gap_timer = asyncio.get_event_loop().call_later(ChangesLog.GAP_TIMEOUT, self.__skip_gap__)
+
+    def changed_since(self, since, service_ids):
+        """
+        Returns a set of services (of those requested, or all if none requested) changed after the version
+        `since`, or None if the log does not go back that far and the watcher has to start over.
+        """
+        if since < self.oldest:
+            return None
+
+        changed = set()
+
+        for version in reversed(self.changes):
+            if version <= since:
+                break
+
+            service_id = self.changes[version]
+
+            if service_id is None:
+                continue
+
+            if not service_ids or service_id in service_ids:
+                changed.add(service_id)
+
+        return changed
+
+    async def wait(self, service_ids, timeout):
+        """
+        Waits until any of the services (all services if the list is empty) changes, or the timeout expires.
+        """
+        future = asyncio.get_event_loop().create_future()
+        keys = service_ids or [None]
+
+        for key in keys:
+            self.waiters.setdefault(key, set()).add(future)
+
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            for key in keys:
+                waiters = self.waiters.get(key)
+                if waiters is not None:
+                    waiters.discard(future)
+                    if not waiters:
+                        del self.waiters[key]
+
+    def __advance__(self):
+        while (self.version + 1) in self.pending:
+            self.version += 1
+            service_id = self.pending.pop(self.version)
+
+            self.changes[self.version] = service_id
+
+            while len(self.changes) > self.size:
+                oldest, _ = self.changes.popitem(last=False)
+                self.oldest = oldest
+
+            if service_id is not None:
+                self.__wake__(service_id)
+                self.__wake__(None)
+
+    def __skip_gap__(self):
+        self.gap_timer = None
+
+        if not self.pending:
+            return
+
+        skip_to = min(self.pending) - 1
+        logging.warning("Registry versions {0}..{1} were never announced, skipping".format(
+            self.version + 1, skip_to))
+
+        # whatever those versions have changed is unknown, so the watchers from before have to start over
+        self.version = skip_to
+        self.oldest = skip_to
+        self.__advance__()
+        self.__wake_all__()
+
+        if self.pending:
+            self.gap_timer = asyncio.get_event_loop().call_later(ChangesLog.GAP_TIMEOUT, self.__skip_gap__)
+
+    def __wake__(self, key):
+        waiters = self.waiters.pop(key, None)
+
+        if waiters is None:
+            return
+
+        for future in waiters:
+            if not future.done():
+                future.set_result(True)
+
+    def __wake_all__(self):
+        for key in list(self.waiters.keys()):
+            self.__wake__(key)
@@ -20,6 +20,18 @@ define("name",
 
 # Discover services
 
+define("discover_services_storage",
+       default="redis",
+       help="Where the service locations are stored: redis, or memory (a single replica only, no Redis needed).",
+       group="discover_services",
+       type=str)
+
+define("discover_services_file",
+       default="",
+       help="Append-only file the memory storage persists the service locations to (empty to not persist).",
+       group="discover_services",
+       type=str)
+
 define("discover_services_host",
        default="127.0.0.1",
        help="Location of service discovery database (redis).",
@@ -44,13 +56,154 @@ define("discover_services_max_connections",
        group="discover_services",
        type=int)
 
+define("discover_services_channel",
+       default="discovery_invalidate",
+       help="Redis pub/sub channel used to invalidate service location caches across replicas.",
+       group="discover_services",
+       type=str)
+
 # Discovery services init file
 
-# If the service is started up with no records at all, the service will fill up the database with records from the
-# file provided. Please note that this will only happen once.
+# Once started, the service adds the records of the file provided that are missing in the database, in the background.
+# The records already in the database are never overwritten.
 
 define("services_init_file",
        default="../dev/discovery-services.json",
-       help="JSON file with default services locations (used to initialize an empty database)",
+       help="JSON file with default services locations (the ones missing in the database are added on start)",
+       group="discovery",
+       type=str)
+
+define("discovery_init_batch_size",
+       default=500,
+       help="How many services of the init file are compared with the database and written at a time.",
+       group="discovery",
+       type=int)
+
+# Watching for changes
+
+define("discovery_watch_timeout",
+       default=30,
+       help="Maximum time (in seconds) a watch request is held until a change happens.",
+       group="discovery",
+       type=int)
+
+define("discovery_watch_history",
+       default=1000,
+       help="How many recent registry changes are kept for the watchers to catch up on.",
+       group="discovery",
+       type=int)
+
+# Multiple endpoints
+
+define("discovery_endpoint_strategy",
+       default="round_robin",
+       help="How to pick one of several service endpoints: round_robin, weighted_random or least_recently_failed.",
+       group="discovery",
+       type=str)
+
+# Heartbeats
+
+define("discovery_heartbeat_ttl",
+       default=15,
+       help="Default time (in seconds) an endpoint registered with a heartbeat stays advertised.",
+       group="discovery",
+       type=int)
+
+define("discovery_heartbeat_max_ttl",
+       default=300,
+       help="Maximum time (in seconds) a heartbeat may ask an endpoint to stay advertised for.",
+       group="discovery",
+       type=int)
+
+define("discovery_heartbeat_expire_interval",
+       default=1.0,
+       help="How often (in seconds) the expired endpoints are removed.",
+       group="discovery",
+       type=float)
+
+# Change history
+
+define("discovery_history_snapshot_every",
+       default=1000,
+       help="Save a snapshot of the whole registry once this replica has logged that many changes (0 to never).",
+       group="discovery",
+       type=int)
+
+define("discovery_history_snapshots",
+       default=10,
+       help="How many registry snapshots are kept. The changes older than the oldest of them are dropped.",
+       group="discovery",
+       type=int)
+
+# Localities
+
+define("discovery_localities",
+       default="",
+       help="Tells the locality of a caller by its address, so the endpoints closest to it are preferred. "
+            "A comma-separated list of <subnet>=<region>:<zone>, "
+            "for example 10.0.1.0/24=eu-west:eu-west-1a,10.0.2.0/24=eu-west:eu-west-1b",
        group="discovery",
        type=str)
+
+# Encoded responses
+
+define("discovery_responses_cache_size",
+       default=256,
+       help="How many distinct multi lookup responses are kept encoded (0 to disable).",
+       group="discovery",
+       type=int)
+
+# Write coalescing
+
+define("discovery_write_batch_window",
+       default=0.005,
+       help="How long (in seconds) the location updates are gathered to be committed together (0 to commit each "
+            "one on its own).",
+       group="discovery",
+       type=float)
+
+define("discovery_write_batch_size",
+       default=500,
+       help="Maximum number of services updated in a single batch, a full batch is committed right away.",
+       group="discovery",
+       type=int)
+
+# Admission control
+
+define("discovery_max_backend_operations",
+       default=256,
+       help="Maximum backend (Redis) operations in flight at once, the rest are queued (0 for no limit).",
+       group="discovery",
+       type=int)
+
+define("discovery_backend_queue_timeout",
+       default=0.5,
+       help="Maximum time (in seconds) a backend operation may wait in the queue before the request fails with 503.",
+       group="discovery",
+       type=float)
+
+define("discovery_overload_retry_after",
+       default=1,
+       help="Retry-After (in seconds) sent along with the 503 responses when overloaded.",
+       group="discovery",
+       type=int)
+
+# Worker processes
+
+define("discovery_workers",
+       default=1,
+       help="Number of worker processes sharing the listening socket (requires the redis storage if more than 1).",
+       group="discovery",
+       type=int)
+
+define("discovery_snapshot_file",
+       default="",
+       help="File the registry is shared with the worker processes through (a temporary one if empty).",
+       group="discovery",
+       type=str)
+
+define("discovery_snapshot_interval",
+       default=0.05,
+       help="How often (in seconds) the registry snapshot is published and checked for by the workers.",
+       group="discovery",
+       type=float)
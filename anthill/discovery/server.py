@@ -1,11 +1,15 @@
 
 from anthill.common import handler, server, access, sign, discover
+from anthill.common.options import options
 
 from . model.discovery import DiscoveryModel, ServiceNotFound
 from . import handler as h
 from . import admin
+from . import workers
 from . import options as _opts
 
+from tornado.httpserver import HTTPServer
+
 
 class DiscoveryServer(server.Server):
     def __init__(self):
@@ -13,13 +17,17 @@ class DiscoveryServer(server.Server):
 
         self.services = DiscoveryModel(self)
 
+        # sockets bound before the worker processes are forked, if any
+        self.sockets = None
+
     def get_admin(self):
         return {
             "index": admin.RootAdminController,
             "service": admin.ServiceController,
             "new_service": admin.NewServiceController,
             "clone_service": admin.CloneServiceController,
-            "services": admin.ServicesController
+            "services": admin.ServicesController,
+            "history": admin.HistoryController
         }
 
     def get_models(self):
@@ -36,13 +44,37 @@ class DiscoveryServer(server.Server):
         return [
             (r"/@service/(.*?)/(.*)", h.ServiceInternalHandler),
             (r"/@services/(.*)", h.ServiceListInternalHandler),
+            (r"/@failed/(.*?)/(.*)", h.ServiceFailureInternalHandler),
+            (r"/@heartbeat/(.*?)/(.*)", h.HeartbeatInternalHandler),
+            (r"/@snapshot/(.*)", h.ServicesSnapshotInternalHandler),
+            (r"/@query/(.*)", h.QueryInternalHandler),
+            (r"/@tags/(.*)", h.TagsInternalHandler),
+            (r"/@cache", h.CacheStatsInternalHandler),
+            (r"/@ready", h.ReadyInternalHandler),
+            (r"/@metrics", h.MetricsInternalHandler),
+            (r"/@export", h.ExportInternalHandler),
+            (r"/@import", h.ImportInternalHandler),
+            (r"/@history", h.HistoryInternalHandler),
+            (r"/@history/rollback", h.RollbackInternalHandler),
+            (r"/@history/([0-9]+)", h.HistoryVersionInternalHandler),
 
             (r"/service/(.*?)/(.*)", h.DiscoverNetworkHandler),
             (r"/services/(.*?)/(.*)", h.MultiDiscoverNetworkHandler),
             (r"/service/(.*)", h.DiscoverHandler),
             (r"/services/(.*)", h.MultiDiscoverHandler),
+
+            (r"/watch/(.*?)/(.*)", h.WatchNetworkHandler),
+            (r"/watch/(.*)", h.WatchHandler),
         ]
 
+    def listen_server(self):
+        if self.sockets is None:
+            super(DiscoveryServer, self).listen_server()
+            return
+
+        self.http_server = HTTPServer(self, xheaders=True)
+        self.http_server.add_sockets(self.sockets)
+
     def get_internal_handler(self):
         return h.InternalHandler(self)
 
@@ -62,4 +94,8 @@ if __name__ == "__main__":
 
     stt = server.init()
     access.AccessToken.init([access.public()])
-    server.start(DiscoveryServer)
+
+    if options.discovery_workers > 1:
+        workers.start(DiscoveryServer, options.discovery_workers)
+    else:
+        server.start(DiscoveryServer)
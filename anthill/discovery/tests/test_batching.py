@@ -0,0 +1,57 @@
+from tornado.testing import gen_test
+
+import tornado.testing
+
+from anthill.discovery.model.batching import WriteCoalescer
+
+import asyncio
+
+
+class TestWriteCoalescer(tornado.testing.AsyncTestCase):
+    def create_coalescer(self, max_size=100):
+        self.batches = []
+
+        async def commit(batch):
+            self.batches.append(batch)
+
+        return WriteCoalescer(0.01, max_size, commit)
+
+    @gen_test
+    async def test_coalesced(self):
+        writes = self.create_coalescer()
+
+        await asyncio.gather(
+            writes.set("a", "internal", "http://a1", "alice"),
+            writes.set("a", "external", "https://a", "alice"),
+            writes.set("a", "internal", "http://a2", "alice"),
+            writes.set("b", "internal", "http://b", "bob"))
+
+        self.assertEqual(self.batches, [{
+            "a": ({"internal": "http://a2", "external": "https://a"}, "alice"),
+            "b": ({"internal": "http://b"}, "bob")
+        }])
+
+    @gen_test
+    async def test_author_changed(self):
+        writes = self.create_coalescer()
+
+        await asyncio.gather(
+            writes.set("a", "internal", "http://a1", "alice"),
+            writes.set("b", "internal", "http://b", "alice"),
+            writes.set("a", "internal", "http://a2", "bob"))
+
+        self.assertEqual(self.batches, [
+            {"a": ({"internal": "http://a1"}, "alice"), "b": ({"internal": "http://b"}, "alice")},
+            {"a": ({"internal": "http://a2"}, "bob")}
+        ])
+
+    @gen_test
+    async def test_max_size(self):
+        writes = self.create_coalescer(max_size=2)
+
+        await asyncio.gather(*[
+            writes.set("service-{0}".format(i), "internal", "http://x") for i in range(0, 5)
+        ])
+        await writes.stop()
+
+        self.assertEqual([len(batch) for batch in self.batches], [2, 2, 1])
@@ -0,0 +1,61 @@
+from anthill.discovery.model.cache import ServicesCache, EMPTY
+
+import unittest
+
+
+class TestServicesCache(unittest.TestCase):
+    def create_cache(self, **kwargs):
+        cache = ServicesCache(**kwargs)
+        cache.enabled = True
+        return cache
+
+    def test_found(self):
+        cache = self.create_cache()
+        cache.put("a", {"internal": "http://a"}, cache.generation)
+
+        self.assertEqual(dict(cache.get("a")), {"internal": "http://a"})
+        self.assertIsNone(cache.get("b"))
+
+        cache.invalidate("a")
+        self.assertIsNone(cache.get("a"))
+
+    def test_stale_put_dropped(self):
+        cache = self.create_cache()
+        generation = cache.generation
+
+        cache.invalidate("a")
+        cache.put("a", {"internal": "http://a"}, generation)
+
+        self.assertIsNone(cache.get("a"))
+
+    def test_missing_bounded(self):
+        cache = self.create_cache(missing_size=10)
+
+        for i in range(0, 1000):
+            cache.put("missing-{0}".format(i), {}, cache.generation)
+
+        self.assertEqual(len(cache.services), 0)
+        self.assertEqual(len(cache.missing), 10)
+
+        # the most recent ones are kept
+        self.assertIs(cache.get("missing-999"), EMPTY)
+        self.assertIsNone(cache.get("missing-0"))
+
+    def test_missing_expires(self):
+        cache = self.create_cache(missing_ttl=0)
+        cache.put("a", {}, cache.generation)
+
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache.missing), 0)
+
+    def test_missing_then_found(self):
+        cache = self.create_cache()
+        cache.put("a", {}, cache.generation)
+        self.assertIs(cache.get("a"), EMPTY)
+
+        cache.invalidate("a")
+        self.assertIsNone(cache.get("a"))
+
+        cache.put("a", {"internal": "http://a"}, cache.generation)
+        self.assertEqual(dict(cache.get("a")), {"internal": "http://a"})
+        self.assertEqual(cache.stats()["missing"], 0)
@@ -0,0 +1,136 @@
+from tornado.testing import gen_test
+
+import tornado.testing
+
+from anthill.common.options import options
+from anthill.discovery import options as _opts
+from anthill.discovery.model.discovery import DiscoveryModel, DiscoveryError
+
+from unittest import mock
+
+import ujson
+
+
+class TestDiscoveryModel(tornado.testing.AsyncTestCase):
+    """
+    The model over the memory storage. The changes made by "another replica" are written to the storage
+    directly, with no notification, which is then delivered by hand, in whatever order the case needs.
+    """
+
+    def setUp(self):
+        super(TestDiscoveryModel, self).setUp()
+
+        self.saved_options = {
+            name: getattr(options, name)
+            for name in ("discover_services_storage", "discover_services_file", "services_init_file",
+                         "discovery_snapshot_file", "discovery_write_batch_window", "discovery_endpoint_strategy")
+        }
+
+        options.discover_services_storage = "memory"
+        options.discover_services_file = ""
+        options.services_init_file = ""
+        options.discovery_snapshot_file = ""
+        options.discovery_write_batch_window = 0.0
+
+    def tearDown(self):
+        for name, value in self.saved_options.items():
+            setattr(options, name, value)
+
+        super(TestDiscoveryModel, self).tearDown()
+
+    async def start(self):
+        model = DiscoveryModel(None)
+        await model.storage.start()
+        return model
+
+    async def stop(self, model):
+        model.history.stop()
+        await model.storage.stop()
+
+    # noinspection PyMethodMayBeStatic
+    def remote_change(self, model, service_id, location):
+        """
+        Changes the service as another replica would, returns the version to notify about.
+        """
+        model.storage.__apply__(["location", service_id, "internal", location])
+        return model.storage.version
+
+    @gen_test
+    async def test_snapshot_late_invalidation(self):
+        model = await self.start()
+
+        try:
+            await model.set_service("x", "http://x1", "internal")
+            await model.get_snapshot("internal")
+
+            x = self.remote_change(model, "x", "http://x2")
+            y = self.remote_change(model, "y", "http://y")
+
+            # the later change is announced first, so the service x is still cached as it was
+            model.storage_changed("y", y)
+            version, body = await model.get_snapshot("internal")
+            self.assertEqual(version, y)
+
+            model.storage_changed("x", x)
+            version, body = await model.get_snapshot("internal")
+
+            self.assertEqual(version, y)
+            self.assertEqual(ujson.loads(body)["services"], {"x": "http://x2", "y": "http://y"})
+        finally:
+            await self.stop(model)
+
+    @gen_test
+    async def test_response_late_invalidation(self):
+        model = await self.start()
+
+        try:
+            await model.set_service("x", "http://x1", "internal")
+            await model.get_services_response(["x"], "internal")
+
+            x = self.remote_change(model, "x", "http://x2")
+            y = self.remote_change(model, "y", "http://y")
+
+            # the later change is announced first, so the service x is still cached as it was
+            model.storage_changed("y", y)
+            body, compression = await model.get_services_response(["x", "y"], "internal")
+            self.assertEqual(ujson.loads(body), {"x": "http://x1", "y": "http://y"})
+
+            model.storage_changed("x", x)
+            body, compression = await model.get_services_response(["x", "y"], "internal")
+            self.assertEqual(ujson.loads(body), {"x": "http://x2", "y": "http://y"})
+        finally:
+            await self.stop(model)
+
+    @gen_test
+    async def test_heartbeat_bad_ttl(self):
+        model = await self.start()
+
+        try:
+            version = await model.storage.get_version()
+
+            for ttl in (0, -10):
+                with self.assertRaises(DiscoveryError) as e:
+                    await model.heartbeat("x", "internal", "http://x", ttl=ttl)
+                self.assertEqual(e.exception.code, 400)
+
+            self.assertEqual(await model.storage.get_version(), version)
+            self.assertEqual(await model.storage.list_service_ids(), [])
+        finally:
+            await self.stop(model)
+
+    @gen_test
+    async def test_failure_of_unknown_location(self):
+        options.discovery_endpoint_strategy = "least_recently_failed"
+        model = await self.start()
+
+        try:
+            await model.set_service_endpoints("x", "internal", [{"location": "http://a"}, {"location": "http://b"}])
+
+            await model.report_failure("x", "internal", "http://a")
+            await model.report_failure("x", "internal", "http://made-up")
+            await model.report_failure("x", "external", "http://a")
+            await model.report_failure("made-up", "internal", "http://a")
+
+            self.assertEqual(model.strategy.failures, {("x", "internal"): {"http://a": mock.ANY}})
+        finally:
+            await self.stop(model)
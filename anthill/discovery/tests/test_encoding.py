@@ -0,0 +1,43 @@
+from anthill.discovery.model import encoding
+from anthill.discovery.model.encoding import negotiate, accepted, Encoding
+
+from unittest import mock
+
+import unittest
+
+
+# the negotiation only checks whether msgpack and brotli are installed
+@mock.patch.object(encoding, "msgpack", object())
+@mock.patch.object(encoding, "brotli", object())
+class TestNegotiate(unittest.TestCase):
+    def negotiate(self, accept, accept_encoding):
+        result = negotiate(accept, accept_encoding)
+        return result.format, result.compression
+
+    def test_accepted(self):
+        self.assertEqual(accepted("gzip, br;q=0.5, deflate;q=0, identity;q=x"), {
+            "gzip": 1.0, "br": 0.5, "deflate": 0.0, "identity": 0.0
+        })
+        self.assertEqual(accepted(None), {})
+
+    def test_default(self):
+        self.assertEqual(self.negotiate(None, None), (Encoding.JSON, None))
+        self.assertEqual(self.negotiate("*/*", "identity"), (Encoding.JSON, None))
+
+    def test_format(self):
+        self.assertEqual(self.negotiate("application/msgpack", None), (Encoding.MSGPACK, None))
+        self.assertEqual(self.negotiate("application/json, application/x-msgpack", None), (Encoding.MSGPACK, None))
+        self.assertEqual(self.negotiate("application/msgpack;q=0.5, application/json", None), (Encoding.JSON, None))
+        self.assertEqual(self.negotiate("application/msgpack;q=0, */*", None), (Encoding.JSON, None))
+        self.assertEqual(self.negotiate("application/msgpack;q=0", None), (Encoding.JSON, None))
+
+    def test_compression(self):
+        self.assertEqual(self.negotiate(None, "gzip, br"), (Encoding.JSON, Encoding.BROTLI))
+        self.assertEqual(self.negotiate(None, "br;q=0, gzip"), (Encoding.JSON, Encoding.GZIP))
+        self.assertEqual(self.negotiate(None, "br;q=0.5, gzip"), (Encoding.JSON, Encoding.GZIP))
+        self.assertEqual(self.negotiate(None, "br;q=0, *"), (Encoding.JSON, Encoding.GZIP))
+        self.assertEqual(self.negotiate(None, "gzip;q=0, br;q=0"), (Encoding.JSON, None))
+
+    def test_not_installed(self):
+        with mock.patch.object(encoding, "brotli", None), mock.patch.object(encoding, "msgpack", None):
+            self.assertEqual(self.negotiate("application/msgpack", "br, gzip;q=0.1"), (Encoding.JSON, Encoding.GZIP))
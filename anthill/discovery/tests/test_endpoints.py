@@ -0,0 +1,56 @@
+from anthill.discovery.model.endpoints import parse_endpoints, dump_endpoints, Endpoint, EndpointsError
+from anthill.discovery.model.endpoints import RoundRobinStrategy, LeastRecentlyFailedStrategy
+
+from unittest import mock
+
+import unittest
+
+
+class TestEndpoints(unittest.TestCase):
+    def locations(self, value):
+        return [(endpoint.location, endpoint.weight) for endpoint in parse_endpoints(value)]
+
+    def test_plain_location(self):
+        self.assertEqual(self.locations("http://a"), [("http://a", 1)])
+        self.assertEqual(self.locations("[::1]:9500"), [("[::1]:9500", 1)])
+        self.assertEqual(self.locations("[2001:db8::1]"), [("[2001:db8::1]", 1)])
+
+    def test_list(self):
+        value = '[{"location": "http://a", "weight": 2}, {"location": "http://b"}]'
+        self.assertEqual(self.locations(value), [("http://a", 2), ("http://b", 1)])
+
+        with self.assertRaises(EndpointsError):
+            parse_endpoints('[{"weight": 2}]')
+
+    def test_dump(self):
+        self.assertEqual(dump_endpoints([Endpoint("http://a")]), "http://a")
+
+        for location in ("[::1]:9500", "[1]"):
+            value = dump_endpoints([Endpoint(location)])
+            self.assertNotEqual(value, location)
+            self.assertEqual(self.locations(value), [(location, 1)])
+
+
+class TestStrategies(unittest.TestCase):
+    def test_round_robin_forgets(self):
+        strategy = RoundRobinStrategy()
+        endpoints = [Endpoint("http://a"), Endpoint("http://b")]
+
+        self.assertEqual(strategy.select(("x", "internal"), endpoints).location, "http://a")
+        self.assertEqual(strategy.select(("x", "internal"), endpoints).location, "http://b")
+
+        strategy.changed("x")
+        self.assertEqual(strategy.counters, {})
+
+    def test_old_failures_pruned(self):
+        strategy = LeastRecentlyFailedStrategy()
+
+        with mock.patch("time.time", return_value=1000):
+            strategy.failed(("x", "internal"), "http://a")
+            strategy.failed(("y", "internal"), "http://b")
+
+        with mock.patch("time.time", return_value=1000 + LeastRecentlyFailedStrategy.FAILURE_TIMEOUT * 2):
+            strategy.failed(("y", "internal"), "http://c")
+
+        self.assertEqual(list(strategy.failures.keys()), [("y", "internal")])
+        self.assertEqual(list(strategy.failures[("y", "internal")].keys()), ["http://c"])
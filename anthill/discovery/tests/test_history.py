@@ -0,0 +1,98 @@
+from tornado.testing import gen_test
+
+import tornado.testing
+
+from anthill.common.options import options
+from anthill.discovery import options as _opts
+from anthill.discovery.model.history import ChangeHistory, HistoryError
+from anthill.discovery.model.storage.memory import MemoryServicesStorage
+
+from . test_storage import RecordingListener
+
+
+class TestChangeHistory(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super(TestChangeHistory, self).setUp()
+        self.services_file, options.discover_services_file = options.discover_services_file, ""
+
+    def tearDown(self):
+        options.discover_services_file = self.services_file
+        super(TestChangeHistory, self).tearDown()
+
+    async def start(self):
+        storage = MemoryServicesStorage(RecordingListener())
+        await storage.start()
+        return storage, ChangeHistory(storage, 0, 2)
+
+    async def change(self, storage, history, service_id, networks):
+        old, = await storage.get_static_services([service_id])
+        versions = await storage.set_networks({service_id: networks})
+        await history.record("test", [(service_id, old, networks, versions[service_id])])
+        return versions[service_id]
+
+    @gen_test
+    async def test_state_at(self):
+        storage, history = await self.start()
+
+        try:
+            first = await self.change(storage, history, "a", {"internal": "http://a1"})
+            second = await self.change(storage, history, "b", {"internal": "http://b1"})
+            third = await self.change(storage, history, "a", {"internal": "http://a2"})
+
+            self.assertEqual(await history.state_at(first), {"a": {"internal": "http://a1"}})
+            self.assertEqual(await history.state_at(second), {
+                "a": {"internal": "http://a1"}, "b": {"internal": "http://b1"}})
+            self.assertEqual(await history.state_at(third), {
+                "a": {"internal": "http://a2"}, "b": {"internal": "http://b1"}})
+        finally:
+            await storage.stop()
+
+    @gen_test
+    async def test_partial_snapshot(self):
+        storage, history = await self.start()
+
+        try:
+            first = await self.change(storage, history, "a", {"internal": "http://a1"})
+
+            # read at the first version, while the second change has been made
+            await storage.put_history_snapshot(first, {"a": {"internal": "http://a2"}}, first + 1)
+            second = await self.change(storage, history, "a", {"internal": "http://a2"})
+            third = await self.change(storage, history, "b", {"internal": "http://b1"})
+
+            # the snapshot has a change too new for the first version, so it can't be used for it
+            self.assertEqual(await history.state_at(first), {"a": {"internal": "http://a1"}})
+            self.assertEqual(await history.state_at(second), {"a": {"internal": "http://a2"}})
+            self.assertEqual(await history.state_at(third), {
+                "a": {"internal": "http://a2"}, "b": {"internal": "http://b1"}})
+        finally:
+            await storage.stop()
+
+    @gen_test
+    async def test_trimmed(self):
+        storage, history = await self.start()
+
+        try:
+            first = await self.change(storage, history, "a", {"internal": "http://a1"})
+            second = await self.change(storage, history, "a", {"internal": "http://a2"})
+            await storage.trim_history(second)
+
+            with self.assertRaises(HistoryError):
+                await history.state_at(first)
+        finally:
+            await storage.stop()
+
+    @gen_test
+    async def test_not_there_yet(self):
+        storage, history = await self.start()
+
+        try:
+            first = await self.change(storage, history, "a", {"internal": "http://a1"})
+            await storage.put_history_snapshot(first, {"a": {"internal": "http://a1"}}, first)
+
+            # a snapshot at or before the version must not make it look like it's there
+            with self.assertRaises(HistoryError):
+                await history.state_at(first + 1)
+
+            self.assertEqual(await history.state_at(first), {"a": {"internal": "http://a1"}})
+        finally:
+            await storage.stop()
@@ -0,0 +1,387 @@
+from tornado.testing import gen_test
+
+import tornado.testing
+
+from anthill.common.options import options
+from anthill.discovery import options as _opts
+from anthill.discovery.model.endpoints import Endpoint
+from anthill.discovery.model.storage import StorageListener
+from anthill.discovery.model.storage.memory import MemoryServicesStorage
+from anthill.discovery.model.storage.redis import RedisServicesStorage
+
+import asyncio
+import tempfile
+import unittest
+import time
+import os
+
+# the Redis database the storage tests wipe clean, so point it to one not used for anything else
+TEST_REDIS_DB = int(os.environ.get("DISCOVERY_TEST_REDIS_DB", 15))
+
+
+class RecordingListener(StorageListener):
+    def __init__(self):
+        self.connected = None
+        self.changes = []
+
+    def storage_connected(self, version):
+        self.connected = version
+
+    def storage_changed(self, service_id, version):
+        self.changes.append((service_id, version))
+
+    def storage_disconnected(self):
+        self.connected = None
+
+
+class StorageConformance(object):
+    """
+    The cases every storage has to pass. Mixed into a test case per storage, which implements create_storage.
+    """
+
+    # noinspection PyMethodMayBeStatic
+    def create_storage(self, listener):
+        raise NotImplementedError()
+
+    def setUp(self):
+        super(StorageConformance, self).setUp()
+
+        self.saved_options = {
+            name: getattr(options, name)
+            for name in ("discovery_heartbeat_expire_interval", "discover_services_file", "discover_services_db")
+        }
+
+        options.discovery_heartbeat_expire_interval = 0.1
+        options.discover_services_file = ""
+        options.discover_services_db = TEST_REDIS_DB
+
+    def tearDown(self):
+        for name, value in self.saved_options.items():
+            setattr(options, name, value)
+
+        super(StorageConformance, self).tearDown()
+
+    async def start(self):
+        listener = RecordingListener()
+        storage = self.create_storage(listener)
+        await storage.start()
+
+        # the redis storage reports connected once the invalidations channel is subscribed
+        for i in range(0, 50):
+            if listener.connected is not None:
+                break
+            await asyncio.sleep(0.05)
+
+        self.assertIsNotNone(listener.connected, "Storage has not connected")
+        return storage, listener
+
+    async def stop(self, storage):
+        await storage.stop()
+
+    @gen_test
+    async def test_networks(self):
+        storage, listener = await self.start()
+
+        try:
+            await storage.set_location("a", "internal", "http://a")
+            await storage.set_networks({"b": {"internal": "http://b", "external": "https://b"}})
+
+            self.assertEqual(await storage.get_services(["a", "b", "c"]), [
+                {"internal": "http://a"},
+                {"internal": "http://b", "external": "https://b"},
+                {}
+            ])
+            self.assertEqual(sorted(await storage.list_service_ids()), ["a", "b"])
+            self.assertEqual(await storage.count_services(), 2)
+
+            await storage.delete_network("b", "external")
+            self.assertEqual(await storage.get_static_services(["b"]), [{"internal": "http://b"}])
+
+            await storage.delete_network("b", "internal")
+            await storage.delete_service("a")
+
+            self.assertEqual(await storage.get_services(["a", "b"]), [{}, {}])
+            self.assertEqual(await storage.count_services(), 0)
+            self.assertEqual(await storage.scan_service_ids(), [])
+        finally:
+            await self.stop(storage)
+
+    @gen_test
+    async def test_set_networks_swaps(self):
+        storage, listener = await self.start()
+
+        try:
+            await storage.set_networks({"a": {"internal": "http://a", "external": "https://a"}})
+            versions = await storage.set_networks({"a": {"broker": "amqp://a"}, "b": {}})
+
+            self.assertEqual(sorted(versions.keys()), ["a", "b"])
+            self.assertEqual(await storage.get_services(["a"]), [{"broker": "amqp://a"}])
+
+            await storage.set_networks({"a": {}})
+            self.assertEqual(await storage.list_service_ids(), [])
+        finally:
+            await self.stop(storage)
+
+    @gen_test
+    async def test_live_service_keeps_listed(self):
+        storage, listener = await self.start()
+
+        try:
+            await storage.set_location("a", "internal", "http://static")
+            await storage.heartbeat("a", "internal", Endpoint("http://live"), time.time() + 60)
+
+            # the static networks are gone, the registered endpoints are still there
+            await storage.set_networks({"a": {}})
+
+            self.assertEqual(await storage.list_service_ids(), ["a"])
+            self.assertEqual(await storage.scan_service_ids(), ["a"])
+            self.assertEqual(await storage.get_static_services(["a"]), [{}])
+        finally:
+            await self.stop(storage)
+
+    @gen_test
+    async def test_tags_of_removed_services(self):
+        storage, listener = await self.start()
+
+        try:
+            await storage.set_networks({service_id: {"internal": "http://x"} for service_id in ("a", "b", "c", "d")})
+            await storage.heartbeat("e", "internal", Endpoint("http://e"), time.time() + 0.3)
+
+            for service_id in ("a", "b", "c", "d", "e"):
+                await storage.set_tags(service_id, ["eu"])
+
+            await storage.set_networks({"a": {}})
+            await storage.delete_network("b", "internal")
+            await storage.delete_service("c")
+            await asyncio.sleep(0.8)
+
+            self.assertEqual(await storage.scan_service_ids(tag="eu"), ["d"])
+            self.assertEqual(await storage.get_tags(["a", "b", "c", "d", "e"]), [[], [], [], ["eu"], []])
+        finally:
+            await self.stop(storage)
+
+    @gen_test
+    async def test_versions_and_notifications(self):
+        storage, listener = await self.start()
+
+        try:
+            start = await storage.get_version()
+
+            first = await storage.set_location("a", "internal", "http://a")
+            second = await storage.set_locations({"a": {"external": "https://a"}, "b": {"internal": "http://b"}})
+            third = await storage.delete_service("b")
+
+            self.assertEqual(first, start + 1)
+            self.assertEqual(sorted(second.values()), [start + 2, start + 3])
+            self.assertEqual(third, start + 4)
+            self.assertEqual(await storage.get_version(), start + 4)
+
+            notified = set(listener.changes)
+            self.assertIn(("a", first), notified)
+            self.assertIn(("a", second["a"]), notified)
+            self.assertIn(("b", second["b"]), notified)
+            self.assertIn(("b", third), notified)
+        finally:
+            await self.stop(storage)
+
+    @gen_test
+    async def test_heartbeat_expiry(self):
+        storage, listener = await self.start()
+
+        try:
+            await storage.set_location("a", "internal", "http://static")
+
+            version = await storage.heartbeat("a", "internal", Endpoint("http://live", 2), time.time() + 0.3)
+            self.assertTrue(version)
+            self.assertIn(("a", version), listener.changes)
+
+            # the same endpoint again changes nothing, so the version stays
+            self.assertFalse(await storage.heartbeat("a", "internal", Endpoint("http://live", 2), time.time() + 0.3))
+
+            # a service only registered with heartbeats exists as long as its endpoints do
+            await storage.heartbeat("b", "internal", Endpoint("http://b"), time.time() + 0.3)
+
+            a, b = await storage.get_services(["a", "b"])
+            self.assertIn("http://live", a["internal"])
+            self.assertIn("http://static", a["internal"])
+            self.assertIn("http://b", b["internal"])
+            self.assertEqual(await storage.get_static_services(["a"]), [{"internal": "http://static"}])
+            self.assertEqual(await storage.scan_service_ids(), ["a", "b"])
+
+            await asyncio.sleep(0.8)
+
+            self.assertEqual(await storage.get_services(["a", "b"]), [{"internal": "http://static"}, {}])
+            self.assertEqual(await storage.scan_service_ids(), ["a"])
+            self.assertGreater(await storage.get_version(), version)
+        finally:
+            await self.stop(storage)
+
+    @gen_test
+    async def test_scan_paging(self):
+        storage, listener = await self.start()
+
+        try:
+            service_ids = ["-", "a", "game-0", "game-1", "game-2", "game-3", "game-4", "gamer", "z"]
+            await storage.set_networks({service_id: {"internal": "http://x"} for service_id in service_ids})
+
+            self.assertEqual(await storage.scan_service_ids(), service_ids)
+
+            pages = []
+            after = None
+
+            while True:
+                page = await storage.scan_service_ids(prefix="game-", after=after, limit=2)
+                if not page:
+                    break
+                pages.append(page)
+                after = page[-1]
+
+            self.assertEqual(pages, [["game-0", "game-1"], ["game-2", "game-3"], ["game-4"]])
+
+            self.assertEqual(await storage.scan_service_ids(prefix="game", after="game-4"), ["gamer"])
+            self.assertEqual(await storage.scan_service_ids(prefix="game-", after="a"), ["game-0", "game-1", "game-2",
+                                                                                         "game-3", "game-4"])
+            self.assertEqual(await storage.scan_service_ids(prefix="x"), [])
+
+            # "-" and "+" are the open ends of a Redis lex range, but not here
+            self.assertEqual(await storage.scan_service_ids(prefix="-"), ["-"])
+            self.assertEqual(await storage.scan_service_ids(after="-", limit=1), ["a"])
+
+            await storage.set_tags("game-1", ["eu", "pvp"])
+            await storage.set_tags("gamer", ["eu"])
+
+            self.assertEqual(await storage.scan_service_ids(tag="eu"), ["game-1", "gamer"])
+            self.assertEqual(await storage.scan_service_ids(prefix="game-", tag="eu"), ["game-1"])
+            self.assertEqual(await storage.get_tags(["game-1", "a"]), [["eu", "pvp"], []])
+
+            await storage.set_tags("game-1", [])
+            self.assertEqual(await storage.scan_service_ids(tag="pvp"), [])
+        finally:
+            await self.stop(storage)
+
+
+    @gen_test
+    async def test_registry_and_snapshots(self):
+        storage, listener = await self.start()
+
+        try:
+            await storage.set_networks({
+                "service-{0}".format(i): {"internal": "http://{0}".format(i)}
+                for i in range(0, 1200)
+            })
+            await storage.heartbeat("live", "internal", Endpoint("http://live"), time.time() + 60)
+
+            version, services = await storage.get_registry()
+
+            self.assertEqual(version, await storage.get_version())
+            self.assertEqual(len(services), 1200)
+            self.assertEqual(services["service-7"], {"internal": "http://7"})
+
+            await storage.put_history_snapshot(version, {"a": {"internal": "http://a"}}, version + 2)
+            await storage.put_history_snapshot(version + 5, {}, version + 5)
+
+            self.assertEqual(await storage.list_history_snapshots(), [version, version + 5])
+            self.assertEqual(await storage.get_history_snapshot(version), ({"a": {"internal": "http://a"}}, version + 2))
+            self.assertIsNone(await storage.get_history_snapshot(version + 1))
+
+            await storage.trim_history(version + 5)
+            self.assertEqual(await storage.list_history_snapshots(), [version + 5])
+            self.assertEqual(await storage.get_history_start(), version + 5)
+        finally:
+            await self.stop(storage)
+
+
+class TestMemoryServicesStorage(StorageConformance, tornado.testing.AsyncTestCase):
+    def create_storage(self, listener):
+        return MemoryServicesStorage(listener)
+
+    @gen_test
+    async def test_replay_and_compaction(self):
+        with tempfile.TemporaryDirectory() as directory:
+            options.discover_services_file = os.path.join(directory, "services.log")
+
+            storage, listener = await self.start()
+
+            await storage.set_location("a", "internal", "http://a1")
+            await storage.set_location("a", "internal", "http://a2")
+            await storage.set_networks({"b": {"internal": "http://b"}, "c": {"internal": "http://c"}})
+            await storage.delete_network("c", "internal")
+            await storage.set_tags("b", ["eu"])
+            await storage.heartbeat("b", "external", Endpoint("https://b"), time.time() + 60)
+            version = await storage.get_version()
+
+            await self.stop(storage)
+
+            with open(options.discover_services_file) as f:
+                self.assertEqual(len(f.readlines()), 8)
+
+            storage, listener = await self.start()
+
+            try:
+                self.assertEqual(listener.connected, version)
+                # the registered endpoints are not persisted
+                self.assertEqual(await storage.get_services(["a", "b", "c"]), [
+                    {"internal": "http://a2"}, {"internal": "http://b"}, {}
+                ])
+                self.assertEqual(await storage.get_tags(["b"]), [["eu"]])
+                self.assertEqual(await storage.scan_service_ids(), ["a", "b"])
+            finally:
+                await self.stop(storage)
+
+            # compacted on start: a record per service, one for the tags, and the version
+            with open(options.discover_services_file) as f:
+                self.assertEqual(len(f.readlines()), 4)
+
+    @gen_test
+    async def test_corrupted_log_tail(self):
+        with tempfile.TemporaryDirectory() as directory:
+            options.discover_services_file = os.path.join(directory, "services.log")
+
+            storage, listener = await self.start()
+            await storage.set_location("a", "internal", "http://a")
+            await self.stop(storage)
+
+            with open(options.discover_services_file, "a") as f:
+                f.write('["location", "b", "inter')
+
+            storage, listener = await self.start()
+
+            try:
+                self.assertEqual(await storage.list_service_ids(), ["a"])
+            finally:
+                await self.stop(storage)
+
+
+class TestRedisServicesStorage(StorageConformance, tornado.testing.AsyncTestCase):
+    """
+    Runs against the Redis of --discover_services_host/port, database TEST_REDIS_DB (wiped clean before
+    every case); skipped if there is none. A fake Redis won't do, the storage relies on Lua scripts.
+    """
+
+    def setUp(self):
+        super(TestRedisServicesStorage, self).setUp()
+
+        try:
+            self.io_loop.run_sync(self.flush, timeout=2)
+        except Exception as e:
+            self.tearDown()
+            raise unittest.SkipTest("Redis is not available: {0}".format(str(e)))
+
+    async def flush(self):
+        storage = RedisServicesStorage(RecordingListener())
+
+        try:
+            async with storage.kv.acquire() as db:
+                await db.flushdb()
+        finally:
+            storage.kv.connection_pool.close()
+            await storage.kv.connection_pool.wait_closed()
+
+    def create_storage(self, listener):
+        return RedisServicesStorage(listener)
+
+    async def stop(self, storage):
+        await storage.stop()
+
+        storage.kv.connection_pool.close()
+        await storage.kv.connection_pool.wait_closed()
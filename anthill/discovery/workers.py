@@ -0,0 +1,70 @@
+
+from anthill.common.options import options
+from anthill.common.server import ServerError
+
+from tornado.netutil import bind_sockets, bind_unix_socket
+from tornado.process import fork_processes
+
+import tempfile
+import logging
+import os
+
+
+# the worker process that reads the registry from Redis and publishes the snapshot for the others
+LEADER = 0
+
+
+def bind_listen_sockets(listen):
+    """
+    Binds the sockets described as in the "listen" option, so they can be shared by the worker processes.
+    """
+    listen_group = listen.split(":")
+
+    if len(listen_group) < 2:
+        raise ServerError("Failed to listen on " + listen + ": bad format")
+
+    kind, addresses = listen_group[0], listen_group[1:]
+
+    sockets = []
+
+    if kind == "port":
+        for port in addresses:
+            sockets.extend(bind_sockets(int(port), "127.0.0.1"))
+    elif kind == "unix":
+        for path in addresses:
+            sockets.append(bind_unix_socket(path, mode=0o777))
+    else:
+        raise ServerError("Failed to listen on " + listen + ": unsupported kind")
+
+    return sockets
+
+
+def start(server_cls, workers):
+    """
+    Forks the worker processes, all accepting connections on the same sockets. The leader reads the registry
+    from the storage as usual, and shares it with the others through a memory-mapped snapshot file,
+    so the reads scale with the workers without querying Redis any more than a single process would.
+    The processes that die are restarted.
+    """
+    if options.discover_services_storage != "redis":
+        raise ServerError("Several worker processes can only share the redis storage")
+
+    sockets = bind_listen_sockets(options.listen)
+
+    if not options.discovery_snapshot_file:
+        options.discovery_snapshot_file = os.path.join(
+            tempfile.gettempdir(), "anthill-discovery-{0}.snapshot".format(os.getpid()))
+
+    logging.info("Starting {0} worker processes, sharing the registry through {1}".format(
+        workers, options.discovery_snapshot_file))
+
+    worker_id = fork_processes(workers)
+
+    if worker_id != LEADER:
+        options.discover_services_storage = "snapshot"
+        # the database is only initialized once, by the leader
+        options.services_init_file = ""
+
+    application = server_cls()
+    application.sockets = sockets
+    application.run()
@@ -0,0 +1,174 @@
+"""
+Latency and throughput of the discovery endpoints.
+
+Serves the real handlers (DiscoveryServer.get_handlers) over HTTP on localhost and hits them with
+a number of concurrent clients. The in-memory storage stands in for Redis by default, so the numbers
+show the cost of the service itself; pass --bench_storage=redis to include a real Redis.
+
+    python benchmarks/endpoints.py --bench_output=bench_results.json
+
+Reports p50/p99 latency and requests per second for every scenario, and writes the same
+into the output file as JSON, so the runs can be compared.
+"""
+
+from anthill.common.options import options, define
+from anthill.common import server
+from anthill.discovery.server import DiscoveryServer
+from anthill.discovery.model.discovery import DiscoveryModel
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+
+from stats import summarize, print_results
+from urllib.parse import urlencode
+
+import asyncio
+import datetime
+import time
+import ujson
+
+define("bench_storage",
+       default="memory",
+       help="Storage to run the benchmark against: memory or redis.",
+       type=str)
+
+define("bench_services",
+       default=1000,
+       help="Number of services in the registry.",
+       type=int)
+
+define("bench_requests",
+       default=2000,
+       help="Requests to make for each scenario.",
+       type=int)
+
+define("bench_concurrency",
+       default=50,
+       help="Number of concurrent clients.",
+       type=int)
+
+define("bench_multi_counts",
+       default="1,10,50,100,500",
+       help="Comma-separated numbers of services to look up at once in the multi lookup scenarios.",
+       type=str)
+
+define("bench_output",
+       default="bench_results.json",
+       help="File to write the results to.",
+       type=str)
+
+
+async def measure(name, client, make_request, total, concurrency):
+    """
+    Makes `total` requests, `concurrency` at once; make_request(i) returns a HTTPRequest for i-th request.
+    """
+    samples = []
+    errors = 0
+    counter = iter(range(0, total))
+
+    async def worker():
+        nonlocal errors
+
+        for i in counter:
+            request = make_request(i)
+            started = time.perf_counter()
+
+            try:
+                await client.fetch(request)
+            except HTTPError:
+                errors += 1
+            else:
+                samples.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(0, concurrency)])
+
+    return summarize(name, samples, time.perf_counter() - started, errors=errors)
+
+
+def service_id(i):
+    return "bench-{0}".format(i % options.bench_services)
+
+
+async def populate(services):
+    await services.set_services_networks({
+        service_id(i): {
+            DiscoveryModel.INTERNAL: "http://10.0.0.{0}:9500".format(i % 250),
+            DiscoveryModel.EXTERNAL: "https://bench-{0}.example.com".format(i)
+        }
+        for i in range(0, options.bench_services)
+    })
+
+
+async def run():
+    options.discover_services_storage = options.bench_storage
+    options.discover_services_file = ""
+    options.services_init_file = ""
+
+    application = DiscoveryServer()
+    services = application.services
+
+    await services.started(application)
+    await populate(services)
+
+    sockets = bind_sockets(0, "127.0.0.1")
+    port = sockets[0].getsockname()[1]
+
+    http_server = HTTPServer(application)
+    http_server.add_sockets(sockets)
+
+    base = "http://127.0.0.1:{0}".format(port)
+    client = AsyncHTTPClient(max_clients=options.bench_concurrency)
+
+    total = options.bench_requests
+    concurrency = options.bench_concurrency
+    results = []
+
+    def get(path):
+        return HTTPRequest(base + path, method="GET")
+
+    results.append(await measure(
+        "single lookup", client,
+        lambda i: get("/service/" + service_id(i)), total, concurrency))
+
+    results.append(await measure(
+        "single lookup (internal)", client,
+        lambda i: get("/service/" + service_id(i) + "/internal"), total, concurrency))
+
+    for count in [int(c) for c in options.bench_multi_counts.split(",")]:
+        results.append(await measure(
+            "multi lookup x{0}".format(count), client,
+            lambda i, n=count: get("/services/" + ",".join(service_id(i + j) for j in range(0, n))),
+            total, concurrency))
+
+    results.append(await measure(
+        "full listing", client,
+        lambda i: get("/@services/internal"), max(total // 10, 1), concurrency))
+
+    results.append(await measure(
+        "concurrent writes", client,
+        lambda i: HTTPRequest(
+            base + "/@service/" + service_id(i) + "/internal", method="POST",
+            body=urlencode({"location": "http://10.0.1.{0}:9500".format(i % 250)})),
+        total, concurrency))
+
+    http_server.stop()
+    await services.stopped()
+
+    print_results(results)
+
+    with open(options.bench_output, "w") as f:
+        ujson.dump({
+            "date": datetime.datetime.utcnow().isoformat(),
+            "storage": options.bench_storage,
+            "services": options.bench_services,
+            "concurrency": concurrency,
+            "results": results
+        }, f, indent=2)
+
+
+if __name__ == "__main__":
+    server.init()
+    IOLoop.current().run_sync(run)
@@ -0,0 +1,66 @@
+"""
+Measures DiscoveryModel.list_services latency as the number of requested services grows.
+
+Runs against a real Redis; the benchmark writes services named "bench-<N>" into the database
+given and deletes them afterwards, so point it to a database not used for anything else.
+
+    python benchmarks/list_services.py --discover_services_db=14
+
+The in-process cache is left disabled, so every lookup goes to Redis.
+"""
+
+from anthill.common.options import options, define
+from anthill.common import server
+from anthill.discovery import options as _opts
+from anthill.discovery.model.discovery import DiscoveryModel
+
+from tornado.ioloop import IOLoop
+
+from stats import percentile
+
+import time
+
+define("bench_counts",
+       default="1,10,50,100,500,1000",
+       help="Comma-separated numbers of services to look up at once.",
+       type=str)
+
+define("bench_iterations",
+       default=200,
+       help="Lookups to measure for each number of services.",
+       type=int)
+
+
+async def run():
+    model = DiscoveryModel(None)
+    counts = [int(count) for count in options.bench_counts.split(",")]
+    service_ids = ["bench-{0}".format(i) for i in range(0, max(counts))]
+
+    for service_id in service_ids:
+        await model.set_service_networks(service_id, {
+            DiscoveryModel.INTERNAL: "http://10.0.0.1/" + service_id,
+            DiscoveryModel.EXTERNAL: "http://example.com/" + service_id
+        })
+
+    try:
+        print("{0:>8} {1:>12} {2:>12}".format("services", "p50, ms", "p99, ms"))
+
+        for count in counts:
+            ids = service_ids[:count]
+            samples = []
+
+            for i in range(0, options.bench_iterations):
+                started = time.perf_counter()
+                await model.list_services(ids, DiscoveryModel.INTERNAL)
+                samples.append((time.perf_counter() - started) * 1000.0)
+
+            print("{0:>8} {1:>12.3f} {2:>12.3f}".format(
+                count, percentile(samples, 0.5), percentile(samples, 0.99)))
+    finally:
+        for service_id in service_ids:
+            await model.delete_service(service_id)
+
+
+if __name__ == "__main__":
+    server.init()
+    IOLoop.current().run_sync(run)
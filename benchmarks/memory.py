@@ -0,0 +1,110 @@
+"""
+Memory taken by the in-process cache of the registry, per service, compared to plain dicts.
+
+No Redis needed: the services are made up as raw replies, decoded the way the storage does it
+(every string on its own, as it comes off the wire), then kept both as dicts and as the entries of ServicesCache.
+
+    python benchmarks/memory.py --bench_services=10000 --bench_networks=3
+
+Reports the bytes taken per service, and the time of a single location lookup, for either.
+"""
+
+from anthill.common.options import options, define
+from anthill.common import server
+from anthill.discovery.model.cache import ServicesCache
+
+from stats import percentile
+
+import tracemalloc
+import time
+
+define("bench_services",
+       default=10000,
+       help="Number of services in the registry.",
+       type=int)
+
+define("bench_networks",
+       default=3,
+       help="Number of networks of each service.",
+       type=int)
+
+define("bench_lookups",
+       default=200000,
+       help="Location lookups to measure for each representation.",
+       type=int)
+
+
+def fetched():
+    """
+    Yields (service_id, [(network, location), ...]) as raw replies, decoded while measured.
+    """
+    networks = ["internal", "external", "broker", "private", "public"][:options.bench_networks]
+
+    for i in range(0, options.bench_services):
+        yield "service-{0}".format(i).encode("utf-8"), [
+            (network.encode("utf-8"), "http://10.0.{0}.{1}:9500/{2}".format(i // 250, i % 250, network).encode("utf-8"))
+            for network in networks
+        ]
+
+
+def decode(networks):
+    return {network.decode("utf-8"): location.decode("utf-8") for network, location in networks}
+
+
+def measure(build):
+    services = list(fetched())
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    registry = build(services)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    return registry, size
+
+
+def build_dicts(services):
+    return {service_id.decode("utf-8"): decode(networks) for service_id, networks in services}
+
+
+def build_cache(services):
+    cache = ServicesCache()
+    cache.enabled = True
+
+    for service_id, networks in services:
+        cache.put(service_id.decode("utf-8"), decode(networks), cache.generation)
+
+    return cache.services
+
+
+def lookups(registry):
+    service_ids = list(registry.keys())
+    count = len(service_ids)
+    samples = []
+
+    for batch in range(0, options.bench_lookups // 1000):
+        started = time.perf_counter()
+
+        for i in range(batch * 1000, batch * 1000 + 1000):
+            registry[service_ids[i % count]].get("internal")
+
+        samples.append((time.perf_counter() - started) * 1000000.0 / 1000)
+
+    return samples
+
+
+def run():
+    print("{0:<12} {1:>16} {2:>16} {3:>16}".format("registry", "bytes/service", "p50 lookup, us", "p99 lookup, us"))
+
+    for name, build in (("dicts", build_dicts), ("entries", build_cache)):
+        # the strings themselves are taken by both, only the structure around them is compared
+        registry, size = measure(build)
+        samples = lookups(registry)
+
+        print("{0:<12} {1:>16.1f} {2:>16.3f} {3:>16.3f}".format(
+            name, float(size) / options.bench_services, percentile(samples, 0.5), percentile(samples, 0.99)))
+
+
+if __name__ == "__main__":
+    server.init()
+    run()
@@ -0,0 +1,432 @@
+"""
+Soak test: how a discovery node holds up over a long run with a fleet of simulated clients.
+
+Serves the real application (DiscoveryServer) over HTTP on localhost, the in-memory storage standing in
+for Redis by default (pass --bench_storage=redis to include a real one). Every simulated client picks
+an operation out of the traffic profile, makes it, and waits for a random (exponential) think time:
+
+    single    GET /service/<id>
+    multi     GET /services/<id>,<id>,...
+    listing   GET /@services/internal
+    churn     set_service_networks of a random service, as the admin tool does it
+
+    python benchmarks/soak.py --bench_duration=3600 --bench_clients=2000 --bench_profile=mixed --logging=warning
+
+Every --bench_interval seconds, a line is printed (and appended to the output file as JSON) with the latency
+percentiles and errors of each operation over the interval, the event loop lag, and the memory taken
+by the process. Latencies include the time a request waits for a free client connection.
+
+Once done, the run is checked for regressions: memory growth after the warm-up, the event loop lag, the error
+rate, and (given --bench_baseline, the output file of an earlier run) p99 latencies worse than that run's.
+Each one found is printed, and the exit code is 1.
+"""
+
+from anthill.common.options import options, define
+from anthill.common import server
+from anthill.discovery.server import DiscoveryServer
+from anthill.discovery.model.discovery import DiscoveryModel, DiscoveryError
+from anthill.discovery.model.admission import Overloaded
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+
+from stats import percentile
+
+import asyncio
+import datetime
+import resource
+import random
+import time
+import ujson
+import sys
+
+define("bench_storage",
+       default="memory",
+       help="Storage to run the soak test against: memory or redis.",
+       type=str)
+
+define("bench_services",
+       default=5000,
+       help="Number of services in the registry.",
+       type=int)
+
+define("bench_clients",
+       default=1000,
+       help="Number of simulated clients.",
+       type=int)
+
+define("bench_connections",
+       default=200,
+       help="Maximum number of HTTP connections the clients share.",
+       type=int)
+
+define("bench_think_time",
+       default=1.0,
+       help="Mean time (in seconds) a client waits between its operations.",
+       type=float)
+
+define("bench_profile",
+       default="mixed",
+       help="Traffic profile: read-heavy, mixed or churn.",
+       type=str)
+
+define("bench_mix",
+       default="",
+       help="Custom traffic mix overriding the profile, like single=70,multi=20,listing=2,churn=8.",
+       type=str)
+
+define("bench_multi_size",
+       default=20,
+       help="Number of services looked up at once by a multi lookup.",
+       type=int)
+
+define("bench_duration",
+       default=600,
+       help="How long (in seconds) to run for, the warm-up included.",
+       type=int)
+
+define("bench_warmup",
+       default=60,
+       help="How long (in seconds) to run before the memory taken is considered settled.",
+       type=int)
+
+define("bench_interval",
+       default=10,
+       help="How often (in seconds) the stats are reported.",
+       type=int)
+
+define("bench_output",
+       default="soak_results.jsonl",
+       help="File to write the stats to, a JSON per line.",
+       type=str)
+
+define("bench_baseline",
+       default="",
+       help="Output file of an earlier run to compare the latencies with.",
+       type=str)
+
+define("bench_max_memory_growth",
+       default=64.0,
+       help="Memory growth (in MB) after the warm-up considered a regression.",
+       type=float)
+
+define("bench_max_loop_lag",
+       default=100.0,
+       help="p99 event loop lag (in ms) over an interval considered a regression.",
+       type=float)
+
+define("bench_max_error_rate",
+       default=0.001,
+       help="Share of failed operations considered a regression.",
+       type=float)
+
+define("bench_max_slowdown",
+       default=0.25,
+       help="How much worse (as a share) a p99 latency may be than the baseline's before it is a regression.",
+       type=float)
+
+
+PROFILES = {
+    "read-heavy": {"single": 80, "multi": 15, "listing": 1, "churn": 4},
+    "mixed": {"single": 60, "multi": 25, "listing": 5, "churn": 10},
+    "churn": {"single": 40, "multi": 10, "listing": 5, "churn": 45}
+}
+
+OPERATIONS = ["single", "multi", "listing", "churn"]
+
+# how often the event loop lag is sampled
+LAG_INTERVAL = 0.05
+
+
+def traffic_mix():
+    if options.bench_mix:
+        mix = {}
+
+        for part in options.bench_mix.split(","):
+            operation, weight = part.split("=")
+            if operation not in OPERATIONS:
+                raise ValueError("Unknown operation: {0}".format(operation))
+            mix[operation] = float(weight)
+
+        return mix
+
+    mix = PROFILES.get(options.bench_profile)
+
+    if mix is None:
+        raise ValueError("Unknown profile: {0}".format(options.bench_profile))
+
+    return mix
+
+
+def service_id(i):
+    return "soak-{0}".format(i % options.bench_services)
+
+
+def networks(i, generation=0):
+    return {
+        DiscoveryModel.INTERNAL: "http://10.{0}.{1}.{2}:9500".format(generation % 250, (i // 250) % 250, i % 250),
+        DiscoveryModel.EXTERNAL: "https://soak-{0}.example.com".format(i)
+    }
+
+
+def memory_taken():
+    """
+    Resident set size of the process in bytes, or the peak of it where the current one is not known.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Window(object):
+    """
+    The stats of a single reporting interval.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.samples = {operation: [] for operation in OPERATIONS}
+        self.errors = {operation: 0 for operation in OPERATIONS}
+        self.lags = []
+
+    def report(self, elapsed):
+        duration = time.perf_counter() - self.started
+
+        result = {
+            "elapsed": round(elapsed, 1),
+            "memory_mb": memory_taken() / 1048576.0,
+            "lag_p99_ms": percentile(self.lags, 0.99) * 1000.0 if self.lags else 0.0,
+            "lag_max_ms": max(self.lags) * 1000.0 if self.lags else 0.0,
+            "operations": {}
+        }
+
+        for operation in OPERATIONS:
+            samples = self.samples[operation]
+
+            result["operations"][operation] = {
+                "count": len(samples),
+                "errors": self.errors[operation],
+                "rps": len(samples) / duration if duration else 0.0,
+                "p50_ms": percentile(samples, 0.5) * 1000.0 if samples else None,
+                "p99_ms": percentile(samples, 0.99) * 1000.0 if samples else None
+            }
+
+        return result
+
+
+def print_header():
+    print("{0:>8} {1:>10} {2:>10} {3:>10}  {4}".format(
+        "elapsed", "memory, MB", "lag p99", "lag max", "operation: rps p50/p99 ms (errors)"))
+
+
+def print_report(report):
+    operations = "  ".join(
+        "{0}: {1:.0f} {2:.1f}/{3:.1f} ({4})".format(
+            operation, stats["rps"], stats["p50_ms"] or 0, stats["p99_ms"] or 0, stats["errors"])
+        for operation, stats in report["operations"].items()
+        if stats["count"] or stats["errors"]
+    )
+
+    print("{0:>8.0f} {1:>10.1f} {2:>10.1f} {3:>10.1f}  {4}".format(
+        report["elapsed"], report["memory_mb"], report["lag_p99_ms"], report["lag_max_ms"], operations))
+    sys.stdout.flush()
+
+
+def summarize_run(reports):
+    """
+    The latencies of every operation over the whole run (the p99 is the worst of the intervals after the warm-up),
+    and the totals.
+    """
+    settled = [report for report in reports if report["elapsed"] > options.bench_warmup] or reports
+    summary = {"operations": {}}
+
+    for operation in OPERATIONS:
+        count = sum(report["operations"][operation]["count"] for report in reports)
+        errors = sum(report["operations"][operation]["errors"] for report in reports)
+        p99 = [report["operations"][operation]["p99_ms"] for report in settled
+               if report["operations"][operation]["p99_ms"] is not None]
+
+        summary["operations"][operation] = {
+            "count": count,
+            "errors": errors,
+            "p99_ms": max(p99) if p99 else None
+        }
+
+    summary["memory_start_mb"] = settled[0]["memory_mb"]
+    summary["memory_end_mb"] = settled[-1]["memory_mb"]
+    summary["lag_p99_ms"] = max(report["lag_p99_ms"] for report in settled)
+
+    return summary
+
+
+def load_baseline(path):
+    summary = None
+
+    with open(path) as f:
+        for line in f:
+            record = ujson.loads(line)
+            if "summary" in record:
+                summary = record["summary"]
+
+    return summary
+
+
+def find_regressions(summary, baseline):
+    regressions = []
+
+    growth = summary["memory_end_mb"] - summary["memory_start_mb"]
+    if growth > options.bench_max_memory_growth:
+        regressions.append("memory has grown by {0:.1f} MB after the warm-up (over {1:.1f} MB)".format(
+            growth, options.bench_max_memory_growth))
+
+    if summary["lag_p99_ms"] > options.bench_max_loop_lag:
+        regressions.append("event loop lag p99 has reached {0:.1f} ms (over {1:.1f} ms)".format(
+            summary["lag_p99_ms"], options.bench_max_loop_lag))
+
+    total = sum(stats["count"] + stats["errors"] for stats in summary["operations"].values())
+    errors = sum(stats["errors"] for stats in summary["operations"].values())
+
+    if total and float(errors) / total > options.bench_max_error_rate:
+        regressions.append("{0} of {1} operations have failed (over {2:.2%})".format(
+            errors, total, options.bench_max_error_rate))
+
+    if baseline is not None:
+        for operation, stats in summary["operations"].items():
+            was = baseline["operations"].get(operation, {}).get("p99_ms")
+            now = stats["p99_ms"]
+
+            if was and now and now > was * (1.0 + options.bench_max_slowdown):
+                regressions.append("{0} p99 is {1:.1f} ms, was {2:.1f} ms".format(operation, now, was))
+
+    return regressions
+
+
+async def run():
+    options.discover_services_storage = options.bench_storage
+    options.discover_services_file = ""
+    options.services_init_file = ""
+
+    mix = traffic_mix()
+    baseline = load_baseline(options.bench_baseline) if options.bench_baseline else None
+
+    application = DiscoveryServer()
+    services = application.services
+
+    await services.started(application)
+    await services.set_services_networks({
+        service_id(i): networks(i)
+        for i in range(0, options.bench_services)
+    })
+
+    sockets = bind_sockets(0, "127.0.0.1")
+    port = sockets[0].getsockname()[1]
+
+    http_server = HTTPServer(application)
+    http_server.add_sockets(sockets)
+
+    base = "http://127.0.0.1:{0}".format(port)
+    client = AsyncHTTPClient(max_clients=options.bench_connections)
+
+    window = Window()
+    started = time.perf_counter()
+    deadline = started + options.bench_duration
+    churned = 0
+
+    async def request(path):
+        await client.fetch(HTTPRequest(base + path, method="GET", request_timeout=60))
+
+    async def churn(rnd):
+        nonlocal churned
+        churned += 1
+        i = rnd.randrange(0, options.bench_services)
+        await services.set_service_networks(service_id(i), networks(i, churned), author="soak")
+
+    def operation(name, rnd):
+        if name == "single":
+            return request("/service/" + service_id(rnd.randrange(0, options.bench_services)))
+        if name == "multi":
+            first = rnd.randrange(0, options.bench_services)
+            return request("/services/" + ",".join(
+                service_id(first + j) for j in range(0, options.bench_multi_size)))
+        if name == "listing":
+            return request("/@services/internal")
+        return churn(rnd)
+
+    names = list(mix.keys())
+    weights = [mix[name] for name in names]
+
+    async def simulated_client(number):
+        rnd = random.Random(number)
+
+        # so the clients do not all start at once
+        await asyncio.sleep(rnd.uniform(0, options.bench_think_time))
+
+        while time.perf_counter() < deadline:
+            name, = rnd.choices(names, weights)
+            operation_started = time.perf_counter()
+
+            try:
+                await operation(name, rnd)
+            except (HTTPError, IOError, asyncio.TimeoutError, DiscoveryError, Overloaded):
+                window.errors[name] += 1
+            else:
+                window.samples[name].append(time.perf_counter() - operation_started)
+
+            await asyncio.sleep(rnd.expovariate(1.0 / options.bench_think_time))
+
+    async def monitor_lag():
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(LAG_INTERVAL)
+            window.lags.append(max(0.0, time.perf_counter() - before - LAG_INTERVAL))
+
+    reports = []
+    clients = [asyncio.ensure_future(simulated_client(number)) for number in range(0, options.bench_clients)]
+    lag = asyncio.ensure_future(monitor_lag())
+
+    print_header()
+
+    with open(options.bench_output, "w") as output:
+        output.write(ujson.dumps({
+            "date": datetime.datetime.utcnow().isoformat(),
+            "storage": options.bench_storage,
+            "services": options.bench_services,
+            "clients": options.bench_clients,
+            "mix": mix
+        }) + "\n")
+
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(min(options.bench_interval, max(0.0, deadline - time.perf_counter())))
+
+            finished, window = window, Window()
+            report = finished.report(time.perf_counter() - started)
+            reports.append(report)
+
+            print_report(report)
+            output.write(ujson.dumps(report) + "\n")
+            output.flush()
+
+        lag.cancel()
+        await asyncio.gather(*clients, return_exceptions=True)
+
+        summary = summarize_run(reports)
+        regressions = find_regressions(summary, baseline)
+
+        output.write(ujson.dumps({"summary": summary, "regressions": regressions}) + "\n")
+
+    http_server.stop()
+    await services.stopped()
+
+    for regression in regressions:
+        print("REGRESSION: " + regression)
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    server.init()
+    sys.exit(IOLoop.current().run_sync(run))
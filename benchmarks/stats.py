@@ -0,0 +1,34 @@
+"""
+Helpers shared by the benchmarks.
+"""
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def summarize(name, samples, elapsed, errors=0, **extra):
+    """
+    Summarizes latency samples (in seconds) of a run that took `elapsed` seconds in total.
+    """
+    result = {
+        "name": name,
+        "requests": len(samples),
+        "errors": errors,
+        "p50_ms": percentile(samples, 0.5) * 1000.0 if samples else None,
+        "p99_ms": percentile(samples, 0.99) * 1000.0 if samples else None,
+        "rps": len(samples) / elapsed if elapsed else None
+    }
+    result.update(extra)
+    return result
+
+
+def print_results(results):
+    print("{0:<32} {1:>9} {2:>7} {3:>10} {4:>10} {5:>10}".format(
+        "benchmark", "requests", "errors", "p50, ms", "p99, ms", "rps"))
+
+    for result in results:
+        print("{0:<32} {1:>9} {2:>7} {3:>10.3f} {4:>10.3f} {5:>10.1f}".format(
+            result["name"], result["requests"], result["errors"],
+            result["p50_ms"] or 0, result["p99_ms"] or 0, result["rps"] or 0))
@@ -0,0 +1,216 @@
+"""
+Throughput of single service lookups as the number of worker processes grows.
+
+For every worker count, the server is started with that many processes sharing one listening socket
+(the leader reading from Redis, the others from the snapshot it publishes), and hit by a number of
+client processes at once. Runs against a real Redis; services named "bench-<N>" are written into
+the database given, so point it to a database not used for anything else.
+
+    python benchmarks/workers.py --discover_services_db=14 --bench_workers=1,2,4
+
+Reports requests per second and p50/p99 latency for every worker count, and writes the same into
+the output file as JSON.
+"""
+
+from anthill.common.options import options, define
+from anthill.common import server
+from anthill.discovery import options as _opts
+
+from tornado.netutil import bind_sockets
+
+from stats import summarize, print_results
+
+import multiprocessing
+import urllib.request
+import urllib.error
+import datetime
+import tempfile
+import signal
+import socket
+import time
+import ujson
+import os
+
+define("bench_workers",
+       default="1,2,4",
+       help="Comma-separated numbers of worker processes to run the benchmark with.",
+       type=str)
+
+define("bench_services",
+       default=1000,
+       help="Number of services in the registry.",
+       type=int)
+
+define("bench_requests",
+       default=20000,
+       help="Requests to make for each number of workers.",
+       type=int)
+
+define("bench_clients",
+       default=4,
+       help="Number of client processes generating the load.",
+       type=int)
+
+define("bench_concurrency",
+       default=25,
+       help="Number of concurrent requests of each client process.",
+       type=int)
+
+define("bench_output",
+       default="bench_workers.json",
+       help="File to write the results to.",
+       type=str)
+
+
+def service_id(i):
+    return "bench-{0}".format(i % options.bench_services)
+
+
+def serve(sockets, workers):
+    """
+    Runs in a process of its own (and its own process group, so the workers can be stopped all at once),
+    much like workers.start does, but without the parts of the server that need the rest of the platform.
+    """
+    from anthill.discovery import workers as w
+    from tornado.httpserver import HTTPServer
+    from tornado.ioloop import IOLoop
+    from tornado.process import fork_processes
+
+    os.setpgrp()
+
+    options.discover_services_storage = "redis"
+    options.services_init_file = ""
+    options.discovery_snapshot_file = os.path.join(
+        tempfile.gettempdir(), "anthill-discovery-bench-{0}.snapshot".format(os.getpid()))
+
+    worker_id = fork_processes(workers) if workers > 1 else w.LEADER
+
+    if worker_id != w.LEADER:
+        options.discover_services_storage = "snapshot"
+
+    from anthill.discovery.server import DiscoveryServer
+    from anthill.discovery.model.discovery import DiscoveryModel
+
+    async def start():
+        application = DiscoveryServer()
+        await application.services.started(application)
+
+        if worker_id == w.LEADER:
+            await application.services.set_services_networks({
+                service_id(i): {DiscoveryModel.INTERNAL: "http://10.0.0.{0}:9500".format(i % 250)}
+                for i in range(0, options.bench_services)
+            })
+
+        http_server = HTTPServer(application)
+        http_server.add_sockets(sockets)
+
+    IOLoop.current().add_callback(start)
+    IOLoop.current().start()
+
+
+def wait_ready(port, timeout=30):
+    deadline = time.time() + timeout
+    url = "http://127.0.0.1:{0}/service/{1}/internal".format(port, service_id(options.bench_services - 1))
+
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except (urllib.error.URLError, socket.error):
+            time.sleep(0.1)
+
+    raise RuntimeError("Server has not started in time")
+
+
+def load(port, requests, concurrency, offset):
+    """
+    Runs in a client process: makes the requests, returns the latency samples and the time it took.
+    """
+    from tornado.httpclient import AsyncHTTPClient, HTTPError
+    from tornado.ioloop import IOLoop
+
+    import asyncio
+
+    client = AsyncHTTPClient(max_clients=concurrency)
+    base = "http://127.0.0.1:{0}/service/".format(port)
+    counter = iter(range(offset, offset + requests))
+    samples = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+
+        for i in counter:
+            started = time.perf_counter()
+
+            try:
+                await client.fetch(base + service_id(i) + "/internal")
+            except HTTPError:
+                errors += 1
+            else:
+                samples.append(time.perf_counter() - started)
+
+    async def run():
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(0, concurrency)])
+        return time.perf_counter() - started
+
+    elapsed = IOLoop.current().run_sync(run)
+    return samples, elapsed, errors
+
+
+def measure(workers):
+    sockets = bind_sockets(0, "127.0.0.1")
+    port = sockets[0].getsockname()[1]
+
+    process = multiprocessing.Process(target=serve, args=(sockets, workers))
+    process.start()
+
+    try:
+        wait_ready(port)
+        # give the workers a moment to pick up the snapshot
+        time.sleep(1)
+
+        per_client = options.bench_requests // options.bench_clients
+
+        with multiprocessing.Pool(options.bench_clients) as pool:
+            results = pool.starmap(load, [
+                (port, per_client, options.bench_concurrency, client * per_client)
+                for client in range(0, options.bench_clients)
+            ])
+    finally:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.join()
+
+        for sock in sockets:
+            sock.close()
+
+    samples = [sample for client_samples, elapsed, errors in results for sample in client_samples]
+    elapsed = max(elapsed for client_samples, elapsed, errors in results)
+    errors = sum(errors for client_samples, elapsed, errors in results)
+
+    return summarize("{0} workers".format(workers), samples, elapsed, errors=errors, workers=workers)
+
+
+def run():
+    results = [
+        measure(int(workers))
+        for workers in options.bench_workers.split(",")
+    ]
+
+    print_results(results)
+
+    with open(options.bench_output, "w") as f:
+        ujson.dump({
+            "date": datetime.datetime.utcnow().isoformat(),
+            "services": options.bench_services,
+            "clients": options.bench_clients,
+            "concurrency": options.bench_concurrency,
+            "results": results
+        }, f, indent=2)
+
+
+if __name__ == "__main__":
+    server.init()
+    multiprocessing.set_start_method("fork")
+    run()
@@ -20,5 +20,10 @@ setup(
     include_package_data=True,
     packages=find_namespace_packages(include=["anthill.*"]),
     zip_safe=False,
-    install_requires=DEPENDENCIES
+    install_requires=DEPENDENCIES,
+    extras_require={
+        # optional encodings of the bulk lookup responses, see model/encoding.py
+        "msgpack": ["msgpack"],
+        "brotli": ["brotli"]
+    }
 )